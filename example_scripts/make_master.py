@@ -10,6 +10,7 @@ import argparse
 
 import general
 import master
+import shared
 
 ################################################################################
 
@@ -134,13 +135,15 @@ def make_master_data(original_file_location,original_filename_structure,file_num
 
     file_number, ID_data, cosmology, file_pixel_map_element, MOCKID_lookup_element = master.get_ID_data(original_file_location,original_filename_structure,file_number,input_format,N_side,minimum_z=min_catalog_z)
 
-    return [file_number, ID_data, cosmology, file_pixel_map_element, MOCKID_lookup_element]
+    #Return the file's catalog in shared memory, so that it is not pickled back to the main process.
+    return [file_number, shared.shared_array(ID_data), cosmology, file_pixel_map_element, MOCKID_lookup_element]
 
 #Set up the multiprocessing pool parameters and make a list of tasks.
 tasks = [(original_file_location,original_filename_structure,file_number,input_format,N_side) for file_number in file_numbers]
 
 #Run the multiprocessing pool
 if __name__ == '__main__':
+    shared.start_resource_tracker()
     pool = Pool(processes = N_processes)
     results = []
     start_time = time.time()
@@ -151,6 +154,12 @@ if __name__ == '__main__':
     pool.close()
     pool.join()
 
+    #Copy the catalogs out of shared memory.
+    for result in results:
+        ID_data = result[1]
+        result[1] = ID_data.copy()
+        ID_data.unlink()
+
 print('\nSaving the master files...')
 
 #Join the multiprocessing results into 'master' and 'bad_coordinates' arrays.
@@ -161,6 +170,11 @@ master_filename = new_base_file_location + '/master.fits'
 master.write_ID(master_filename,master_data,cosmology_data,N_side)
 print('\nMaster file contains {} objects.'.format(master_data.shape[0]))
 
+#Write the MOCKID lookup alongside the master file.
+MOCKID_lookup_filename = new_base_file_location + '/master_MOCKID_lookup.fits'
+lookup_index, sorted_MOCKID = master.make_MOCKID_lookup_index(master_data)
+master.write_MOCKID_lookup(MOCKID_lookup_filename,lookup_index,sorted_MOCKID,N_side)
+
 if bad_coordinates_data.shape[0] > 0:
     bad_coordinates_filename = new_base_file_location + '/bad_coordinates.fits'
     master.write_ID(bad_coordinates_filename,bad_coordinates_data,cosmology_data,N_side)
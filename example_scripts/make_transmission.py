@@ -9,6 +9,7 @@ import sys
 import time
 import os
 import argparse
+import functools
 
 import general
 import independent
@@ -18,6 +19,10 @@ import pixelise
 import input
 import DLA
 import RSD
+import master
+import checkpoint
+import schedule
+import workqueue
 
 ################################################################################
 
@@ -85,6 +90,12 @@ parser.add_argument('--add-RSDs', action="store_true", default = False, required
 parser.add_argument('--include-thermal-effects', action="store_true", default = False, required=False,
                     help = 'add thermal RSDs to the transmission file')
 
+parser.add_argument('--thermal-kernel', type = str, default = 'batched', required=False,
+                    help = 'method for computing thermal RSDs', choices=['batched','loop'])
+
+parser.add_argument('--resampling', type = str, default = 'NGP', required=False,
+                    help = 'method for resampling skewers onto the output cells', choices=['NGP','linear','cubic'])
+
 parser.add_argument('--retune-small-scale-fluctuations', action="store_true", default = False, required=False,
                     help = 'recalculate the values of sigma_G and alpha needed')
 
@@ -94,6 +105,27 @@ parser.add_argument('--transmission-only', action="store_true", default = False,
 parser.add_argument('--nskewers', type = int, default = None, required=False,
                     help = 'number of skewers to process')
 
+parser.add_argument('--seed', type = int, default = 0, required=False,
+                    help = 'global seed for the random numbers drawn for each skewer')
+
+parser.add_argument('--overwrite', action="store_true", default = False, required=False,
+                    help = 'redo stages that have already been completed for a pixel, rather than skipping them')
+
+parser.add_argument('--direct-from-colore', action="store_true", default = False, required=False,
+                    help = 'measure the Gaussian mean and variance in a pre-pass over the input files, and make each pixel\'s final skewers directly from them without gaussian-colore files')
+
+parser.add_argument('--ingest-by-file', action="store_true", default = False, required=False,
+                    help = 'read each input file once, splitting its skewers into per-pixel shards')
+
+parser.add_argument('--queue-dir', type = str, default = None, required=False,
+                    help = 'shared directory of a work queue (use a new one for each run): each stage\'s tasks are shared between all workers run with the same arguments and queue, on any number of hosts')
+
+parser.add_argument('--queue-timeout', type = float, default = 600., required=False,
+                    help = 'time in s after which a task claimed from the work queue by a worker that has stopped responding is given to another worker')
+
+parser.add_argument('--queue-max-attempts', type = int, default = 3, required=False,
+                    help = 'number of times a task from the work queue is tried before it is recorded as failed')
+
 ################################################################################
 
 args = parser.parse_args()
@@ -120,10 +152,19 @@ parameter_filename = args.param_file
 add_DLAs = args.add_DLAs
 add_RSDs = args.add_RSDs
 include_thermal_effects = args.include_thermal_effects
+thermal_kernel = args.thermal_kernel
+resampling = args.resampling
 retune_small_scale_fluctuations = args.retune_small_scale_fluctuations
 tuning_file = args.tuning_file
 transmission_only = args.transmission_only
 N_skewers = args.nskewers
+ingest_by_file = args.ingest_by_file
+global_seed = args.seed
+overwrite = args.overwrite
+direct_from_colore = args.direct_from_colore
+queue_dir = args.queue_dir
+queue_timeout = args.queue_timeout
+queue_max_attempts = args.queue_max_attempts
 
 # TODO: print to confirm the arguments. e.g. "DLAs will be added"
 
@@ -140,6 +181,8 @@ input_format = 'gaussian_colore'
 #Set file structure
 new_file_structure = '{}/{}/'               #pixel number//100, pixel number
 new_filename_structure = '{}-{}-{}.fits'    #file type, nside, pixel number
+shard_filename_structure = '{}-{}-{}-{}.fits'   #file type, nside, pixel number, file number
+gaussian_statistics_filename_structure = 'gaussian-statistics-{}-{}.json'   #nside, file number
 
 #Calculate the minimum value of z that we are interested in.
 #i.e. the z value for which lambda_min cooresponds to the lya wavelength.
@@ -159,23 +202,24 @@ if simulation_parameters['dens_type'] != 0:
 Construct the MOCKID_lookup from the master file.
 """
 # TODO: potential issue with differnt values of nside being used in make_master.py
-master = fits.open(master_location+'/master.fits')
-master_data = master[1].data
-master.close()
-
-#Make a MOCKID lookup.
-pixel_list = list(sorted(set([pixel for pixel in master_data['PIXNUM'] if pixel in pixels])))
-MOCKID_lookup = {}
-for pixel in pixel_list:
-    #pixel_indices = [i for i in range(len(master_data['PIXNUM'])) if master_data['PIXNUM'][i]==pixel]
-    pixel_indices = (master_data['PIXNUM']==pixel)
-    pixel_MOCKIDs = master_data['MOCKID'][pixel_indices]
-    pixel_file_number_list = list(sorted(set(master_data['FILENUM'][pixel_indices])))
-    for file_number in pixel_file_number_list:
-        pixel_file_indices = ((master_data['FILENUM'][pixel_indices])==file_number)
-        #MOCKID_list = [master_data['MOCKID'][i] for i in range(len(master_data['PIXNUM'])) if master_data['PIXNUM'][i]==pixel and master_data['FILENUM'][i]==file_number]
-        pixel_file_MOCKIDs = pixel_MOCKIDs[pixel_file_indices]
-        MOCKID_lookup = {**MOCKID_lookup,**{(file_number,pixel):list(pixel_file_MOCKIDs)}}
+#Load the MOCKID lookup saved alongside the master file if there is one, otherwise make it from the master file.
+#The lookup is held in shared memory, so that it is not copied for each multiprocessing task.
+MOCKID_lookup_filename = master_location+'/master_MOCKID_lookup.fits'
+if os.path.isfile(MOCKID_lookup_filename):
+    MOCKID_lookup = master.read_MOCKID_lookup(MOCKID_lookup_filename,pixels=pixels,use_shared_memory=True)
+else:
+    h = fits.open(master_location+'/master.fits')
+    master_data = h[1].data
+    h.close()
+    MOCKID_lookup = master.make_MOCKID_lookup(master_data,pixels=pixels,use_shared_memory=True)
+
+pixel_list = list(sorted(set([key[1] for key in MOCKID_lookup.keys()])))
+
+#Order the pixels from most to least costly, so that the most costly pixels are not left until the end of the run.
+#Costs are estimated from the master file, and refined using the times recorded in any previous runs.
+pixel_costs = schedule.get_pixel_costs(master_location+'/master.fits',pixel_list,z_min=z_min)
+pixel_timings = schedule.get_pixel_timings(new_base_file_location,new_file_structure,N_side,pixel_list)
+pixel_list = schedule.order_by_cost(pixel_list,schedule.refine_pixel_costs(pixel_costs,pixel_timings))
 
 ################################################################################
 
@@ -196,18 +240,108 @@ def log_result(retval):
 def log_error(retval):
     print('Error:',retval)
 
+#Define a function to run a task from the work queue, given the task's name.
+def run_queue_task(function,task_dict,task_name):
+    return function(*task_dict[task_name])
+
+#Define a function to run a stage's tasks with the multiprocessing pool, filling the global results list.
+#If there is a work queue, the tasks are instead shared between all of the workers using it, and this returns once they are all complete.
+#The results list then only holds the results of the tasks run by this worker.
+def run_tasks(stage,function,tasks,task_names):
+    global results
+
+    results = []
+    if queue_dir is None:
+        pool = Pool(processes = N_processes)
+        for task in tasks:
+            pool.apply_async(function,task,callback=log_result,error_callback=log_error)
+        pool.close()
+        pool.join()
+    else:
+        task_function = functools.partial(run_queue_task,function,{str(task_name):task for task_name, task in zip(task_names,tasks)})
+        queue_results, failed_tasks = workqueue.run_stage(queue_dir,stage,task_names,task_function,N_processes=N_processes,timeout=queue_timeout,max_attempts=queue_max_attempts)
+        results = [result for task_name, result in queue_results]
+        print('\nCompleted {} of {} tasks from the work queue in this worker.'.format(len(results),len(tasks)))
+        if len(failed_tasks) > 0:
+            print('Error: tasks {} failed {} times.'.format(failed_tasks,queue_max_attempts))
+
+    return
+
 ################################################################################
 
-print('\nWorking on per-HEALPix pixel initial Gaussian skewer files...')
-start_time = time.time()
+"""
+If desired, read each input file once, splitting its skewers into per-pixel shards.
+The pixel files are then made from these shards rather than from the input files.
+"""
+
+#Define the ingestion process.
+def ingest_file(file_number,original_file_location,original_filename_structure,input_format,MOCKID_lookup,new_base_file_location,new_file_structure,N_side):
+
+    #Split the file's skewers into pixels.
+    pixel_objects = pixelise.make_gaussian_file_pixel_objects(file_number,original_file_location,original_filename_structure,input_format,MOCKID_lookup,IVAR_cutoff=IVAR_cutoff)
+
+    #Save each pixel's skewers as a shard, unless the pixel's Gaussian skewers have already been made.
+    for pixel, pixel_object in pixel_objects.items():
+        location = new_base_file_location + '/' + new_file_structure.format(pixel//100,pixel)
+        if not overwrite and checkpoint.stage_complete(location,N_side,pixel,'gaussian'):
+            continue
+
+        header = fits.Header()
+        header['HPXNSIDE'] = N_side
+        header['HPXPIXEL'] = pixel
+        header['HPXNEST'] = True
+        header['LYA'] = lya
+        header['SIGMA_G'] = pixel_object.SIGMA_G
+
+        filename = shard_filename_structure.format('gaussian-colore-shard',N_side,pixel,file_number)
+        pixel_object.save_as_gaussian_colore(location,filename,header,overwrite=True)
+
+    return file_number
+
+#The shards are not needed if the final skewers are to be made directly from the input files.
+if ingest_by_file and not direct_from_colore:
+
+    print('\nWorking on per-file shards of the input skewers...')
+    start_time = time.time()
+
+    #Only read the files that have skewers in pixels whose Gaussian skewers have not already been made.
+    def get_location(pixel):
+        return new_base_file_location + '/' + new_file_structure.format(pixel//100,pixel)
+    ingest_file_numbers = list(sorted(set([key[0] for key in MOCKID_lookup.keys() if overwrite or not checkpoint.stage_complete(get_location(key[1]),N_side,key[1],'gaussian')])))
+    tasks = [(file_number,original_file_location,original_filename_structure,input_format,MOCKID_lookup,new_base_file_location,new_file_structure,N_side) for file_number in ingest_file_numbers]
+
+    #Run the multiprocessing pool
+    if __name__ == '__main__':
+        start_time = time.time()
+        run_tasks('ingest',ingest_file,tasks,ingest_file_numbers)
+
+    print('\nTime to make shards: {:4.0f}s.\n'.format(time.time()-start_time))
+
+################################################################################
+
+#This stage is not needed if the final skewers are to be made directly from the input files.
+if not direct_from_colore:
+    print('\nWorking on per-HEALPix pixel initial Gaussian skewer files...')
+    start_time = time.time()
 
 #Define the pixelisation process.
 def pixelise_gaussian_skewers(pixel,original_file_location,original_filename_structure,input_format,MOCKID_lookup,z_min,new_base_file_location,new_file_structure,N_side):
     #Define the save location for the pixel, according to the new file structure.
     location = new_base_file_location + '/' + new_file_structure.format(pixel//100,pixel)
 
-    #Make file into an object
-    pixel_object = pixelise.make_gaussian_pixel_object(pixel,original_file_location,original_filename_structure,input_format,MOCKID_lookup,IVAR_cutoff=IVAR_cutoff)
+    #If the pixel's Gaussian skewers have already been made, return the means stored when they were.
+    if not overwrite and checkpoint.stage_complete(location,N_side,pixel,'gaussian'):
+        stage_data = checkpoint.get_stage_data(location,N_side,pixel,'gaussian')
+        means_data = [stage_data['N'],stage_data['mean_DG'],stage_data['mean_DGS']]
+        return means_data
+    pixel_start_time = time.time()
+
+    #Make file into an object, either from the pixel's shards or from the input files.
+    if ingest_by_file:
+        shard_filenames = [location + shard_filename_structure.format('gaussian-colore-shard',N_side,pixel,key[0]) for key in MOCKID_lookup.keys() if key[1]==pixel]
+        pixel_object = pixelise.make_gaussian_pixel_object_from_files(shard_filenames,IVAR_cutoff=IVAR_cutoff)
+    else:
+        pixel_object = pixelise.make_gaussian_pixel_object(pixel,original_file_location,original_filename_structure,input_format,MOCKID_lookup,IVAR_cutoff=IVAR_cutoff)
 
     # TODO: These could be made beforehand and passed to the function? Or is there already enough being passed?
     #Make some useful headers
@@ -221,13 +355,24 @@ def pixelise_gaussian_skewers(pixel,original_file_location,original_filename_str
     header['SIGMA_G'] = pixel_object.SIGMA_G
 
     #Gaussian CoLoRe
+    #Any existing file is from a run that did not complete this stage, so is replaced.
     filename = new_filename_structure.format('gaussian-colore',N_side,pixel)
-    pixel_object.save_as_gaussian_colore(location,filename,header)
+    pixel_object.save_as_gaussian_colore(location,filename,header,overwrite=True)
 
     #Calculate the means of the pixel's gaussian skewers.
     #WARNING: this currently just uses all of the cells but this may be too slow once we've added small scale power?
-    N, mean_DG, mean_DGS = stats.return_means(pixel_object.GAUSSIAN_DELTA_rows,pixel_object.IVAR_rows)
+    N, mean_DG, mean_DGS = stats.return_means(pixel_object.GAUSSIAN_DELTA_rows,pixel_object.IVAR_cells)
     means_data = [N,mean_DG,mean_DGS]
+
+    #Record that the stage is complete, storing the means so that they need not be recomputed.
+    #The final skewers must then be remade from the new Gaussian skewers.
+    checkpoint.reset_stages(location,N_side,pixel,['final'])
+    checkpoint.mark_stage_complete(location,N_side,pixel,'gaussian',data={'N':N,'mean_DG':mean_DG,'mean_DGS':mean_DGS,'time':time.time()-pixel_start_time})
+
+    #The shards are no longer needed once the Gaussian CoLoRe file has been saved.
+    if ingest_by_file:
+        for shard_filename in shard_filenames:
+            os.remove(shard_filename)
     print(pixel)
     return means_data
 
@@ -238,18 +383,73 @@ def pixelise_gaussian_skewers(pixel,original_file_location,original_filename_str
 tasks = [(pixel,original_file_location,original_filename_structure,input_format,MOCKID_lookup,z_min,new_base_file_location,new_file_structure,N_side) for pixel in pixel_list]
 
 #Run the multiprocessing pool
-if __name__ == '__main__':
-    pool = Pool(processes = N_processes)
-    results = []
+if __name__ == '__main__' and not direct_from_colore:
     start_time = time.time()
+    run_tasks('gaussian',pixelise_gaussian_skewers,tasks,pixel_list)
+
+    #With a work queue, other workers made some of the pixels, so get all of the pixels' means from their manifests.
+    if queue_dir is not None:
+        results = []
+        for pixel in pixel_list:
+            location = new_base_file_location + '/' + new_file_structure.format(pixel//100,pixel)
+            if checkpoint.stage_complete(location,N_side,pixel,'gaussian'):
+                stage_data = checkpoint.get_stage_data(location,N_side,pixel,'gaussian')
+                results += [[stage_data['N'],stage_data['mean_DG'],stage_data['mean_DGS']]]
+
+    print('\nTime to make Gaussian pixel files: {:4.0f}s.\n'.format(time.time()-start_time))
+
+################################################################################
 
-    for task in tasks:
-        pool.apply_async(pixelise_gaussian_skewers,task,callback=log_result,error_callback=log_error)
+"""
+If making the final skewers directly from the input files, measure the sums needed for the mean and variance of the Gaussian skewers in a pre-pass over the input files.
+The sums for each (file, pixel) pair are stored in the output directory, so that they need not be remeasured when the run is restarted.
+"""
+
+#Define the pre-pass process.
+def measure_gaussian_sums(file_number,original_file_location,original_filename_structure,input_format,MOCKID_lookup,new_base_file_location,N_side):
+
+    #Load any sums that have already been measured.
+    sums_filename = new_base_file_location + '/' + gaussian_statistics_filename_structure.format(N_side,file_number)
+    if overwrite:
+        file_sums = {}
+    else:
+        file_sums = checkpoint.read_json(sums_filename)
 
-    pool.close()
-    pool.join()
+    #Measure the sums for the file's pixels that have not already been measured.
+    file_pixels = [key[1] for key in MOCKID_lookup.keys() if key[0]==file_number]
+    MOCKID_groups = {pixel:MOCKID_lookup[(file_number,pixel)] for pixel in file_pixels if str(pixel) not in file_sums}
+    if len(MOCKID_groups) > 0:
+        filename = original_file_location + '/' + original_filename_structure.format(file_number)
+        new_file_sums = stats.get_gaussian_sums(filename,file_number,input_format,MOCKID_groups,IVAR_cutoff=IVAR_cutoff)
+        for pixel, sums in new_file_sums.items():
+            file_sums[str(pixel)] = sums
+        checkpoint.write_json(sums_filename,file_sums)
 
-print('\nTime to make Gaussian pixel files: {:4.0f}s.\n'.format(time.time()-start_time))
+    return [file_sums[str(pixel)] for pixel in file_pixels]
+
+if direct_from_colore:
+
+    print('\nMeasuring the Gaussian mean and variance from the input files...')
+    start_time = time.time()
+
+    sums_file_numbers = list(sorted(set([key[0] for key in MOCKID_lookup.keys()])))
+    tasks = [(file_number,original_file_location,original_filename_structure,input_format,MOCKID_lookup,new_base_file_location,N_side) for file_number in sums_file_numbers]
+
+    #Run the multiprocessing pool
+    if __name__ == '__main__':
+        start_time = time.time()
+        run_tasks('gaussian-sums',measure_gaussian_sums,tasks,sums_file_numbers)
+
+        #With a work queue, other workers measured some of the sums, so get all of the files' sums from the output directory.
+        if queue_dir is not None:
+            results = []
+            for file_number in sums_file_numbers:
+                sums_filename = new_base_file_location + '/' + gaussian_statistics_filename_structure.format(N_side,file_number)
+                file_sums = checkpoint.read_json(sums_filename)
+                file_pixels = [key[1] for key in MOCKID_lookup.keys() if key[0]==file_number]
+                results += [[file_sums[str(pixel)] for pixel in file_pixels if str(pixel) in file_sums]]
+
+    print('\nTime to measure Gaussian mean and variance: {:4.0f}s.\n'.format(time.time()-start_time))
 
 ################################################################################
 
@@ -257,10 +457,16 @@ print('\nTime to make Gaussian pixel files: {:4.0f}s.\n'.format(time.time()-star
 To correctly calculate the physical fields, we must measure sigma from the Gaussian skewers.
 """
 
-means_data_array = np.array(results)
-N_total = np.sum(means_data_array[:,0])
-gaussian_mean = (np.sum(means_data_array[:,1]*means_data_array[:,0]))/N_total
-gaussian_variance = (np.sum(means_data_array[:,2]*means_data_array[:,0]))/N_total - gaussian_mean**2
+if direct_from_colore:
+    sums_array = np.array([sums for result in results for sums in result])
+    N_total = np.sum(sums_array[:,0])
+    gaussian_mean = np.sum(sums_array[:,1])/N_total
+    gaussian_variance = np.sum(sums_array[:,2])/N_total - gaussian_mean**2
+else:
+    means_data_array = np.array(results)
+    N_total = np.sum(means_data_array[:,0])
+    gaussian_mean = (np.sum(means_data_array[:,1]*means_data_array[:,0]))/N_total
+    gaussian_variance = (np.sum(means_data_array[:,2]*means_data_array[:,0]))/N_total - gaussian_mean**2
 measured_SIGMA_G = np.sqrt(gaussian_variance)
 
 print('\nGaussian skewers have mean {:2.2f}, variance {:2.2f}.'.format(gaussian_mean,measured_SIGMA_G))
@@ -311,11 +517,20 @@ def produce_final_skewers(new_base_file_location,new_file_structure,new_filename
     location = new_base_file_location + '/' + new_file_structure.format(pixel//100,pixel)
     mean_F_data = np.array(list(zip(tuning_z_values,desired_mean_F)))
 
-    #We work from the gaussian colore files made in 'pixelise gaussian skewers'.
+    #If the pixel's final skewers have already been made, skip it.
+    if not overwrite and checkpoint.stage_complete(location,N_side,pixel,'final'):
+        return pixel
+    pixel_start_time = time.time()
+
+    #We work from the gaussian colore files made in 'pixelise gaussian skewers', or directly from the input files.
     gaussian_filename = new_filename_structure.format('gaussian-colore',N_side,pixel)
 
     #Make a pixel object from it.
-    pixel_object = pixelise.simulation_data.get_gaussian_skewers_object(location+gaussian_filename,None,input_format,SIGMA_G=measured_SIGMA_G,IVAR_cutoff=IVAR_cutoff)
+    if direct_from_colore:
+        pixel_object = pixelise.make_gaussian_pixel_object(pixel,original_file_location,original_filename_structure,input_format,MOCKID_lookup,IVAR_cutoff=IVAR_cutoff)
+        pixel_object.SIGMA_G = measured_SIGMA_G
+    else:
+        pixel_object = pixelise.simulation_data.get_gaussian_skewers_object(location+gaussian_filename,None,input_format,SIGMA_G=measured_SIGMA_G,IVAR_cutoff=IVAR_cutoff)
 
     #Make some useful headers
     header = fits.Header()
@@ -329,7 +544,7 @@ def produce_final_skewers(new_base_file_location,new_file_structure,new_filename
         #lognorm CoLoRe
         pixel_object.compute_physical_skewers()
         filename = new_filename_structure.format('physical-colore',N_side,pixel)
-        pixel_object.save_as_physical_colore(location,filename,header)
+        pixel_object.save_as_physical_colore(location,filename,header,overwrite=True)
 
     #Trim the skewers (remove low lambda cells)
     pixel_object.trim_skewers(lambda_min,min_catalog_z,extra_cells=1)
@@ -337,13 +552,13 @@ def produce_final_skewers(new_base_file_location,new_file_structure,new_filename
     #Exit now if no skewers are left.
     if pixel_object.N_qso == 0:
         print('\nwarning: no objects left in pixel {} after trimming.'.format(pixel))
+        checkpoint.mark_stage_complete(location,N_side,pixel,'final',data={'time':time.time()-pixel_start_time})
         return pixel
 
     #Add small scale power to the gaussian skewers:
-    #new_seed = 10**(len(str(12*N_side**2))) + pixel
-    seed = int(str(N_side) + str(pixel))
-    generator = np.random.RandomState(seed)
-    new_cosmology = pixel_object.add_small_scale_gaussian_fluctuations(final_cell_size,tuning_z_values,extra_sigma_G_values,generator,white_noise=False,lambda_min=lambda_min,IVAR_cutoff=IVAR_cutoff)
+    #Each skewer has its own random number generator, keyed on the global seed and its MOCKID.
+    generators = general.get_skewer_generators(global_seed,pixel_object.MOCKID,'small_scale_fluctuations')
+    new_cosmology = pixel_object.add_small_scale_gaussian_fluctuations(final_cell_size,tuning_z_values,extra_sigma_G_values,generators,white_noise=False,lambda_min=lambda_min,IVAR_cutoff=IVAR_cutoff,resampling=resampling)
     #new_cosmology = []
 
     #Remove the 'SIGMA_G' header as SIGMA_G now varies with z, so can't be stored in a header.
@@ -355,59 +570,50 @@ def produce_final_skewers(new_base_file_location,new_file_structure,new_filename
     #That means we need to store skewers all the way down to z=0.
     #Not possible atm as we'd run out of memory, but can be done once running on >1 node.
     if add_DLAs:
-        pixel_object.add_DLA_table()
-
-    #Add physical skewers to the object.
-    pixel_object.compute_physical_skewers()
-
-    #Add tau skewers to the object.
-    pixel_object.compute_tau_skewers(np.interp(pixel_object.Z,tuning_z_values,alphas),beta)
+        pixel_object.add_DLA_table(seed=global_seed)
 
-    #Convert the tau skewers to flux skewers.
-    pixel_object.compute_flux_skewers()
+    #Add physical, tau and flux skewers to the object in one pass.
+    #The physical skewers are only kept if they are to be saved or needed for RSDs, and the tau skewers only if needed for RSDs.
+    store_density = (transmission_only == False) or add_RSDs
+    pixel_object.compute_all_skewers(np.interp(pixel_object.Z,tuning_z_values,alphas),beta,store_density=store_density,store_tau=add_RSDs)
 
+    #The selection of QSOs, IVAR, LOGLAM_MAP and catalog are shared by all picca files, as RSDs do not change them.
+    picca_plan = None
     if transmission_only == False:
-        #Picca Gaussian
-        filename = new_filename_structure.format('picca-gaussian-noRSD',N_side,pixel)
-        pixel_object.save_as_picca_gaussian(location,filename,header)
-
-        #Picca density
-        filename = new_filename_structure.format('picca-density-noRSD',N_side,pixel)
-        pixel_object.save_as_picca_density(location,filename,header)
-
-        #picca flux
-        filename = new_filename_structure.format('picca-flux-noRSD',N_side,pixel)
-        pixel_object.save_as_picca_flux(location,filename,header,mean_F_data=mean_F_data)
+        #Picca Gaussian, density and flux
+        filenames = {}
+        for product in ['gaussian','density','flux']:
+            filenames[product] = new_filename_structure.format('picca-'+product+'-noRSD',N_side,pixel)
+        picca_plan = pixel_object.save_as_picca_products(location,filenames,header,mean_F_data=mean_F_data,overwrite=True)
 
     #Add thermal RSDs to the tau skewers.
     #Add RSDs from the velocity skewers provided by CoLoRe.
     if add_RSDs == True:
-        pixel_object.add_RSDs(np.interp(pixel_object.Z,tuning_z_values,alphas),beta,thermal=include_thermal_effects)
+        pixel_object.add_RSDs(np.interp(pixel_object.Z,tuning_z_values,alphas),beta,thermal=include_thermal_effects,thermal_kernel=thermal_kernel)
 
-    #Convert the tau skewers to flux skewers.
-    pixel_object.compute_flux_skewers()
+        #Convert the tau skewers to flux skewers.
+        pixel_object.compute_flux_skewers()
 
     #transmission
     filename = new_filename_structure.format('transmission',N_side,pixel)
-    pixel_object.save_as_transmission(location,filename,header)
+    pixel_object.save_as_transmission(location,filename,header,overwrite=True)
 
     if transmission_only == False:
-        #Picca Gaussian
-        filename = new_filename_structure.format('picca-gaussian',N_side,pixel)
-        pixel_object.save_as_picca_gaussian(location,filename,header)
+        #Picca Gaussian, density and flux
+        filenames = {}
+        for product in ['gaussian','density','flux']:
+            filenames[product] = new_filename_structure.format('picca-'+product,N_side,pixel)
+        picca_plan = pixel_object.save_as_picca_products(location,filenames,header,mean_F_data=mean_F_data,overwrite=True,plan=picca_plan)
 
-        #Picca density
-        filename = new_filename_structure.format('picca-density',N_side,pixel)
-        pixel_object.save_as_picca_density(location,filename,header)
+    means = pixel_object.get_means()
 
-        #picca flux
-        filename = new_filename_structure.format('picca-flux',N_side,pixel)
-        pixel_object.save_as_picca_flux(location,filename,header,mean_F_data=mean_F_data)
-    else:
-        #If transmission_only is not False, remove the gaussian-colore file.
-        os.remove(location+gaussian_filename)
+    #Record that the stage is complete, and how long it took (to refine the cost estimates used to schedule later runs).
+    checkpoint.mark_stage_complete(location,N_side,pixel,'final',data={'time':time.time()-pixel_start_time})
 
-    means = pixel_object.get_means()
+    #If transmission_only is not False, remove the gaussian-colore file (if one was made).
+    #This is done once the stage is complete, so that the stage can be redone until then.
+    if transmission_only == True and not direct_from_colore:
+        os.remove(location+gaussian_filename)
 
     return [new_cosmology,means]
 
@@ -416,15 +622,8 @@ tasks = [(new_base_file_location,new_file_structure,new_filename_structure,pixel
 
 #Run the multiprocessing pool
 if __name__ == '__main__':
-    pool = Pool(processes = N_processes)
-    results = []
     start_time = time.time()
-
-    for task in tasks:
-        pool.apply_async(produce_final_skewers,task,callback=log_result,error_callback=log_error)
-
-    pool.close()
-    pool.join()
+    run_tasks('final',produce_final_skewers,tasks,pixel_list)
 
 print('\nTime to make physical pixel files: {:4.0f}s.\n'.format(time.time()-start_time))
 
@@ -436,20 +635,29 @@ Having added small scale power, we must add a new HDU to the master file's cosmo
 print('Updating master file\'s cosmology...')
 #First check that the new cosmologies are all the same.
 # TODO: some kind of system to check consistency here?
-new_cosmology = results[0][0]
+#Pixels that were skipped (as they were already complete, or empty) do not return a new cosmology.
+new_cosmologies = [result[0] for result in results if isinstance(result,list)]
 master_filename = master_location + '/master.fits'
 
-#Reorganise the data.
-master = fits.open(master_filename)
-try:
+#Reorganise the data, unless the master file already has the new cosmology.
+h = fits.open(master_filename)
+if len(h) > 3:
+
+    h.close()
+
+elif len(new_cosmologies) == 0:
 
-    test = master[3].data
-    master.close()
+    h.close()
+    if queue_dir is None:
+        print('No pixels were processed, so the cosmology cannot be updated. Rerun with --overwrite to update it.')
+    else:
+        print('No pixels were processed by this worker, so the cosmology is left to the other workers.')
 
-except IndexError:
+else:
 
-    master_catalog = master[1].data
-    master_colore_cosmology = master[2].data
+    new_cosmology = new_cosmologies[0]
+    master_catalog = h[1].data
+    master_colore_cosmology = h[2].data
     master_new_cosmology = new_cosmology
 
     #Make an appropriate header.
@@ -467,11 +675,14 @@ except IndexError:
 
     #Make the .fits file.
     hdulist = fits.HDUList([prihdu,hdu_ID,hdu_cosmology_colore,hdu_cosmology_expanded])
-    hdulist.writeto(master_filename,overwrite=True)
+    checkpoint.write_HDUList(hdulist,master_filename,overwrite=True)
     hdulist.close()
 
 print('Process complete!\n')
 
+#All of the tasks are complete, so the MOCKID lookup's shared memory is no longer needed.
+MOCKID_lookup.unlink()
+
 ################################################################################
 
 """
@@ -3,6 +3,7 @@
 import numpy as np
 from astropy.io import fits
 import process_functions as functions
+import master
 import matplotlib.pyplot as plt
 from multiprocessing import Pool
 import multiprocessing
@@ -274,8 +275,8 @@ def pixelise_gaussian_skewers(pixel,original_file_location,original_filename_str
 
 #Set up the multiprocessing pool parameters and make a list of tasks.
 #N_processes = int(sys.argv[1])
-manager = multiprocessing.Manager()
-shared_MOCKID_lookup = manager.dict(MOCKID_lookup)
+#The MOCKID lookup is held in shared memory, so that workers read it directly rather than through a manager process.
+shared_MOCKID_lookup = master.make_MOCKID_lookup(master_data,pixels=pixel_list,use_shared_memory=True)
 tasks = [(pixel,original_file_location,original_filename_structure,input_format,shared_MOCKID_lookup,z_min,new_base_file_location,new_file_structure,N_side) for pixel in pixel_list]
 
 #Run the multiprocessing pool
@@ -290,6 +291,8 @@ if __name__ == '__main__':
     pool.close()
     pool.join()
 
+    shared_MOCKID_lookup.unlink()
+
 print('\nTime to make Gaussian pixel files: {:4.0f}s.\n'.format(time.time()-start_time))
 
 ################################################################################
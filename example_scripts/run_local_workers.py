@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+################################################################################
+
+#Script to run make_transmission.py with several local workers sharing a work queue, standing in for several nodes under SLURM.
+#Any arguments not listed below are passed on to each worker. e.g.
+#    run_local_workers.py --local-workers 4 --queue-dir out/queue -- --in-dir in --out-dir out --nproc 2
+#The workers share each stage's tasks through the queue directory, so killing some of them only delays the run: their tasks are given to the other workers after --queue-timeout.
+
+################################################################################
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('--local-workers', type = int, default = 2, required=False,
+                    help = 'number of workers to run')
+
+parser.add_argument('--queue-dir', type = str, default = None, required=True,
+                    help = 'shared directory of the work queue (use a new one for each run)')
+
+parser.add_argument('--log-dir', type = str, default = None, required=False,
+                    help = 'directory to write each worker\'s log to (default: the queue directory)')
+
+################################################################################
+
+args, worker_args = parser.parse_known_args()
+if len(worker_args) > 0 and worker_args[0] == '--':
+    worker_args = worker_args[1:]
+
+N_workers = args.local_workers
+queue_dir = args.queue_dir
+log_dir = args.log_dir
+if not log_dir:
+    log_dir = queue_dir
+os.makedirs(log_dir,exist_ok=True)
+
+make_transmission_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),'make_transmission.py')
+command = [sys.executable,make_transmission_filename] + worker_args + ['--queue-dir',queue_dir]
+
+#Start the workers, each with its own log.
+start_time = time.time()
+workers = []
+for i in range(N_workers):
+    log_filename = log_dir + '/worker-{}.log'.format(i)
+    log = open(log_filename,'w')
+    print('starting worker {}, logging to {}'.format(i,log_filename))
+    workers += [(subprocess.Popen(command,stdout=log,stderr=subprocess.STDOUT,stdin=subprocess.DEVNULL),log)]
+
+#Wait for them all to finish.
+return_codes = []
+for i, (worker, log) in enumerate(workers):
+    return_codes += [worker.wait()]
+    log.close()
+    print('worker {} finished with return code {}'.format(i,return_codes[-1]))
+
+print('\nTime to run {} workers: {:4.0f}s.\n'.format(N_workers,time.time()-start_time))
+
+if any([return_code != 0 for return_code in return_codes]):
+    sys.exit(1)
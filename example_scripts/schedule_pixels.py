@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+import numpy as np
+from astropy.io import fits
+import argparse
+
+import schedule
+
+################################################################################
+
+#Script to split the pixels of a master file between nodes, so that the nodes' total costs are as even as possible.
+#Pixel costs are estimated from the master file, and refined using the times recorded by make_transmission.py in any previous runs.
+#One line is written per node, listing its pixels from most to least costly.
+
+################################################################################
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('--out-dir', type = str, default = None, required=True,
+                    help = 'output data directory, containing the pixel directories')
+
+parser.add_argument('--master-dir', type = str, default = None, required=False,
+                    help = 'directory containing the master file')
+
+parser.add_argument('--nside', type = int, default = 16, required=False,
+                    help = 'HEALPix nside for output files (must be 2^n)')
+
+parser.add_argument('--nnodes', type = int, default = 1, required=False,
+                    help = 'number of nodes to split the pixels between')
+
+parser.add_argument('--pixels', type = int, default = None, required=False,
+                    help = 'which pixel numbers to schedule (default: all pixels in the master file)', nargs='*')
+
+parser.add_argument('--lambda-min', type = float, default = 3550., required=False,
+                    help = 'minimum lambda in picca skewers (Å)')
+
+parser.add_argument('--out-file', type = str, default = None, required=False,
+                    help = 'file to write the pixels of each node to (default: print them)')
+
+################################################################################
+
+args = parser.parse_args()
+
+lya = 1215.67
+
+new_base_file_location = args.out_dir
+master_location = args.master_dir
+if not master_location:
+    master_location = new_base_file_location
+N_side = args.nside
+N_nodes = args.nnodes
+z_min = args.lambda_min/lya - 1
+
+#Set file structure
+new_file_structure = '{}/{}/'               #pixel number//100, pixel number
+
+#Load the master data, and get the pixels that have quasars in them.
+h = fits.open(master_location+'/master.fits')
+master_data = h[1].data
+cosmology_data = h[2].data
+pixels = args.pixels
+if not pixels:
+    PIXNUM = master_data['PIXNUM'].astype(int)
+    pixels = list(np.unique(PIXNUM[PIXNUM>=0]))
+
+#Estimate the costs, refine them using previous timings, and split the pixels between the nodes.
+costs = schedule.get_pixel_costs_from_master_data(master_data,cosmology_data,pixels,z_min=z_min)
+h.close()
+timings = schedule.get_pixel_timings(new_base_file_location,new_file_structure,N_side,pixels)
+costs = schedule.refine_pixel_costs(costs,timings)
+node_pixels = schedule.split_pixels_by_cost(pixels,costs,N_nodes)
+
+lines = [' '.join([str(pixel) for pixel in pixels]) for pixels in node_pixels]
+if args.out_file:
+    with open(args.out_file,'w') as f:
+        f.write('\n'.join(lines) + '\n')
+else:
+    print('\n'.join(lines))
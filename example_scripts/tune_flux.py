@@ -23,6 +23,9 @@ z_width = 0.2
 
 cell_size = 0.25 #Mpc/h
 
+#Global seed for the random numbers drawn for each skewer
+global_seed = 0
+
 #Open up the Gaussian colore files
 base_file_location = '/Users/jfarr/Projects/test_data/test/'
 N_side = 16
@@ -69,9 +72,8 @@ def measure_pixel(pixel):
     data.trim_skewers(lambda_min,min_cat_z,extra_cells=1)
 
     #add small scale fluctuations
-    seed = int(str(N_side) + str(pixel))
-    generator = np.random.RandomState(seed)
-    data.add_small_scale_gaussian_fluctuations(cell_size,tuning_z_values,extra_sigma_G_values,generator,amplitude=1.0,white_noise=False,lambda_min=0.0,IVAR_cutoff=lya)
+    generators = general.get_skewer_generators(global_seed,data.MOCKID,'small_scale_fluctuations')
+    data.add_small_scale_gaussian_fluctuations(cell_size,tuning_z_values,extra_sigma_G_values,generators,amplitude=1.0,white_noise=False,lambda_min=0.0,IVAR_cutoff=lya)
 
     #Convert to flux
     data.compute_physical_skewers()
@@ -101,7 +103,7 @@ def measure_pixel(pixel):
         #this is returning complex results atm
         mean_F = np.average(cropped_data.F_rows)
         delta_F_rows = cropped_data.F_rows/mean_F - 1
-        k_kms, Pk_kms, var_kms = Pk1D.get_Pk1D(delta_F_rows,cropped_data.IVAR_rows,cropped_data.R,cropped_data.Z,z_value,z_width=0.2,N_processes=1)
+        k_kms, Pk_kms, var_kms = Pk1D.get_Pk1D(delta_F_rows,cropped_data.IVAR_cells,cropped_data.R,cropped_data.Z,z_value,z_width=0.2,N_processes=1)
 
         Pk1D_results += [(k_kms,Pk_kms,var_kms)]
 
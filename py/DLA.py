@@ -2,18 +2,28 @@ from __future__ import print_function, division
 import numpy as np
 import astropy.io.fits as fits
 from scipy.stats import norm
-from scipy.interpolate import interp1d, interp2d
+from scipy.interpolate import interp1d, RegularGridInterpolator
 import astropy.table
 import os
 
+#Process-wide caches of the bias to threshold interpolator, and of the thresholds for each z grid.
+nu_of_bD_interpolator = {}
+DLA_thresholds = {}
+
+def get_nu_of_bD_interpolator():
+    """ Get the (lazily built) interpolator from bias to Gaussian field threshold"""
+    if 'interpolator' not in nu_of_bD_interpolator:
+        nu = np.linspace(-10,100,500) # Generous range to interpolate
+        p_nu = norm.pdf(nu)
+        galaxy_mean = 1.0-norm.cdf(nu)
+        b_nu = np.zeros(nu.shape)
+        b_nu[galaxy_mean!=0] = p_nu[galaxy_mean!=0]/galaxy_mean[galaxy_mean!=0]
+        nu_of_bD_interpolator['interpolator'] = interp1d(b_nu,nu)
+    return nu_of_bD_interpolator['interpolator']
+
 def nu_of_bD(b):
     """ Compute the Gaussian field threshold for a given bias"""
-    nu = np.linspace(-10,100,500) # Generous range to interpolate
-    p_nu = norm.pdf(nu)
-    galaxy_mean = 1.0-norm.cdf(nu)
-    b_nu = np.zeros(nu.shape)
-    b_nu[galaxy_mean!=0] = p_nu[galaxy_mean!=0]/galaxy_mean[galaxy_mean!=0]
-    y = interp1d(b_nu,nu)
+    y = get_nu_of_bD_interpolator()
     return y(b)
 
 def get_bias_z(fname,dla_bias):
@@ -43,78 +53,168 @@ def flag_DLA(skewer,nu_arr,sigma_g):
 #number per unit redshift from minimum lg(N) in file (17.2) to argument
 # Reading file from https://arxiv.org/pdf/astro-ph/0407378.pdf
 
+#Location of the table, relative to this module. If a pre-parsed .npy version exists, it is used instead.
+zheng_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','example_data','zheng_cumulative.overz')
+zheng_npy_filename = os.path.splitext(zheng_filename)[0] + '.npy'
+
+#Process-wide caches of the parsed table and its interpolator, and of the CDF tables made from them.
+zheng_table = {}
+N_CDF_tables = {}
+
+def read_zheng_table(filename=zheng_filename,npy_filename=zheng_npy_filename):
+    """ Read the (z, lg(N), cumulative dn/dz) columns of the table, from the
+    .npy version if it exists"""
+    if npy_filename is not None and os.path.exists(npy_filename):
+        return np.load(npy_filename)
+    return np.loadtxt(filename)
+
+def write_zheng_table_npy(filename=zheng_filename,npy_filename=zheng_npy_filename):
+    """ Save the table in .npy form for fast loading"""
+    np.save(npy_filename,np.loadtxt(filename))
+    return
+
+def get_zheng_interpolator():
+    """ Get the (lazily built) regular grid interpolator of the table"""
+    if 'interpolator' not in zheng_table:
+        table = read_zheng_table()
+        z_grid = np.unique(table[:,0])
+        logN_grid = np.unique(table[:,1])
+        order = np.lexsort((table[:,1],table[:,0]))
+        values = table[order,2].reshape((len(z_grid),len(logN_grid)))
+        zheng_table['interpolator'] = RegularGridInterpolator((z_grid,logN_grid),values)
+    return zheng_table['interpolator']
+
 def dnHD_dz_cumlgN(z,logN):
-    tab = astropy.table.Table.read(os.path.abspath('example_data/zheng_cumulative.overz'),format='ascii')
-    y = interp2d(tab['col1'],tab['col2'],tab['col3'],fill_value=None)
-    return y(z,logN)
+    """ Evaluate the table on the outer grid of logN and z, with shape
+    (len(logN),len(z)) and any length 1 dimensions removed.
+    Outside the table, the nearest value is used"""
+    y = get_zheng_interpolator()
+    z_grid, logN_grid = y.grid
+    z = np.clip(np.atleast_1d(z),z_grid[0],z_grid[-1])
+    logN = np.clip(np.atleast_1d(logN),logN_grid[0],logN_grid[-1])
+    points = np.stack(np.meshgrid(logN,z,indexing='ij')[::-1],axis=-1)
+    return np.squeeze(y(points))
 
 def dNdz(z, Nmin=19.5, Nmax=22.):
     """ Get the column density as a function of z
     for a given range in N"""
     return dnHD_dz_cumlgN(z,Nmax)-dnHD_dz_cumlgN(z,Nmin)
 
-def get_N(z, Nmin=19.5, Nmax=22.0, nsamp=100):
+def get_N_CDF_table(z_grid, Nmin=19.5, Nmax=22.0, nsamp=100):
+    """ Get the cumulative distribution of lg(N) between Nmin and Nmax
+    at each of a sorted grid of z values, with shape (len(z_grid),nsamp).
+    Results are cached, as all pixels in a run share the same z grid"""
+    z_grid = np.asarray(z_grid,dtype='float64')
+    key = (z_grid.tobytes(),Nmin,Nmax,nsamp)
+    if key not in N_CDF_tables:
+        nn = np.linspace(Nmin,Nmax,nsamp)
+        cumulative = np.reshape(dnHD_dz_cumlgN(z_grid,nn),(nsamp,len(z_grid))).T
+        cumulative = np.maximum.accumulate(cumulative,axis=1)
+        CDF = cumulative - cumulative[:,:1]
+        total = CDF[:,-1:]
+        CDF = np.divide(CDF,total,out=np.tile(np.linspace(0.,1.,nsamp),(len(CDF),1)),where=total>0)
+        nn.flags.writeable = False
+        CDF.flags.writeable = False
+        N_CDF_tables[key] = (nn,CDF)
+    return N_CDF_tables[key]
+
+def sample_N(z, u, z_grid, nn, CDF):
+    """ Get the column density for each of a set of z by inverse-CDF
+    sampling, given uniform random numbers u and a table from get_N_CDF_table.
+    The CDF is interpolated linearly in z and in lg(N)"""
+    z = np.atleast_1d(z)
+    u = np.atleast_1d(u)
+    if len(z_grid) > 1:
+        i = np.clip(np.searchsorted(z_grid,z) - 1,0,len(z_grid)-2)
+        w = np.clip((z - z_grid[i])/(z_grid[i+1] - z_grid[i]),0.,1.)
+        CDF_z = (1. - w)[:,None]*CDF[i] + w[:,None]*CDF[i+1]
+    else:
+        CDF_z = np.tile(CDF[0],(len(z),1))
+    j = np.clip(np.sum(CDF_z < u[:,None],axis=1),1,len(nn)-1)
+    rows = np.arange(len(z))
+    CDF_low = CDF_z[rows,j-1]
+    CDF_high = CDF_z[rows,j]
+    f = np.divide(u - CDF_low,CDF_high - CDF_low,out=np.zeros(len(z)),where=CDF_high>CDF_low)
+    return nn[j-1] + f*(nn[j] - nn[j-1])
+
+def get_N(z, Nmin=19.5, Nmax=22.0, nsamp=100, u=None):
     """ Get the column density for a given z
-    This always returns recurring decimals of a kind, could just expand nsamp to deal with it"""
-    nn = np.linspace(Nmin,Nmax,nsamp)
-    probs = dnHD_dz_cumlgN(z,nn).T
-    N = np.zeros(len(probs))
-    for i in range(0,len(probs)):
-        N[i] = np.random.choice(nn,size=1,p=probs[i]/np.sum(probs[i]))
-    return N
-
-def add_DLA_table_to_object(object,dla_bias=2.0,extrapolate_z_down=None):
-
-    y = interp1d(object.Z,object.D)
-    bias = dla_bias/(object.D)*y(2.25)
+    If u (uniform random numbers, one for each z) is not given, np.random is used"""
+    z = np.atleast_1d(z)
+    if u is None:
+        u = np.random.random(size=len(z))
+    z_grid = np.unique(z)
+    nn, CDF = get_N_CDF_table(z_grid,Nmin=Nmin,Nmax=Nmax,nsamp=nsamp)
+    return sample_N(z,u,z_grid,nn,CDF)
+
+def get_DLA_thresholds(Z,D,dla_bias=2.0,extrapolate_z_down=None):
+    """ Get the z bin edges, the Gaussian field threshold and the mean
+    number of DLAs per flagged cell for a z grid.
+    All pixels in a run share the same grid, so results are cached"""
+    key = (Z.tobytes(),D.tobytes(),dla_bias,extrapolate_z_down)
+    if key not in DLA_thresholds:
+        y = interp1d(Z,D)
+        bias = dla_bias/D*y(2.25)
+        nu_arr = nu_of_bD(bias*D)
+
+        #Edges of the z bins
+        if extrapolate_z_down and extrapolate_z_down<Z[0]:
+            zedges = np.concatenate([[extrapolate_z_down],(Z[1:]+Z[:-1])*0.5,[Z[-1]+(-Z[-2]+Z[-1])*0.5]]).ravel()
+        else:
+            zedges = np.concatenate([[Z[0]],(Z[1:]+Z[:-1])*0.5,[Z[-1]+(-Z[-2]+Z[-1])*0.5]]).ravel()
+        z_width = zedges[1:]-zedges[:-1]
+
+        #Average number of DLAs per pixel
+        N = z_width*dNdz(Z)
+
+        #For a given z, probability of having the density higher than the threshold
+        p_nu_z = 1.0-norm.cdf(nu_arr)
+        mu = N/p_nu_z
+
+        for array in [zedges,z_width,nu_arr,mu]:
+            array.flags.writeable = False
+        DLA_thresholds[key] = (zedges,z_width,nu_arr,mu)
+    return DLA_thresholds[key]
+
+def add_DLA_table_to_object(object,dla_bias=2.0,extrapolate_z_down=None,generators=None):
+    """ Add a table of DLAs to a simulation_data object
+    If given, generators has one random number generator for each skewer, otherwise np.random is used"""
+
+    zedges, z_width, nu_arr, mu = get_DLA_thresholds(object.Z,object.D,dla_bias=dla_bias,extrapolate_z_down=extrapolate_z_down)
 
     #We measure sigma_G already, but it is not fed back into the files at all. This should change.
     sigma_g = object.SIGMA_G
     #sigma_g = DLA.get_sigma_g(o.input_file)
 
-    nu_arr = nu_of_bD(bias*object.D)
     flagged_pixels = flag_DLA(object.GAUSSIAN_DELTA_rows,nu_arr,sigma_g)
 
-    #Edges of the z bins
-    if extrapolate_z_down and extrapolate_z_down<object.Z[0]:
-        zedges = np.concatenate([[extrapolate_z_down],(object.Z[1:]+object.Z[:-1])*0.5,[object.Z[-1]+(-object.Z[-2]+object.Z[-1])*0.5]]).ravel()
-    else:
-        zedges = np.concatenate([[object.Z[0]],(object.Z[1:]+object.Z[:-1])*0.5,[object.Z[-1]+(-object.Z[-2]+object.Z[-1])*0.5]]).ravel()
-    z_width = zedges[1:]-zedges[:-1]
-
-    #Average number of DLAs per pixel
-    N = z_width*dNdz(object.Z)
-
-    #For a given z, probability of having the density higher than the threshold
-    p_nu_z = 1.0-norm.cdf(nu_arr)
-    mu = N/p_nu_z
-
     #Should the "len(skewers)" be the number of skewers or the number of cells in each skewer here?
     #Think it's the number of skewers but will check
-    pois = np.random.poisson(mu,size=(object.N_qso,len(mu)))
+    if generators is not None:
+        pois = np.array([generator.poisson(mu) for generator in generators]).reshape((object.N_qso,len(mu)))
+    else:
+        pois = np.random.poisson(mu,size=(object.N_qso,len(mu)))
     dlas = pois*flagged_pixels
 
-    ndlas = np.sum(dlas)
-    zdla = np.zeros(ndlas)
-    kskw = np.zeros(ndlas)
-    dz_dla = np.zeros(ndlas)
-    idx = 0
-
-    #In each skewer, look at each potential DLA.
-    for nskw,dla in enumerate(dlas):
-
-        #Asess which potential DLA position will be allocated a DLA.
-        ind = np.where(dla>0)[0]
-
-        #For each dla, assign it a redshift, a velocity and a column density.
-        for ii in ind:
-            zdla[idx:idx+dla[ii]] = np.random.uniform(low=(zedges[ii]),high=(zedges[ii+1]),size=dla[ii])
-            kskw[idx:idx+dla[ii]] = nskw
-            dz_dla[idx:idx+dla[ii]] = object.VEL_rows[nskw,ii]
-            idx = idx+dla[ii]
+    #Expand the number of DLAs in each cell into one entry per DLA, ordered by skewer and then by cell.
+    skewers, cells = np.nonzero(dlas)
+    N_dlas_per_cell = dlas[skewers,cells]
+    kskw = np.repeat(skewers,N_dlas_per_cell).astype('int32')
+    kcell = np.repeat(cells,N_dlas_per_cell)
+    ndlas = kskw.shape[0]
+
+    #Draw two uniform random numbers for each DLA: one for its redshift, one for its column density.
+    if generators is not None:
+        N_dlas_per_skewer = np.bincount(kskw,minlength=object.N_qso)
+        u = np.concatenate([np.zeros((0,2))] + [generators[nskw].random(size=(N_dlas_per_skewer[nskw],2)) for nskw in np.where(N_dlas_per_skewer>0)[0]])
+    else:
+        u = np.random.random(size=(ndlas,2))
 
-    Ndla = get_N(zdla)
-    kskw = kskw.astype('int32')
+    #Assign each DLA a redshift uniformly within its cell, a velocity and a column density.
+    zdla = zedges[kcell] + u[:,0]*z_width[kcell]
+    dz_dla = object.VEL_rows[kskw,kcell]
+    nn, CDF = get_N_CDF_table(object.Z)
+    Ndla = sample_N(zdla,u[:,1],object.Z,nn,CDF)
     MOCKIDs = object.MOCKID[kskw]
 
     #Make the data into a table HDU
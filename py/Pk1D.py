@@ -2,7 +2,8 @@ import numpy as np
 
 import general
 
-def get_Pk1D(skewer_rows,IVAR_rows,R_hMpc,z,z_value,z_width=0.2,N_processes=1):
+#Function to measure the 1D power spectrum of a set of skewers, given a compact ivar mask (see general.make_IVAR_cells).
+def get_Pk1D(skewer_rows,IVAR_cells,R_hMpc,z,z_value,z_width=0.2,N_processes=1):
 
     #Find relevant chunk of the skewers
     z_min = z_value - z_width/2.
@@ -13,12 +14,8 @@ def get_Pk1D(skewer_rows,IVAR_rows,R_hMpc,z,z_value,z_width=0.2,N_processes=1):
     N_cells_chunk = j_upper - j_lower
 
     #if skewer contains entire chunk, keep, otherwise discard
-    N_qso = skewer_rows.shape[0]
-    skewer_rows_chunk = []
-    for i in range(N_qso):
-        if np.sum(IVAR_rows[i][j_lower:j_upper]) == N_cells_chunk:
-            skewer_rows_chunk.append(skewer_rows[i][j_lower:j_upper])
-    skewer_rows_chunk = np.array(skewer_rows_chunk)
+    relevant_QSOs = (IVAR_cells[:,0] <= j_lower) * (IVAR_cells[:,1] >= j_upper - 1)
+    skewer_rows_chunk = skewer_rows[relevant_QSOs,j_lower:j_upper]
 
     #trim R to the chunk now being considered
     R_hMpc = R_hMpc[j_lower:j_upper]
@@ -1,6 +1,8 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.interpolate as sciint
+from scipy import sparse
+from scipy.special import erf
 import math
 
 import general
@@ -62,44 +64,56 @@ def get_sigma_kms(T_K):
 
     return sigma_kms
 
-#
-def get_T_K(z,density_rows):
+#Data describing the temperature-density relation, T = T_0*(density**(gamma-1)).
+#Data from McDonald et al. 2001
+#Probably more up to date versions available
+T_14_McD = [20700.,20300.,20100.]
+T_0_McD =  [17400.,18400.,17400.]
+gm1_McD =  [0.52  ,0.29  ,0.43  ]
+z_McD =    [2.4   ,3.0   ,3.9   ]
+
+#Data from Hiss et al. 2017
+T_0_Hiss = [13530.,9580.,14272.,17454.,23130.,20608.,19172.,17348.]
+gm1_Hiss = [0.39  ,0.59 ,0.49  ,0.37  ,0.31  ,0.13  ,0.48  ,0.42  ]
+z_Hiss =   [2.0   ,2.2  ,2.4   ,2.6   ,2.8   ,3.0   ,3.2   ,3.4   ]
+
+#Data from Ricotti et al. 2000
+T_0_Ric =  [4700. ,17700.,25200.,19800.]
+gm1_Ric =  [0.85  ,0.32  ,0.22  ,0.38  ]
+z_Ric =    [0.06  ,1.9   ,2.75  ,3.56  ]
+
+#Mixed data
+T_0_values = [17700.,13530.,9580.,14272.,17454.,23130.,20608.,19172.,17348.,19800.,20100.]
+gm1_values = [0.32  ,0.39  ,0.59 ,0.49  ,0.37  ,0.31  ,0.13  ,0.48  ,0.42  ,0.38  ,0.43  ]
+z_values =   [1.9   ,2.0   ,2.2  ,2.4   ,2.6   ,2.8   ,3.0   ,3.2   ,3.4   ,3.56  ,3.9   ]
 
-    #Data from McDonald et al. 2001
-    #Probably more up to date versions available
-    T_14_McD = [20700.,20300.,20100.]
-    T_0_McD =  [17400.,18400.,17400.]
-    gm1_McD =  [0.52  ,0.29  ,0.43  ]
-    z_McD =    [2.4   ,3.0   ,3.9   ]
+#Tables of T_0 and gamma-1 for each z grid used so far in this process, keyed by the grid itself.
+#All pixels in a run share the same z grid, so these are only computed once.
+T_0_gm1_tables = {}
 
-    #Data from Hiss et al. 2017
-    T_0_Hiss = [13530.,9580.,14272.,17454.,23130.,20608.,19172.,17348.]
-    gm1_Hiss = [0.39  ,0.59 ,0.49  ,0.37  ,0.31  ,0.13  ,0.48  ,0.42  ]
-    z_Hiss =   [2.0   ,2.2  ,2.4   ,2.6   ,2.8   ,3.0   ,3.2   ,3.4   ]
+#Function to return T_0 and gamma-1 at each value of a z grid.
+def get_T_0_gm1(z):
 
-    #Data from Ricotti et al. 2000
-    T_0_Ric =  [4700. ,17700.,25200.,19800.]
-    gm1_Ric =  [0.85  ,0.32  ,0.22  ,0.38  ]
-    z_Ric =    [0.06  ,1.9   ,2.75  ,3.56  ]
+    z = np.asarray(z,dtype='float64')
+    key = z.tobytes()
 
-    #Mixed data
-    T_0_values = [17700.,13530.,9580.,14272.,17454.,23130.,20608.,19172.,17348.,19800.,20100.]
-    gm1_values = [0.32  ,0.39  ,0.59 ,0.49  ,0.37  ,0.31  ,0.13  ,0.48  ,0.42  ,0.38  ,0.43  ]
-    z_values =   [1.9   ,2.0   ,2.2  ,2.4   ,2.6   ,2.8   ,3.0   ,3.2   ,3.4   ,3.56  ,3.9   ]
+    if key not in T_0_gm1_tables:
+        T_0 = np.interp(z,z_values,T_0_values)
+        gm1 = np.interp(z,z_values,gm1_values)
+        T_0_gm1_tables[key] = (T_0,gm1)
 
-    N_cells = density_rows.shape[1]
-    T_K = np.zeros(density_rows.shape)
+    return T_0_gm1_tables[key]
 
-    for j in range(N_cells):
-        T_0_value = np.interp(z[j],z_values,T_0_values)
-        gm1_value = np.interp(z[j],z_values,gm1_values)
+#
+def get_T_K(z,density_rows):
 
-        T_K[:,j] = T_0_value*((density_rows[:,j])**gm1_value)
+    T_0, gm1 = get_T_0_gm1(z)
+    T_K = T_0*(density_rows**gm1)
 
     return T_K
 
 def S(x):
-    S = x*math.erf(x) + 1./(np.sqrt(np.pi))*np.exp(-(x**2))
+    S = x*erf(x) + 1./(np.sqrt(np.pi))*np.exp(-(x**2))
     return S
 
 def J(x,a,sigma):
@@ -109,8 +123,215 @@ def J(x,a,sigma):
     J = (1./(4*a*b))*(S((x+a)*b)-S((x-a)*b))
     return J
 
+#Function to determine where in velocity space each cell moves to once the velocity skewers are applied.
+def get_shifted_x_kms(velocity_skewer_rows_dz,z,r_hMpc):
+
+    #Add the dz from the velocity skewers to get a 'new_z' for each cell
+    new_z_rows = z + velocity_skewer_rows_dz
+
+    #Convert the new z values to radial distances, and then to velocities.
+    new_r_hMpc_rows = np.interp(new_z_rows,z,r_hMpc)
+    new_x_kms_rows = new_r_hMpc_rows * general.get_dkms_dhMpc(new_z_rows)
+
+    return new_x_kms_rows
+
+#Function to determine the neighbouring cells of each shifted cell, and the linear weights allocated to each.
+#Cells that move off either end of the skewer only contribute to the end cell, and only if they are within 1 cell's width of it.
+def get_linear_RSD_weights(new_x_kms_rows,x_kms):
+
+    N_cells = x_kms.shape[0]
+
+    #Work out where in the skewer each cell 'moves' to.
+    j_upper = np.searchsorted(x_kms,new_x_kms_rows)
+    off_low_end = (j_upper == 0)
+    off_high_end = (j_upper >= N_cells)
+
+    #Split the contribution between the new neighbours, distance weighted.
+    j_upper = np.clip(j_upper,1,N_cells-1)
+    j_lower = j_upper - 1
+    x_kms_upper = x_kms[j_upper]
+    x_kms_lower = x_kms[j_lower]
+
+    w_upper = abs(new_x_kms_rows - x_kms_lower)/(x_kms_upper - x_kms_lower)
+    w_lower = abs(new_x_kms_rows - x_kms_upper)/(x_kms_upper - x_kms_lower)
+
+    #If it has moved off the low-z end of the skewer, lower weight is 0
+    #Only include an upper weight if it is within 1 cell's width.
+    distance = abs(x_kms[0] - new_x_kms_rows[off_low_end])
+    width = abs(x_kms[1] - x_kms[0])
+    w_upper[off_low_end] = np.where(distance < width,1. - distance/width,0.)
+    w_lower[off_low_end] = 0.
+    j_upper[off_low_end] = 0
+    j_lower[off_low_end] = 0
+
+    #If it has moved off the high-z end of the skewer, upper weight is 0
+    #Only include a lower weight if it is within 1 cell's width.
+    distance = abs(x_kms[-1] - new_x_kms_rows[off_high_end])
+    width = abs(x_kms[-1] - x_kms[-2])
+    w_lower[off_high_end] = np.where(distance < width,1. - distance/width,0.)
+    w_upper[off_high_end] = 0.
+    j_upper[off_high_end] = N_cells - 1
+    j_lower[off_high_end] = N_cells - 1
+
+    return j_upper, j_lower, w_upper, w_lower
+
+#Function to determine the number of rows to process at once, so as to keep temporary arrays to a manageable size.
+def get_N_rows_block(N_cells,N_elements_block=2**20):
+
+    N_rows_block = max(N_elements_block//max(N_cells,1),1)
+
+    return N_rows_block
+
+#Function to determine the size of each cell in velocity space, and the velocities of the bottom and top edges of each cell.
+def get_cell_edges_kms(x_kms):
+
+    cell_sizes = np.zeros(x_kms.shape)
+    cell_sizes[1:-1] = (x_kms[2:] - x_kms[:-2])/2.
+    cell_sizes[0] = x_kms[1] - x_kms[0]
+    cell_sizes[-1] = x_kms[-1] - x_kms[-2]
+
+    bot_edges = np.zeros(x_kms.shape)
+    bot_edges[1:] = (x_kms[:-1] + x_kms[1:])/2.
+    bot_edges[0] = x_kms[0] - (x_kms[1] - x_kms[0])/2.
+
+    top_edges = np.zeros(x_kms.shape)
+    top_edges[:-1] = (x_kms[:-1] + x_kms[1:])/2.
+    top_edges[-1] = x_kms[-1] + (x_kms[-1] - x_kms[-2])/2.
+
+    return cell_sizes, bot_edges, top_edges
+
+#Function to determine the cells that each shifted cell contributes to when thermal broadening is included, and the weight allocated to each.
+#Contributions go to all cells within cell_size/2 + 5 sigma of where the cell moves to.
+#Returns the (flattened) source and target index of each contribution, along with its weight.
+def get_thermal_RSD_weights(new_x_kms_rows,sigma_kms_rows,x_kms):
+
+    N_cells = x_kms.shape[0]
+    cell_sizes, bot_edges, top_edges = get_cell_edges_kms(x_kms)
+
+    #Define the x_kms range over which we will add contributions.
+    x_kms_rad = cell_sizes/2. + 5.*sigma_kms_rows
+    x_upper_limits = new_x_kms_rows + x_kms_rad
+    x_lower_limits = new_x_kms_rows - x_kms_rad
+
+    #If at least one limit is within the skewer, determine which cells we determine weights for.
+    j_upper_limits = general.NN_sorted(x_kms,x_upper_limits)
+    j_lower_limits = general.NN_sorted(x_kms,x_lower_limits)
+    in_skewer = (x_upper_limits > x_kms[0]) * (x_lower_limits < x_kms[-1])
+    N_contributions = ((j_upper_limits - j_lower_limits + 1)*in_skewer).ravel()
+
+    #Expand the windows into one entry per (source cell, target cell) pair.
+    source_indices = np.repeat(np.arange(N_contributions.shape[0]),N_contributions)
+    window_starts = np.repeat(np.cumsum(N_contributions) - N_contributions,N_contributions)
+    target_cells = np.repeat(j_lower_limits.ravel(),N_contributions) + np.arange(source_indices.shape[0]) - window_starts
+    target_indices = source_indices - (source_indices % N_cells) + target_cells
+
+    #Use the J function to integrate the weight between the bottom and top of each target cell.
+    # TODO: update this to take into account that consecutive cells may not be precisely the same size
+    new_x_kms = new_x_kms_rows.ravel()[source_indices]
+    sigma_kms = sigma_kms_rows.ravel()[source_indices]
+    a = cell_sizes[source_indices % N_cells]/2.
+    weights = J(top_edges[target_cells] - new_x_kms,a,sigma_kms) - J(bot_edges[target_cells] - new_x_kms,a,sigma_kms)
+
+    return source_indices, target_indices, weights
+
+#Function to determine the contributions that each cell in a block of skewers makes to the cells of the RSD skewers.
+#Returns the (flattened) source and target index of each contribution, along with its weight.
+#Without thermal effects, each cell contributes to the cell above and the cell below where it moves to.
+def get_RSD_contributions(initial_density_rows,velocity_skewer_rows_dz,z,r_hMpc,thermal=False):
+
+    N_cells = z.shape[0]
+
+    #Convert radial distance to a velocity.
+    dkms_dhMpc = general.get_dkms_dhMpc(z)
+    x_kms = r_hMpc * dkms_dhMpc
+
+    new_x_kms_rows = get_shifted_x_kms(velocity_skewer_rows_dz,z,r_hMpc)
+
+    if thermal == True:
+        sigma_kms_rows = get_sigma_kms(get_T_K(z,initial_density_rows))
+        source_indices, target_indices, weights = get_thermal_RSD_weights(new_x_kms_rows,sigma_kms_rows,x_kms)
+    else:
+        j_upper, j_lower, w_upper, w_lower = get_linear_RSD_weights(new_x_kms_rows,x_kms)
+        row_offsets = N_cells*np.arange(new_x_kms_rows.shape[0])[:,None]
+        source_indices = np.repeat(np.arange(new_x_kms_rows.size),2)
+        target_indices = np.stack((j_upper + row_offsets,j_lower + row_offsets),axis=-1).ravel()
+        weights = np.stack((w_upper,w_lower),axis=-1).ravel()
+
+    return source_indices, target_indices, weights
+
 #
-def add_skewer_RSDs(initial_tau_rows,initial_density_rows,velocity_skewer_rows_dz,z,r_hMpc,thermal=False):
+def add_skewer_RSDs(initial_tau_rows,initial_density_rows,velocity_skewer_rows_dz,z,r_hMpc,thermal=False,thermal_kernel='batched'):
+
+    #If we want to include thermal effects, we include contributions to all cells within a chosen x_kms range.
+    #The original cell-by-cell calculation is retained as the 'loop' kernel for reference.
+    if thermal == True and thermal_kernel == 'loop':
+        return add_skewer_thermal_RSDs(initial_tau_rows,initial_density_rows,velocity_skewer_rows_dz,z,r_hMpc)
+    elif thermal == True and thermal_kernel != 'batched':
+        raise ValueError('Thermal kernel "{}" not recognised: current options are "batched" and "loop".'.format(thermal_kernel))
+
+    N_qso = initial_tau_rows.shape[0]
+    N_cells = initial_tau_rows.shape[1]
+    final_tau_rows = np.zeros(initial_tau_rows.shape)
+
+    #Work through the skewers in blocks to keep temporary arrays to a manageable size.
+    #The contributions are accumulated in the same order as when working cell by cell.
+    if thermal == True:
+        N_rows_block = get_N_rows_block(N_cells,N_elements_block=2**17)
+    else:
+        N_rows_block = get_N_rows_block(N_cells)
+
+    for i_start in range(0,N_qso,N_rows_block):
+        i_stop = min(i_start + N_rows_block,N_qso)
+        N_rows = i_stop - i_start
+
+        source_indices, target_indices, weights = get_RSD_contributions(initial_density_rows[i_start:i_stop,:],velocity_skewer_rows_dz[i_start:i_stop,:],z,r_hMpc,thermal=thermal)
+        contributions = weights*initial_tau_rows[i_start:i_stop,:].ravel()[source_indices]
+
+        final_tau_rows[i_start:i_stop,:] = np.bincount(target_indices,weights=contributions,minlength=N_rows*N_cells).reshape((N_rows,N_cells))
+
+    return final_tau_rows
+
+#Function to construct the RSD mapping for a set of skewers as a sparse matrix acting on the flattened tau rows.
+#The mapping depends only on the density and velocity skewers, so it may be applied to several sets of tau skewers.
+#It is stored in CSC format, with one column per initial cell.
+def get_RSD_operator(initial_density_rows,velocity_skewer_rows_dz,z,r_hMpc,thermal=False):
+
+    N_qso = initial_density_rows.shape[0]
+    N_cells = initial_density_rows.shape[1]
+
+    if thermal == True:
+        N_rows_block = get_N_rows_block(N_cells,N_elements_block=2**17)
+    else:
+        N_rows_block = get_N_rows_block(N_cells)
+
+    data = []
+    indices = []
+    N_contributions = []
+
+    for i_start in range(0,N_qso,N_rows_block):
+        i_stop = min(i_start + N_rows_block,N_qso)
+        N_rows = i_stop - i_start
+
+        source_indices, target_indices, weights = get_RSD_contributions(initial_density_rows[i_start:i_stop,:],velocity_skewer_rows_dz[i_start:i_stop,:],z,r_hMpc,thermal=thermal)
+
+        data += [weights]
+        indices += [target_indices + i_start*N_cells]
+        N_contributions += [np.bincount(source_indices,minlength=N_rows*N_cells)]
+
+    indptr = np.concatenate([[0],np.cumsum(np.concatenate(N_contributions))])
+    RSD_operator = sparse.csc_matrix((np.concatenate(data),np.concatenate(indices),indptr),shape=(N_qso*N_cells,N_qso*N_cells))
+
+    return RSD_operator
+
+#Function to apply an RSD operator (as made by get_RSD_operator) to a set of tau skewers.
+def apply_RSD_operator(RSD_operator,initial_tau_rows):
+
+    final_tau_rows = RSD_operator.dot(initial_tau_rows.ravel().astype('float64')).reshape(initial_tau_rows.shape)
+
+    return final_tau_rows
+
+#Function to add RSDs including thermal broadening cell by cell, by spreading each cell's tau over the cells within 5 sigma of where it moves to.
+def add_skewer_thermal_RSDs(initial_tau_rows,initial_density_rows,velocity_skewer_rows_dz,z,r_hMpc):
 
     N_qso = initial_tau_rows.shape[0]
     N_cells = initial_tau_rows.shape[1]
@@ -120,12 +341,8 @@ def add_skewer_RSDs(initial_tau_rows,initial_density_rows,velocity_skewer_rows_d
     dkms_dhMpc = general.get_dkms_dhMpc(z)
     x_kms = r_hMpc * dkms_dhMpc
 
-    #Calculate the temperature in every cell if we want to include thermal effects.
-    if thermal == True:
-        T_K_rows = get_T_K(z,initial_density_rows)
-
-    #count = np.zeros(100)
-    #total = 0
+    #Calculate the temperature in every cell.
+    T_K_rows = get_T_K(z,initial_density_rows)
 
     for i in range(N_qso):
         for j in range(N_cells):
@@ -139,97 +356,47 @@ def add_skewer_RSDs(initial_tau_rows,initial_density_rows,velocity_skewer_rows_d
                 cell_size = (x_kms[j+1] - x_kms[j-1])/2.
             elif j == 0:
                 cell_size = (x_kms[j+1] - x_kms[j])
-            elif j == N_cells:
+            elif j == N_cells-1:
                 cell_size = (x_kms[j] - x_kms[j-1])
 
             new_r_hMpc = np.interp(new_z_cell,z,r_hMpc)
             new_x_kms_cell = new_r_hMpc * general.get_dkms_dhMpc(new_z_cell)
-            #new_x_kms_cell = x_kms_cell
 
-            j_upper = np.searchsorted(x_kms,new_x_kms_cell)
-            j_lower = j_upper - 1
+            tau = initial_tau_rows[i,j]
+
+            #Calculate the dispersion as a result of thermal effects.
+            sigma_kms = get_sigma_kms(T_K_rows[i,j])
+
+            #Define the x_kms range over which we will add contributions.
+            x_kms_rad = cell_size/2. + 5.*sigma_kms
+            x_upper_limit = new_x_kms_cell + x_kms_rad
+            x_lower_limit = new_x_kms_cell - x_kms_rad
 
-            #If we want to include thermal effects, we include contributions to all cells within a chosen x_kms range.
-            if thermal == True:
-                tau = initial_tau_rows[i,j]
-
-                #Calculate the dispersion as a result of thermal effects.
-                sigma_kms = get_sigma_kms(T_K_rows[i,j])
-
-                #Define the x_kms range over which we will add contributions.
-                x_kms_rad = cell_size/2. + 5.*sigma_kms
-                x_upper_limit = new_x_kms_cell + x_kms_rad
-                x_lower_limit = new_x_kms_cell - x_kms_rad
-
-                #If at least one limit is within the skewer, determine which cells we determine weights for.
-                if x_upper_limit > x_kms[0] and x_lower_limit < x_kms[-1]:
-                    j_upper_limit = general.NN_sorted(x_kms,x_upper_limit)
-                    j_lower_limit = general.NN_sorted(x_kms,x_lower_limit)
-                    j_values = np.array(list(range(j_lower_limit,j_upper_limit+1)))
-                else:
-                    j_values = np.array([])
-
-                #total += 1
-                #if len(j_values)<100:
-                #    count[len(j_values)] += 1
-
-                cell_weights = np.zeros(len(j_values))
-
-                #For each such cell, find the bottom and top of the cell.
-                for j_value in j_values:
-                    if j_value > 0 and j_value < N_cells-1:
-                        bot = (x_kms[j_value-1] + x_kms[j_value])/2. - new_x_kms_cell
-                        top = (x_kms[j_value] + x_kms[j_value+1])/2. - new_x_kms_cell
-                    elif j_value == 0:
-                        bot = x_kms[j_value] - (x_kms[j_value+1] - x_kms[j_value])/2. - new_x_kms_cell
-                        top = (x_kms[j_value] + x_kms[j_value+1])/2. - new_x_kms_cell
-                    elif j_value == N_cells-1:
-                        bot = (x_kms[j_value-1] + x_kms[j_value])/2. - new_x_kms_cell
-                        top = x_kms[j_value] + (x_kms[j_value] - x_kms[j_value-1])/2. - new_x_kms_cell
-
-                    #Use the J function to integrate the weight in this range.
-                    # TODO: update this to take into account that consecutive cells may not be precisely the same size
-                    #weight = (0.5)*(math.erf((np.sqrt(2))*sigma_kms*top) - math.erf((np.sqrt(2))*sigma_kms*bot))
-                    weight = J(top,cell_size/2.,sigma_kms) - J(bot,cell_size/2.,sigma_kms)
-
-                    #cell_weights[j_value-j_values[0]] += weight
-                    final_tau_rows[i,j_value] += weight*tau
-
-            #If we do not want to include thermal effects, we only allocate to the cell above and the cell below.
+            #If at least one limit is within the skewer, determine which cells we determine weights for.
+            if x_upper_limit > x_kms[0] and x_lower_limit < x_kms[-1]:
+                j_upper_limit = general.NN_sorted(x_kms,x_upper_limit)
+                j_lower_limit = general.NN_sorted(x_kms,x_lower_limit)
+                j_values = np.array(list(range(j_lower_limit,j_upper_limit+1)))
             else:
-                tau = initial_tau_rows[i,j]
-                #If it has moved off the low-z end of the skewer, lower weight is 0
-                #Only include an upper weight if it is within 1 cell's width.
-                if j_lower < 0:
-                    w_lower = 0.
-                    if abs(x_kms[0] - new_x_kms_cell) < abs(x_kms[1] - x_kms[0]):
-                        w_upper = 1. - abs(x_kms[0] - new_x_kms_cell)/abs(x_kms[1] - x_kms[0])
-                        final_tau_rows[i,j_upper] += w_upper*tau
-                    else:
-                        w_upper = 0.
-
-                #If it has moved off the high-z end of the skewer, upper weight is 0
-                #Only include a lower weight if it is within 1 cell's width.
-                elif j_upper >= N_cells:
-                    w_upper = 0.
-                    if abs(x_kms[-1] - new_x_kms_cell) < abs(x_kms[-1] - x_kms[-2]):
-                        w_lower = 1. - abs(x_kms[-1] - new_x_kms_cell)/abs(x_kms[-1] - x_kms[-2])
-                        final_tau_rows[i,j_lower] += w_lower*tau
-                    else:
-                        w_lower = 0.
-
-                #Otherwise, split the contribution between the new neighbours, distance weighted.
-                else:
-                    x_kms_upper = x_kms[j_upper]
-                    x_kms_lower = x_kms[j_lower]
-
-                    w_upper = abs(new_x_kms_cell - x_kms_lower)/(x_kms_upper - x_kms_lower)
-                    w_lower = abs(new_x_kms_cell - x_kms_upper)/(x_kms_upper - x_kms_lower)
-
-                    final_tau_rows[i,j_upper] += w_upper*tau
-                    final_tau_rows[i,j_lower] += w_lower*tau
-
-            #final_tau_rows[i,j_values] += cell_weights*initial_tau_rows[i,j]
+                j_values = np.array([])
+
+            #For each such cell, find the bottom and top of the cell.
+            for j_value in j_values:
+                if j_value > 0 and j_value < N_cells-1:
+                    bot = (x_kms[j_value-1] + x_kms[j_value])/2. - new_x_kms_cell
+                    top = (x_kms[j_value] + x_kms[j_value+1])/2. - new_x_kms_cell
+                elif j_value == 0:
+                    bot = x_kms[j_value] - (x_kms[j_value+1] - x_kms[j_value])/2. - new_x_kms_cell
+                    top = (x_kms[j_value] + x_kms[j_value+1])/2. - new_x_kms_cell
+                elif j_value == N_cells-1:
+                    bot = (x_kms[j_value-1] + x_kms[j_value])/2. - new_x_kms_cell
+                    top = x_kms[j_value] + (x_kms[j_value] - x_kms[j_value-1])/2. - new_x_kms_cell
+
+                #Use the J function to integrate the weight in this range.
+                # TODO: update this to take into account that consecutive cells may not be precisely the same size
+                weight = J(top,cell_size/2.,sigma_kms) - J(bot,cell_size/2.,sigma_kms)
+
+                final_tau_rows[i,j_value] += weight*tau
 
     return final_tau_rows
 
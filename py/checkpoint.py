@@ -0,0 +1,126 @@
+import numpy as np
+import json
+import os
+
+#Structure of the manifest filename in each pixel's directory.
+manifest_filename_structure = 'manifest-{}-{}.json'     #nside, pixel number
+
+#Function to get the name of a temporary file in the same directory as a given file, keeping its extension.
+#Renaming within a directory is atomic, so a file is never seen half-written under its final name.
+def get_temporary_filename(filename):
+
+    directory, basename = os.path.split(filename)
+    temporary_filename = os.path.join(directory,'.tmp-{}-{}'.format(os.getpid(),basename))
+
+    return temporary_filename
+
+#Function to write an HDUList to file atomically, by writing to a temporary file and then renaming it.
+#As with HDUList.writeto, an existing file is only replaced if overwrite is True.
+def write_HDUList(hdulist,filename,overwrite=False):
+
+    if os.path.exists(filename) and not overwrite:
+        raise OSError('File {} already exists. Use overwrite=True to replace it.'.format(filename))
+
+    temporary_filename = get_temporary_filename(filename)
+    try:
+        hdulist.writeto(temporary_filename,overwrite=True)
+        os.replace(temporary_filename,filename)
+    finally:
+        if os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
+
+    return
+
+#Function to read a JSON file, returning an empty dictionary if it does not exist.
+def read_json(filename):
+
+    if os.path.exists(filename):
+        with open(filename) as f:
+            data = json.load(f)
+    else:
+        data = {}
+
+    return data
+
+#Function to write a JSON file atomically.
+def write_json(filename,data):
+
+    temporary_filename = get_temporary_filename(filename)
+    with open(temporary_filename,'w') as f:
+        json.dump(data,f)
+    os.replace(temporary_filename,filename)
+
+    return
+
+#Function to get the filename of a pixel's manifest.
+def get_manifest_filename(location,N_side,pixel):
+
+    filename = location + '/' + manifest_filename_structure.format(N_side,pixel)
+
+    return filename
+
+#Function to read a pixel's manifest, a dictionary with the completed stages as keys.
+#If there is no manifest, no stages have been completed.
+def read_manifest(location,N_side,pixel):
+
+    filename = get_manifest_filename(location,N_side,pixel)
+    manifest = read_json(filename)
+
+    return manifest
+
+#Function to write a pixel's manifest atomically.
+def write_manifest(location,N_side,pixel,manifest):
+
+    filename = get_manifest_filename(location,N_side,pixel)
+    write_json(filename,manifest)
+
+    return
+
+#Function to determine whether a stage has been completed for a pixel.
+def stage_complete(location,N_side,pixel,stage):
+
+    manifest = read_manifest(location,N_side,pixel)
+
+    return stage in manifest
+
+#Function to record that a stage has been completed for a pixel, along with any data needed to resume from it.
+#Arrays in the data are stored as lists.
+def mark_stage_complete(location,N_side,pixel,stage,data=None):
+
+    manifest = read_manifest(location,N_side,pixel)
+
+    stage_data = {}
+    if data is not None:
+        for key, value in data.items():
+            if isinstance(value,np.ndarray):
+                value = value.tolist()
+            stage_data[key] = value
+
+    manifest[stage] = stage_data
+    write_manifest(location,N_side,pixel,manifest)
+
+    return
+
+#Function to get the data stored when a stage was completed for a pixel.
+#Lists are returned as arrays.
+def get_stage_data(location,N_side,pixel,stage):
+
+    manifest = read_manifest(location,N_side,pixel)
+
+    stage_data = {}
+    for key, value in manifest[stage].items():
+        if isinstance(value,list):
+            value = np.array(value)
+        stage_data[key] = value
+
+    return stage_data
+
+#Function to forget that a set of stages were completed for a pixel, so that they will be redone.
+def reset_stages(location,N_side,pixel,stages):
+
+    manifest = read_manifest(location,N_side,pixel)
+    for stage in stages:
+        manifest.pop(stage,None)
+    write_manifest(location,N_side,pixel,manifest)
+
+    return
@@ -4,24 +4,58 @@ from astropy.io import fits
 lya = 1215.67
 
 #Function to convert gaussian field skewers (in rows) to lognormal delta skewers (in rows).
+#SIGMA_G and D may be scalars or arrays with one value per cell.
 def gaussian_to_lognormal_delta(GAUSSIAN_DELTA_rows,SIGMA_G,D):
 
-    LN_DENSITY_rows = np.zeros(GAUSSIAN_DELTA_rows.shape)
-    LN_DENSITY_DELTA_rows = np.zeros(GAUSSIAN_DELTA_rows.shape)
-
-    SIGMA_G = SIGMA_G*np.ones(GAUSSIAN_DELTA_rows.shape[1])
-
-    D = D*np.ones(GAUSSIAN_DELTA_rows.shape[1])
-
-    for j in range(GAUSSIAN_DELTA_rows.shape[1]):
-        LN_DENSITY_rows[:,j] = np.exp(D[j]*GAUSSIAN_DELTA_rows[:,j] - ((D[j])**2)*(SIGMA_G[j]**2)/2.)
-
-    LN_DENSITY_DELTA_rows = LN_DENSITY_rows - 1
-
-    LN_DENSITY_DELTA_rows = LN_DENSITY_DELTA_rows.astype('float32')
+    LN_DENSITY_rows = np.multiply(D,GAUSSIAN_DELTA_rows,dtype='float64')
+    LN_DENSITY_rows -= (D**2)*(SIGMA_G**2)/2.
+    np.exp(LN_DENSITY_rows,out=LN_DENSITY_rows)
+    LN_DENSITY_DELTA_rows = (LN_DENSITY_rows - 1).astype('float32')
 
     return LN_DENSITY_DELTA_rows
 
+#Function to convert gaussian field skewers (in rows) to flux skewers (in rows) in a single pass.
+#The rows are processed in blocks small enough to stay in cache, so only the flux skewers are stored in full.
+#The lognormal delta and tau skewers are also returned in full if requested (otherwise None is returned in their place).
+#SIGMA_G, D and alpha may be scalars or arrays with one value per cell.
+def gaussian_to_flux(GAUSSIAN_DELTA_rows,SIGMA_G,D,alpha,beta,return_density=False,return_tau=False,N_elements_block=2**15):
+
+    N_qso = GAUSSIAN_DELTA_rows.shape[0]
+    N_cells = GAUSSIAN_DELTA_rows.shape[1]
+    N_rows_block = max(N_elements_block//max(N_cells,1),1)
+
+    F_rows = np.zeros((N_qso,N_cells))
+    if return_density:
+        LN_DENSITY_DELTA_rows = np.zeros((N_qso,N_cells),dtype='float32')
+    else:
+        LN_DENSITY_DELTA_rows = None
+    if return_tau:
+        TAU_rows = np.zeros((N_qso,N_cells))
+    else:
+        TAU_rows = None
+
+    #Precompute the lognormal offset for each cell.
+    offset = (D**2)*(SIGMA_G**2)/2.
+
+    for i_start in range(0,N_qso,N_rows_block):
+        i_stop = min(i_start + N_rows_block,N_qso)
+
+        #Gaussian -> lognormal density -> tau -> flux, reusing the same block of memory at each step.
+        block = GAUSSIAN_DELTA_rows[i_start:i_stop,:].astype('float64')
+        block *= D
+        block -= offset
+        np.exp(block,out=block)
+        if return_density:
+            LN_DENSITY_DELTA_rows[i_start:i_stop,:] = block - 1
+        np.power(block,beta,out=block)
+        block *= alpha
+        if return_tau:
+            TAU_rows[i_start:i_stop,:] = block
+        np.negative(block,out=block)
+        np.exp(block,out=F_rows[i_start:i_stop,:])
+
+    return F_rows, LN_DENSITY_DELTA_rows, TAU_rows
+
 #Function to convert from density to tau using alpha*density^beta
 def density_to_tau(density,alpha,beta):
 
@@ -38,32 +72,63 @@ def density_to_flux(density,alpha,beta):
     return F
 
 #Function to convert lognormal delta skewers (in rows) to gaussian field skewers (in rows).
-def lognormal_delta_to_gaussian(LN_DENSITY_DELTA_rows,SIGMA_G,D):
+#SIGMA_G and D may be scalars or arrays with one value per cell.
+#The result may be written into an existing array 'out' (which may be LN_DENSITY_DELTA_rows itself), otherwise a float32 array is returned.
+#If single_precision is True, the calculation is carried out in float32 rather than float64.
+def lognormal_delta_to_gaussian(LN_DENSITY_DELTA_rows,SIGMA_G,D,out=None,single_precision=False):
 
-    LN_DENSITY_rows = 1.0 + LN_DENSITY_DELTA_rows
+    compute_dtype = get_compute_dtype(single_precision)
+    SIGMA_G = np.asarray(SIGMA_G,dtype=compute_dtype)
+    D = np.asarray(D,dtype=compute_dtype)
 
-    GAUSSIAN_DELTA_rows = np.zeros(LN_DENSITY_DELTA_rows.shape)
+    #Work in 'out' directly if it has the right type, otherwise in a temporary array.
+    if out is not None and out.dtype == compute_dtype:
+        GAUSSIAN_DELTA_rows = out
+        np.add(LN_DENSITY_DELTA_rows,1.0,out=GAUSSIAN_DELTA_rows)
+    else:
+        GAUSSIAN_DELTA_rows = np.add(LN_DENSITY_DELTA_rows,1.0,dtype=compute_dtype)
 
-    if np.array(D).shape[0] == 1:
-        D = np.ones(LN_DENSITY_rows.shape[1])*D
+    np.log(GAUSSIAN_DELTA_rows,out=GAUSSIAN_DELTA_rows)
+    GAUSSIAN_DELTA_rows /= D
+    GAUSSIAN_DELTA_rows += D*(SIGMA_G**2)/2
 
-    if np.array(SIGMA_G).shape[0] == 1:
-        SIGMA_G = np.ones(LN_DENSITY_rows.shape[1])*SIGMA_G
+    if out is None:
+        return GAUSSIAN_DELTA_rows.astype('float32',copy=False)
+    elif GAUSSIAN_DELTA_rows is not out:
+        out[...] = GAUSSIAN_DELTA_rows
 
-    for j in range(GAUSSIAN_DELTA_rows.shape[1]):
-        GAUSSIAN_DELTA_rows[:,j] = (np.log(LN_DENSITY_rows[:,j]))/D[j] + (D[j])*(SIGMA_G[j]**2)/2
+    return out
 
-    GAUSSIAN_DELTA_rows = GAUSSIAN_DELTA_rows.astype('float32')
+#Function to convert tau skewers (in rows) to density skewers (in rows).
+#alpha may be a scalar or an array with one value per cell.
+#The result may be written into an existing array 'out' (which may be TAU_rows itself), otherwise a new array is returned.
+#If single_precision is True, the calculation is carried out in float32 rather than float64.
+def tau_to_density(TAU_rows,alpha,beta,out=None,single_precision=False):
 
-    return GAUSSIAN_DELTA_rows
+    compute_dtype = get_compute_dtype(single_precision)
+    alpha = np.asarray(alpha,dtype=compute_dtype)
 
-#Function to convert tau skewers (in rows) to density skewers (in rows).
-def tau_to_density(TAU_rows,alpha,beta):
+    #Work in 'out' directly if it has the right type, otherwise in a temporary array.
+    if out is not None and out.dtype == compute_dtype:
+        DENSITY_rows = out
+        np.divide(TAU_rows,alpha,out=DENSITY_rows)
+    else:
+        DENSITY_rows = np.divide(TAU_rows,alpha,dtype=compute_dtype)
 
-    DENSITY_rows = np.zeros(TAU_rows.shape)
-    N_cells = TAU_rows.shape[1]
+    np.power(DENSITY_rows,1/beta,out=DENSITY_rows)
 
-    for j in range(N_cells):
-        DENSITY_rows[:,j] = (TAU_rows[:,j]/alpha[j])**(1/beta)
+    if out is not None and DENSITY_rows is not out:
+        out[...] = DENSITY_rows
+        return out
 
     return DENSITY_rows
+
+#Function to return the dtype to carry out calculations in.
+def get_compute_dtype(single_precision=False):
+
+    if single_precision:
+        compute_dtype = np.dtype('float32')
+    else:
+        compute_dtype = np.dtype('float64')
+
+    return compute_dtype
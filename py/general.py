@@ -1,5 +1,6 @@
 import numpy as np
 from astropy.io import fits
+from scipy import sparse
 import time
 import os
 import healpy as hp
@@ -75,6 +76,25 @@ def make_MOCKID(file_number,row_numbers):
 
     return MOCKID
 
+#Purposes for which random numbers are drawn for each skewer. Each purpose has its own streams.
+RNG_purposes = {'small_scale_fluctuations':0, 'DLAs':1}
+
+#Function to make a random number generator for a given skewer and purpose from a global seed.
+#A counter-based (Philox) bit generator is keyed on (seed, MOCKID, purpose), so each skewer's random numbers can be regenerated independently of all other skewers.
+def get_skewer_generator(seed,MOCKID,purpose):
+
+    seed_sequence = np.random.SeedSequence([seed,int(MOCKID),RNG_purposes[purpose]])
+    generator = np.random.Generator(np.random.Philox(seed_sequence))
+
+    return generator
+
+#Function to make a list of random number generators, one for each of a set of skewers, for a given purpose.
+def get_skewer_generators(seed,MOCKIDs,purpose):
+
+    generators = [get_skewer_generator(seed,MOCKID,purpose) for MOCKID in MOCKIDs]
+
+    return generators
+
 #Function to determine in which HEALPix pixel each of a set of (RA,DEC) coordinates lies, given N_side.
 def make_pixel_ID(N_side,RA,DEC):
 
@@ -99,20 +119,81 @@ def make_pixel_ID(N_side,RA,DEC):
 def make_IVAR_rows(IVAR_cutoff,Z_QSO,LOGLAM_MAP):
 
     N_cells = LOGLAM_MAP.shape[0]
+    IVAR_cells = make_IVAR_cells(IVAR_cutoff,Z_QSO,LOGLAM_MAP)
+    IVAR_rows = IVAR_cells_to_rows(IVAR_cells,N_cells)
+
+    return IVAR_rows
+
+#Function to make a compact ivar mask: the first and last relevant cells (inclusive) of each skewer.
+#Skewers with no relevant cells have a last relevant cell before their first relevant cell.
+def make_IVAR_cells(IVAR_cutoff,Z_QSO,LOGLAM_MAP):
+
     N_qso = Z_QSO.shape[0]
 
     lya_lambdas = IVAR_cutoff*(1+Z_QSO)
-    IVAR_rows = np.ones((N_qso,N_cells),dtype='float32')
     lambdas = 10**LOGLAM_MAP
 
-    for i in range(N_qso):
-        last_relevant_cell = np.searchsorted(lambdas,lya_lambdas[i]) - 1
+    IVAR_cells = np.zeros((N_qso,2),dtype=int)
+    IVAR_cells[:,1] = np.searchsorted(lambdas,lya_lambdas) - 1
+
+    return IVAR_cells
+
+#Function to convert a compact ivar mask to a boolean mask of shape (N_qso,N_cells).
+def IVAR_cells_to_mask(IVAR_cells,N_cells):
 
-        for j in range(last_relevant_cell+1,N_cells):
-            IVAR_rows[i,j] = 0.
+    cells = np.arange(N_cells)
+    IVAR_mask = (cells >= IVAR_cells[:,0,None]) * (cells <= IVAR_cells[:,1,None])
+
+    return IVAR_mask
+
+#Function to convert a compact ivar mask to the dense form used in picca files.
+def IVAR_cells_to_rows(IVAR_cells,N_cells):
+
+    IVAR_rows = IVAR_cells_to_mask(IVAR_cells,N_cells).astype('float32')
 
     return IVAR_rows
 
+#Function to convert a dense ivar mask (non-zero over one range of cells per skewer) to a compact ivar mask.
+def IVAR_rows_to_cells(IVAR_rows):
+
+    N_qso = IVAR_rows.shape[0]
+    N_cells = IVAR_rows.shape[1]
+    relevant = (IVAR_rows > 0)
+
+    IVAR_cells = np.zeros((N_qso,2),dtype=int)
+    IVAR_cells[:,0] = np.argmax(relevant,axis=1)
+    IVAR_cells[:,1] = N_cells - 1 - np.argmax(relevant[:,::-1],axis=1)
+
+    #Skewers with no relevant cells are given an empty range.
+    empty = ~np.any(relevant,axis=1)
+    IVAR_cells[empty,0] = 0
+    IVAR_cells[empty,1] = -1
+
+    return IVAR_cells
+
+#Function to determine the number of relevant cells in each skewer from a compact ivar mask.
+def get_N_relevant_cells(IVAR_cells):
+
+    N_relevant_cells = np.maximum(IVAR_cells[:,1] - IVAR_cells[:,0] + 1,0)
+
+    return N_relevant_cells
+
+#Function to determine which skewers have a given cell as relevant from a compact ivar mask.
+def IVAR_cells_contain(IVAR_cells,cell):
+
+    contained = (IVAR_cells[:,0] <= cell) * (IVAR_cells[:,1] >= cell)
+
+    return contained
+
+#Function to trim a compact ivar mask to the cells [first_cell,last_cell) of the skewers.
+def trim_IVAR_cells(IVAR_cells,first_cell,last_cell):
+
+    trimmed_IVAR_cells = np.zeros(IVAR_cells.shape,dtype=int)
+    trimmed_IVAR_cells[:,0] = np.maximum(IVAR_cells[:,0] - first_cell,0)
+    trimmed_IVAR_cells[:,1] = np.minimum(IVAR_cells[:,1],last_cell - 1) - first_cell
+
+    return trimmed_IVAR_cells
+
 #Function to determine the first index corresponding to a value in an array greater than a minimum value.
 def get_first_relevant_index(minimum,values):
 
@@ -169,28 +250,103 @@ def normalise_deltas(DELTA_rows,mean_DELTA):
 
     return DELTA_rows_normalised
 
+#Function to make a structured array from a list of columns, one for each field of the dtype, in order.
+def make_structured_array(columns,dtype):
+
+    N_rows = len(columns[0]) if len(columns) > 0 else 0
+    structured_array = np.empty(N_rows,dtype=dtype)
+    for field, column in zip(structured_array.dtype.names,columns):
+        structured_array[field] = column
+
+    return structured_array
+
 #Function to interpolate via the NGP method.
+#x must be sorted in ascending order. Where a new point is equidistant from two points, the lower one is chosen.
 def get_NGPs(x,x_new):
 
-    NGPs = np.zeros(x_new.shape)
+    N = x.shape[0]
+    if N == 1:
+        return np.zeros(x_new.shape,dtype=int)
 
-    for i,x_new_value in enumerate(x_new):
-        distances2 = (x-x_new_value)**2
-        NGPs[i] = np.argmin(distances2)
+    NGPs = np.clip(np.searchsorted(x,x_new),1,N-1)
+
+    #Move to the lower neighbour if it is at least as close.
+    NGPs -= ((x[NGPs-1] - x_new)**2 <= (x[NGPs] - x_new)**2)
 
     return NGPs
 
-#Function to return the index of the point in a sorted array closest to a given value.
+#Function to make a sparse matrix that resamples skewers from a sorted grid x onto a new grid x_new.
+#The method may be 'NGP', 'linear' (cloud-in-cell) or 'cubic' (Catmull-Rom). Beyond the ends of x, the end values are used.
+def make_resampling_matrix(x,x_new,method='NGP'):
+
+    N = x.shape[0]
+    N_new = x_new.shape[0]
+
+    if method == 'NGP':
+        columns = get_NGPs(x,x_new)[:,None]
+        weights = np.ones(columns.shape)
+
+    elif method in ['linear','cubic']:
+        #Find the interval of x that each new point lies in, and the position within it.
+        j = np.clip(np.searchsorted(x,x_new,side='right') - 1,0,N-2)
+        t = np.clip((x_new - x[j])/(x[j+1] - x[j]),0.,1.)[:,None]
+
+        if method == 'linear':
+            columns = j[:,None] + np.arange(2)
+            weights = np.hstack((1-t,t))
+        else:
+            columns = np.clip(j[:,None] + np.arange(-1,3),0,N-1)
+            weights = np.hstack(((-t**3 + 2*t**2 - t)/2,(3*t**3 - 5*t**2 + 2)/2,(-3*t**3 + 4*t**2 + t)/2,(t**3 - t**2)/2))
+
+    else:
+        raise ValueError('Resampling method not recognised: current options are "NGP", "linear" and "cubic".')
+
+    #Weights that refer to the same cell (at the ends of x) are summed.
+    rows = np.repeat(np.arange(N_new),columns.shape[1])
+    resampling_matrix = sparse.csr_matrix((weights.ravel(),(rows,columns.ravel())),shape=(N_new,N))
+
+    return resampling_matrix
+
+#Cache of resamplings, keyed on the old grid, the new cell size and the method.
+resamplings = {}
+
+#Function to get a grid with a given cell size spanning an old grid, and the resampling of skewers onto it.
+#For NGP, this is the NGP in the old grid of each new cell, so that skewers are resampled by indexing. Otherwise, it is a resampling matrix.
+#All pixels in a run share the same grids, so the results are cached.
+def get_resampling(old_R,cell_size,method='NGP'):
+
+    key = (old_R.tobytes(),cell_size,method)
+    if key not in resamplings:
+        new_R = np.arange(np.min(old_R),np.max(old_R),cell_size)
+        if method == 'NGP':
+            resampling = get_NGPs(old_R,new_R)
+            resampling.flags.writeable = False
+        else:
+            resampling = make_resampling_matrix(old_R,new_R,method=method)
+        new_R.flags.writeable = False
+        resamplings[key] = (new_R,resampling)
+
+    return resamplings[key]
+
+#Function to resample a set of skewers (in rows) using a resampling from 'get_resampling'.
+#NGPs are applied by gathering cells (np.take is much faster than fancy indexing here), and resampling matrices in a single product.
+def resample_skewers(skewer_rows,resampling):
+
+    if isinstance(resampling,np.ndarray):
+        resampled_skewer_rows = np.take(skewer_rows,resampling,axis=1)
+    else:
+        resampled_skewer_rows = np.ascontiguousarray((resampling @ skewer_rows.T).T)
+
+    return resampled_skewer_rows
+
+#Function to return the index of the point in a sorted array closest to a given value (or array of values).
 def NN_sorted(arr,val):
 
     N = arr.shape[0]
-    i = np.searchsorted(arr,val)
+    i = np.clip(np.searchsorted(arr,val),1,N-1)
 
-    if i > 0 and i < N:
-        if abs(arr[i] - val) > abs(arr[i-1] - val):
-            i -= 1
-    elif i == N:
-        i -= 1
+    #Move to the lower neighbour if it is strictly closer.
+    i = i - (abs(arr[i] - val) > abs(arr[i-1] - val))
 
     return i
 
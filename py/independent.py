@@ -26,11 +26,8 @@ def get_gaussian_fields(generator,N_cells,z=0.0,dv_kms=10.0,N_skewers=1,white_no
     # number of Fourier modes
     NF = int(N_cells/2+1)
 
-    # get frequencies (wavenumbers in units of s/km)
-    k_kms = np.fft.rfftfreq(N_cells)*2*np.pi/dv_kms
-
     # get power evaluated at each k_kms
-    P_kms = power_kms(z,k_kms,dv_kms,white_noise=white_noise)
+    P_kms = get_power_spectrum(N_cells,dv_kms,white_noise,z=z)[1]
 
     # generate random Fourier modes
     modes = np.empty([N_skewers,NF], dtype=complex)
@@ -47,6 +44,74 @@ def get_gaussian_fields(generator,N_cells,z=0.0,dv_kms=10.0,N_skewers=1,white_no
 
     return delta
 
+#Function to generate random Gaussian fields at a given redshift in blocks of skewers, so that memory use is bounded.
+#Yields (start, stop, delta_rows) for each block of at most N_skewers_block skewers.
+#generator may be a single random number generator, or a list with one generator for each skewer (see general.get_skewer_generators).
+#The random numbers are drawn skewer by skewer, so each skewer's field does not depend on the block size.
+#The mode and output arrays are reused between blocks, so delta_rows must be copied if it is to be kept.
+def generate_gaussian_field_blocks(generator,N_cells,z=0.0,dv_kms=10.0,N_skewers=1,white_noise=True,N_skewers_block=1024):
+
+    # number of Fourier modes
+    NF = int(N_cells/2+1)
+
+    # get the amplitude of each mode (real for i=0, i=NF-1)
+    k_kms, P_kms, amplitudes, mean_P = get_power_spectrum(N_cells,dv_kms,white_noise,z=z)
+    normalisation = np.sqrt(N_cells/dv_kms)
+
+    # preallocate the buffers for each block
+    N_skewers_block = max(min(N_skewers_block,N_skewers),1)
+    modes = np.empty([N_skewers_block,NF], dtype=complex)
+    delta_rows = np.empty([N_skewers_block,N_cells])
+
+    for start in range(0,N_skewers,N_skewers_block):
+        stop = min(start+N_skewers_block,N_skewers)
+        N_block = stop - start
+
+        # generate random Fourier modes, drawing the real then imaginary parts for each skewer in turn
+        if isinstance(generator,list):
+            random_numbers = np.array([skewer_generator.normal(size=[2,NF]) for skewer_generator in generator[start:stop]])
+        else:
+            random_numbers = generator.normal(size=[N_block,2,NF])
+        modes[:N_block].real = random_numbers[:,0,:]
+        modes[:N_block].imag = random_numbers[:,1,:]
+        modes[:N_block,0].imag = 0.
+        modes[:N_block,-1].imag = 0.
+
+        # normalize to desired power
+        modes[:N_block] *= amplitudes
+
+        # inverse FFT to get (normalized) delta field
+        delta_rows[:N_block] = np.fft.irfft(modes[:N_block],n=N_cells)
+        delta_rows[:N_block] *= normalisation
+
+        yield start, stop, delta_rows[:N_block]
+
+#Cache of power spectra, keyed on the number of cells, the cell size, whether the noise is white, and z.
+power_spectra = {}
+
+#Function to get the frequencies, power and mode amplitudes for Gaussian fields on a grid, and the mean power.
+#All pixels in a run share the same grid, so the results are cached and returned read-only.
+def get_power_spectrum(N_cells,dv_kms,white_noise,z=0.0):
+
+    key = (N_cells,dv_kms,white_noise,z)
+    if key not in power_spectra:
+
+        # get frequencies (wavenumbers in units of s/km)
+        k_kms = np.fft.rfftfreq(N_cells)*2*np.pi/dv_kms
+
+        # get power evaluated at each k_kms, and the amplitude of each mode (real for i=0, i=NF-1)
+        P_kms = power_kms(z,k_kms,dv_kms,white_noise=white_noise)
+        amplitudes = np.sqrt(0.5*P_kms)
+        amplitudes[0] = np.sqrt(P_kms[0])
+        amplitudes[-1] = np.sqrt(P_kms[-1])
+        mean_P = np.average(P_kms)
+
+        for array in [k_kms,P_kms,amplitudes]:
+            array.flags.writeable = False
+        power_spectra[key] = (k_kms,P_kms,amplitudes,mean_P)
+
+    return power_spectra[key]
+
 #Function to return a gaussian P1D in k.
 #From lya_mock_functions
 def power_amplitude(z):
@@ -1,4 +1,5 @@
 import numpy as np
+from astropy.io import fits
 
 import general
 
@@ -133,3 +134,28 @@ def get_lya_lambdas(h,input_format):
         print('Error.')
 
     return lya_lambdas
+
+#Function to extract a selection of rows, and the cells from first_cell onwards, from an image HDU of a hdulist.
+#Where possible, the image is memory-mapped so that only the selected rows are read from disk.
+def get_image_rows(h,hdu_number,rows,first_cell=0):
+
+    header = h[hdu_number].header
+    filename = h.filename()
+
+    #Scaled or non-2D images, hdulists not opened from a file, and compressed files or images are read in the usual way.
+    #The data of a compressed file or image are not stored as they are laid out in memory, so cannot be memory-mapped.
+    image_dtypes = {8:'u1', 16:'>i2', 32:'>i4', 64:'>i8', -32:'>f4', -64:'>f8'}
+    compressed = (getattr(h._file,'compression',None) is not None) or isinstance(h[hdu_number],fits.CompImageHDU)
+    if (filename is None) or compressed or ('BSCALE' in header) or ('BZERO' in header) or (header['NAXIS'] != 2):
+        image_rows = h[hdu_number].data[rows,first_cell:]
+
+    else:
+        dtype = np.dtype(image_dtypes[header['BITPIX']])
+        shape = (header['NAXIS2'],header['NAXIS1'])
+        offset = h.fileinfo(hdu_number)['datLoc']
+
+        image = np.memmap(filename,dtype=dtype,mode='r',offset=offset,shape=shape)
+        image_rows = image[rows,first_cell:].astype(dtype.newbyteorder('='))
+        del image
+
+    return image_rows
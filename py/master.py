@@ -3,6 +3,7 @@ from astropy.io import fits
 
 import general
 import input
+import shared
 
 lya = 1215.67
 
@@ -45,13 +46,10 @@ def get_ID_data(original_file_location,original_filename_structure,file_number,i
     ID_sort = np.sort(ID, order=['PIXNUM','MOCKID'])
 
     #Make file-pixel map element and MOCKID lookup.
-    pixel_ID_set = list(sorted(set([pixel for pixel in ID_sort['PIXNUM'] if pixel>=0])))
+    good_coordinates = ID_sort['PIXNUM']>=0
     file_pixel_map_element = np.zeros(N_pixels)
-    MOCKID_lookup_element = {}
-    for pixel in pixel_ID_set:
-        file_pixel_map_element[pixel] = 1
-        MOCKID_pixel_list = [ID_sort['MOCKID'][i] for i in range(len(ID_sort['PIXNUM'])) if ID_sort['PIXNUM'][i]==pixel]
-        MOCKID_lookup_element = {**MOCKID_lookup_element,**{(file_number,pixel):MOCKID_pixel_list}}
+    file_pixel_map_element[ID_sort['PIXNUM'][good_coordinates]] = 1
+    MOCKID_lookup_element = make_MOCKID_lookup(ID_sort[good_coordinates])
 
     #Construct the cosmology array.
     cosmology_data = list(zip(h_R,h_Z,h_D,h_V))
@@ -78,7 +76,7 @@ def join_ID_data(results,N_side):
         # TODO: Something to check that all cosmology results are the same
         cosmology_results = [result[2]]
         file_pixel_map_results += [result[3]]
-        MOCKID_lookup = {**MOCKID_lookup,**result[4]}
+        MOCKID_lookup.update(result[4])
 
     file_pixel_map = np.zeros((max(file_numbers)+1,12*(N_side**2)))
     for i, file_number in enumerate(file_numbers):
@@ -91,6 +89,97 @@ def join_ID_data(results,N_side):
 
     return master_data, bad_coordinates_data, cosmology_data, file_pixel_map, MOCKID_lookup
 
+#Function to make an index of the MOCKIDs in each (file number, pixel number) pair from master data.
+#The MOCKIDs are sorted by file number and then pixel number (keeping their order within each pair), so that those of each pair form a contiguous slice.
+#The index has one row per pair, giving the start and size of its slice.
+def make_MOCKID_lookup_index(master_data):
+
+    FILENUM = master_data['FILENUM'].astype(int)
+    PIXNUM = master_data['PIXNUM'].astype(int)
+
+    #Combine the file and pixel numbers into a single key, and sort by it.
+    N_keys_per_file = np.max(PIXNUM,initial=0) + 1
+    keys = FILENUM*N_keys_per_file + PIXNUM
+    order = np.argsort(keys,kind='stable')
+    sorted_MOCKID = master_data['MOCKID'][order].astype(int)
+
+    unique_keys, starts, counts = np.unique(keys[order],return_index=True,return_counts=True)
+
+    dtype = [('FILENUM', int), ('PIXNUM', int), ('START', int), ('COUNT', int)]
+    lookup_index = np.array(list(zip(unique_keys//N_keys_per_file,unique_keys%N_keys_per_file,starts,counts)),dtype=dtype)
+
+    return lookup_index, sorted_MOCKID
+
+#Function to convert a MOCKID lookup index into a dictionary with (file number, pixel number) keys, and arrays of MOCKIDs as values.
+#If a list of pixels is given, only keys with those pixels are included.
+def MOCKID_lookup_index_to_dict(lookup_index,sorted_MOCKID,pixels=None):
+
+    if pixels is not None:
+        lookup_index = lookup_index[np.isin(lookup_index['PIXNUM'],pixels)]
+
+    MOCKID_lookup = {}
+    for FILENUM, PIXNUM, START, COUNT in lookup_index:
+        MOCKID_lookup[(int(FILENUM),int(PIXNUM))] = sorted_MOCKID[START:START+COUNT]
+
+    return MOCKID_lookup
+
+#Function to convert a MOCKID lookup index into a dictionary-like lookup held in shared memory (see shared.py).
+#This can be passed to multiprocessing workers without being copied. If a list of pixels is given, only keys with those pixels are included.
+def MOCKID_lookup_index_to_shared(lookup_index,sorted_MOCKID,pixels=None):
+
+    if pixels is not None:
+        lookup_index = lookup_index[np.isin(lookup_index['PIXNUM'],pixels)]
+
+    MOCKID_lookup = shared.shared_MOCKID_lookup(lookup_index,sorted_MOCKID)
+
+    return MOCKID_lookup
+
+#Function to make a MOCKID lookup dictionary directly from master data, or a lookup held in shared memory if use_shared_memory is True.
+def make_MOCKID_lookup(master_data,pixels=None,use_shared_memory=False):
+
+    lookup_index, sorted_MOCKID = make_MOCKID_lookup_index(master_data)
+    if use_shared_memory:
+        MOCKID_lookup = MOCKID_lookup_index_to_shared(lookup_index,sorted_MOCKID,pixels=pixels)
+    else:
+        MOCKID_lookup = MOCKID_lookup_index_to_dict(lookup_index,sorted_MOCKID,pixels=pixels)
+
+    return MOCKID_lookup
+
+#Function to write a MOCKID lookup index to file.
+def write_MOCKID_lookup(filename,lookup_index,sorted_MOCKID,N_side,overwrite=False):
+
+    #Make an appropriate header.
+    header = fits.Header()
+    header['NSIDE'] = N_side
+
+    #Make the data into HDUs.
+    prihdr = fits.Header()
+    prihdu = fits.PrimaryHDU(header=prihdr)
+    hdu_index = fits.BinTableHDU.from_columns(lookup_index,header=header,name='INDEX')
+    hdu_MOCKID = fits.ImageHDU(data=sorted_MOCKID,header=header,name='MOCKID')
+
+    #Make the .fits file.
+    hdulist = fits.HDUList([prihdu,hdu_index,hdu_MOCKID])
+    hdulist.writeto(filename,overwrite=overwrite)
+    hdulist.close()
+
+    return
+
+#Function to read a MOCKID lookup dictionary from a file made by 'write_MOCKID_lookup', or a lookup held in shared memory if use_shared_memory is True.
+def read_MOCKID_lookup(filename,pixels=None,use_shared_memory=False):
+
+    h = fits.open(filename)
+    lookup_index = np.array(h['INDEX'].data)
+    sorted_MOCKID = np.array(h['MOCKID'].data).astype(int)
+    h.close()
+
+    if use_shared_memory:
+        MOCKID_lookup = MOCKID_lookup_index_to_shared(lookup_index,sorted_MOCKID,pixels=pixels)
+    else:
+        MOCKID_lookup = MOCKID_lookup_index_to_dict(lookup_index,sorted_MOCKID,pixels=pixels)
+
+    return MOCKID_lookup
+
 #Function to write a single ID file, given the data.
 def write_ID(filename,ID_data,cosmology_data,N_side):
 
@@ -3,6 +3,7 @@ from astropy.io import fits
 import time
 
 import general
+import checkpoint
 import input
 import convert
 import RSD
@@ -43,10 +44,51 @@ def make_gaussian_pixel_object(pixel,original_file_location,original_filename_st
 
     return pixel_object
 
+#Function to read a CoLoRe file once and split its skewers into 'simulation_data' objects, one for each pixel that has quasars in the file.
+#The objects are returned in a dictionary with pixel numbers as keys.
+def make_gaussian_file_pixel_objects(file_number,original_file_location,original_filename_structure,input_format,MOCKID_lookup,lambda_min=0,IVAR_cutoff=lya):
+
+    #Determine which pixels we need to look at for the current file, and which quasars are relevant to them.
+    relevant_keys = [key for key in MOCKID_lookup.keys() if key[0]==file_number and len(MOCKID_lookup[key])>0]
+    pixel_objects = {}
+
+    if len(relevant_keys) > 0:
+        file_MOCKIDs = np.concatenate([MOCKID_lookup[key] for key in relevant_keys])
+
+        #Extract the data for all relevant quasars in a single pass over the file.
+        filename = original_file_location + '/' + original_filename_structure.format(file_number)
+        file_object = simulation_data.get_gaussian_skewers_object(filename,file_number,input_format,MOCKIDs=file_MOCKIDs,lambda_min=lambda_min,IVAR_cutoff=IVAR_cutoff)
+
+        #Split the quasars into their pixels.
+        for key in relevant_keys:
+            pixel_objects[key[1]] = simulation_data.choose_qsos(file_object,MOCKID_lookup[key])
+
+    return pixel_objects
+
+#Function to create a 'simulation_data' object for a pixel from a list of gaussian colore files, such as those made from the output of 'make_gaussian_file_pixel_objects'.
+def make_gaussian_pixel_object_from_files(filenames,IVAR_cutoff=lya):
+
+    files_included = 0
+
+    for filename in filenames:
+        working = simulation_data.get_gaussian_skewers_object(filename,None,'gaussian_colore',IVAR_cutoff=IVAR_cutoff)
+
+        #Combine the data from the working file with that from the files already looked at.
+        if files_included > 0:
+            combined = simulation_data.combine_files(combined,working,gaussian_only=True)
+            files_included += 1
+        else:
+            combined = working
+            files_included += 1
+
+    pixel_object = combined
+
+    return pixel_object
+
 #Definition of a generic 'simulation_data' class, from which it is easy to save in new formats.
 class simulation_data:
     #Initialisation function.
-    def __init__(self,N_qso,N_cells,SIGMA_G,ALPHA,TYPE,RA,DEC,Z_QSO,DZ_RSD,MOCKID,PLATE,MJD,FIBER,GAUSSIAN_DELTA_rows,DENSITY_DELTA_rows,VEL_rows,IVAR_rows,F_rows,R,Z,D,V,LOGLAM_MAP,A):
+    def __init__(self,N_qso,N_cells,SIGMA_G,ALPHA,TYPE,RA,DEC,Z_QSO,DZ_RSD,MOCKID,PLATE,MJD,FIBER,GAUSSIAN_DELTA_rows,DENSITY_DELTA_rows,VEL_rows,IVAR_cells,F_rows,R,Z,D,V,LOGLAM_MAP,A):
 
         self.N_qso = N_qso
         self.N_cells = N_cells
@@ -66,7 +108,7 @@ class simulation_data:
         self.GAUSSIAN_DELTA_rows = GAUSSIAN_DELTA_rows
         self.DENSITY_DELTA_rows = DENSITY_DELTA_rows
         self.VEL_rows = VEL_rows
-        self.IVAR_rows = IVAR_rows
+        self.IVAR_cells = IVAR_cells
         self.F_rows = F_rows
 
         self.R = R
@@ -102,16 +144,11 @@ class simulation_data:
 
         times += [time.time()-start-np.sum(times[:-1])]
 
-        if MOCKIDs != None:
+        if MOCKIDs is not None:
             #Work out which rows in the hdulist we are interested in.
-            rows = []
-            s = set(MOCKIDs)
-
-            for i, qso in enumerate(h_MOCKID):
-                if qso in s:
-                    rows += [i]
+            rows = np.where(np.isin(h_MOCKID,MOCKIDs))[0]
         else:
-            rows = list(range(h_MOCKID.shape[0]))
+            rows = np.arange(h_MOCKID.shape[0])
 
         #Calculate the first_relevant_cell.
         first_relevant_cell = np.searchsorted(h_lya_lambdas,lambda_min)
@@ -128,9 +165,9 @@ class simulation_data:
             Z_QSO = h[1].data['Z_COSMO'][rows]
             DZ_RSD = h[1].data['DZ_RSD'][rows]
 
-            DENSITY_DELTA_rows = h[2].data[rows,first_relevant_cell:]
+            DENSITY_DELTA_rows = input.get_image_rows(h,2,rows,first_relevant_cell)
 
-            VEL_rows = h[3].data[rows,first_relevant_cell:]
+            VEL_rows = input.get_image_rows(h,3,rows,first_relevant_cell)
 
             Z = h[4].data['Z'][first_relevant_cell:]
             R = h[4].data['R'][first_relevant_cell:]
@@ -144,7 +181,7 @@ class simulation_data:
                 SIGMA_G = h[4].header['SIGMA_G']
 
             #Derive the MOCKID and LOGLAM_MAP.
-            MOCKID = input.get_MOCKID(h,input_format,file_number)
+            MOCKID = h_MOCKID[rows]
             LOGLAM_MAP = np.log10(lya*(1+Z))
 
             #Calculate the Gaussian skewers.
@@ -161,7 +198,7 @@ class simulation_data:
             MJD = np.zeros(N_qso)
             FIBER = np.zeros(N_qso)
 
-            IVAR_rows = general.make_IVAR_rows(IVAR_cutoff,Z_QSO,LOGLAM_MAP)
+            IVAR_cells = general.make_IVAR_cells(IVAR_cutoff,Z_QSO,LOGLAM_MAP)
 
         elif input_format == 'gaussian_colore':
 
@@ -172,9 +209,9 @@ class simulation_data:
             Z_QSO = h[1].data['Z_COSMO'][rows]
             DZ_RSD = h[1].data['DZ_RSD'][rows]
 
-            GAUSSIAN_DELTA_rows = h[2].data[rows,first_relevant_cell:]
+            GAUSSIAN_DELTA_rows = input.get_image_rows(h,2,rows,first_relevant_cell)
 
-            VEL_rows = h[3].data[rows,first_relevant_cell:]
+            VEL_rows = input.get_image_rows(h,3,rows,first_relevant_cell)
 
             Z = h[4].data['Z'][first_relevant_cell:]
             R = h[4].data['R'][first_relevant_cell:]
@@ -188,10 +225,7 @@ class simulation_data:
                 SIGMA_G = h[4].header['SIGMA_G']
 
             #Derive the MOCKID and LOGLAM_MAP.
-            if MOCKIDs != None:
-                MOCKID = MOCKIDs
-            else:
-                MOCKID = input.get_MOCKID(h,input_format,file_number)
+            MOCKID = h_MOCKID[rows]
             LOGLAM_MAP = np.log10(lya*(1+Z))
 
             #Set the remaining variables to None
@@ -205,14 +239,14 @@ class simulation_data:
             MJD = np.zeros(N_qso)
             FIBER = np.zeros(N_qso)
 
-            IVAR_rows = general.make_IVAR_rows(IVAR_cutoff,Z_QSO,LOGLAM_MAP)
+            IVAR_cells = general.make_IVAR_cells(IVAR_cutoff,Z_QSO,LOGLAM_MAP)
 
         elif input_format == 'picca_density':
 
             #Extract data from the HDUlist.
             DENSITY_DELTA_rows = h[0].data.T[rows,first_relevant_cell:]
 
-            IVAR_rows = h[1].data.T[rows,first_relevant_cell:]
+            IVAR_cells = general.IVAR_rows_to_cells(h[1].data.T[rows,first_relevant_cell:])
 
             LOGLAM_MAP = h[2].data[first_relevant_cell:]
 
@@ -264,7 +298,7 @@ class simulation_data:
 
         #print('{:3.0%} {:3.0%} {:3.0%} {:3.0%}'.format(times[0]/np.sum(times),times[1]/np.sum(times),times[2]/np.sum(times),times[3]/np.sum(times)))
 
-        return cls(N_qso,N_cells,SIGMA_G,ALPHA,TYPE,RA,DEC,Z_QSO,DZ_RSD,MOCKID,PLATE,MJD,FIBER,GAUSSIAN_DELTA_rows,DENSITY_DELTA_rows,VEL_rows,IVAR_rows,F_rows,R,Z,D,V,LOGLAM_MAP,A)
+        return cls(N_qso,N_cells,SIGMA_G,ALPHA,TYPE,RA,DEC,Z_QSO,DZ_RSD,MOCKID,PLATE,MJD,FIBER,GAUSSIAN_DELTA_rows,DENSITY_DELTA_rows,VEL_rows,IVAR_cells,F_rows,R,Z,D,V,LOGLAM_MAP,A)
 
     #Function to trim skewers according to a minimum value of lambda. QSOs with no relevant cells are removed.
     def trim_skewers(self,lambda_min,min_catalog_z,extra_cells=0,lambda_max=None,whole_lambda_range=False):
@@ -279,6 +313,9 @@ class simulation_data:
         #If we want to keep any extra_cells, we subtract from the first_relevant_cell.
         first_relevant_cell -= extra_cells
 
+        #Determine the range of cells that will be kept, as positive indices.
+        first_kept_cell, last_kept_cell, _ = slice(first_relevant_cell,last_relevant_cell).indices(self.N_cells)
+
         #Determine which QSOs have any relevant cells to keep.
         """
         relevant_QSOs = []
@@ -291,10 +328,10 @@ class simulation_data:
 
         #If we want the entirety of the lambda range to be relevant (i.e. with IVAR=1), we must remove skewers that do not have this
         if whole_lambda_range:
-            relevant_QSOs *= (self.IVAR_rows[:,first_relevant_cell] == 1) * (self.IVAR_rows[:,last_relevant_cell] == 1)
+            relevant_QSOs *= general.IVAR_cells_contain(self.IVAR_cells,first_relevant_cell % self.N_cells) * general.IVAR_cells_contain(self.IVAR_cells,last_relevant_cell % self.N_cells)
 
         #Remove QSOs no longer needed.
-        self.N_qso = len(relevant_QSOs)
+        self.N_qso = np.sum(relevant_QSOs)
 
         self.TYPE = self.TYPE[relevant_QSOs]
         self.RA = self.RA[relevant_QSOs]
@@ -310,20 +347,20 @@ class simulation_data:
         if self.density_computed == True:
             self.DENSITY_DELTA_rows = self.DENSITY_DELTA_rows[relevant_QSOs,:]
         self.VEL_rows = self.VEL_rows[relevant_QSOs,:]
-        self.IVAR_rows = self.IVAR_rows[relevant_QSOs,:]
+        self.IVAR_cells = self.IVAR_cells[relevant_QSOs,:]
         if self.tau_computed == True:
             self.TAU_rows = self.TAU_rows[relevant_QSOs,:]
         if self.flux_computed == True:
             self.F_rows = self.F_rows[relevant_QSOs,:]
 
         #Now trim the skewers of the remaining QSOs.
-        self.N_cells -= first_relevant_cell
+        self.N_cells = last_kept_cell - first_kept_cell
 
         self.GAUSSIAN_DELTA_rows = self.GAUSSIAN_DELTA_rows[:,first_relevant_cell:last_relevant_cell]
         if self.density_computed == True:
             self.DENSITY_DELTA_rows = self.DENSITY_DELTA_rows[:,first_relevant_cell:last_relevant_cell]
         self.VEL_rows = self.VEL_rows[:,first_relevant_cell:last_relevant_cell]
-        self.IVAR_rows = self.IVAR_rows[:,first_relevant_cell:last_relevant_cell]
+        self.IVAR_cells = general.trim_IVAR_cells(self.IVAR_cells,first_kept_cell,last_kept_cell)
         if self.tau_computed == True:
             self.TAU_rows = self.TAU_rows[:,first_relevant_cell:last_relevant_cell]
         if self.flux_computed == True:
@@ -338,22 +375,17 @@ class simulation_data:
         return
 
     #Function to add small scale gaussian fluctuations.
-    def add_small_scale_gaussian_fluctuations(self,cell_size,sigma_G_z_values,extra_sigma_G_values,generator,amplitude=1.0,white_noise=False,lambda_min=0.0,IVAR_cutoff=lya):
-
-        # TODO: Is NGP really the way to go?
+    #The skewers are first resampled onto the new cells using the 'NGP', 'linear' or 'cubic' method.
+    #The extra variance is generated in blocks of N_skewers_block skewers to limit memory use.
+    #generator may be a single random number generator, or a list with one generator for each skewer.
+    def add_small_scale_gaussian_fluctuations(self,cell_size,sigma_G_z_values,extra_sigma_G_values,generator,amplitude=1.0,white_noise=False,lambda_min=0.0,IVAR_cutoff=lya,resampling='NGP',N_skewers_block=1024):
 
         #Add small scale fluctuations
         old_R = self.R
-        Rmax = np.max(old_R)
-        Rmin = np.min(old_R)
-        new_R = np.arange(Rmin,Rmax,cell_size)
+        new_R, skewer_resampling = general.get_resampling(old_R,cell_size,method=resampling)
         new_N_cells = new_R.shape[0]
 
-        NGPs = general.get_NGPs(old_R,new_R).astype(int)
-        expanded_GAUSSIAN_DELTA_rows = np.zeros((self.N_qso,new_N_cells))
-
-        for i in range(self.N_qso):
-            expanded_GAUSSIAN_DELTA_rows[i,:] = self.GAUSSIAN_DELTA_rows[i,NGPs]
+        expanded_GAUSSIAN_DELTA_rows = general.resample_skewers(self.GAUSSIAN_DELTA_rows.astype('float64'),skewer_resampling)
 
         #Redefine the necessary variables (N_cells, Z, D etc)
         self.N_cells = new_N_cells
@@ -366,29 +398,22 @@ class simulation_data:
         self.LOGLAM_MAP = np.log10(lya*(1+self.Z))
 
         # TODO: What to do with this?
-        self.VEL_rows = self.VEL_rows[:,NGPs]
+        self.VEL_rows = general.resample_skewers(self.VEL_rows,skewer_resampling).astype(self.VEL_rows.dtype,copy=False)
 
-        #Make new IVAR rows.
-        self.IVAR_rows = general.make_IVAR_rows(IVAR_cutoff,self.Z_QSO,self.LOGLAM_MAP)
+        #Make new IVAR cells.
+        self.IVAR_cells = general.make_IVAR_cells(IVAR_cutoff,self.Z_QSO,self.LOGLAM_MAP)
 
         #For each skewer, determine the last relevant cell
-        first_relevant_cells = np.zeros(self.N_qso)
-        last_relevant_cells = np.zeros(self.N_qso)
-        for i in range(self.N_qso):
-            first_relevant_cell = np.searchsorted(10**(self.LOGLAM_MAP),lambda_min)
-            if self.linear_skewer_RSDs_added == True:
-                last_relevant_cell = np.searchsorted(self.Z,self.Z_QSO[i]+self.DZ_RSD[i]) - 1
-            else:
-                last_relevant_cell = np.searchsorted(self.Z,self.Z_QSO[i]) - 1
-
-            #Clip the gaussian skewers so that they are zero after the quasar.
-            #This avoids effects from NGP interpolation).
-            expanded_GAUSSIAN_DELTA_rows[i,last_relevant_cell + 1:] = 0
+        first_relevant_cells = np.searchsorted(10**(self.LOGLAM_MAP),lambda_min)*np.ones(self.N_qso,dtype=int)
+        if self.linear_skewer_RSDs_added == True:
+            last_relevant_cells = np.searchsorted(self.Z,self.Z_QSO+self.DZ_RSD) - 1
+        else:
+            last_relevant_cells = np.searchsorted(self.Z,self.Z_QSO) - 1
 
-            first_relevant_cells[i] = first_relevant_cell
-            last_relevant_cells[i] = last_relevant_cell
+        #Clip the gaussian skewers so that they are zero after the quasar.
+        #This avoids effects from NGP interpolation).
+        expanded_GAUSSIAN_DELTA_rows[np.arange(self.N_cells) > last_relevant_cells[:,None]] = 0
 
-        extra_var = np.zeros(expanded_GAUSSIAN_DELTA_rows.shape)
         extra_sigma_G = np.interp(self.Z,sigma_G_z_values,extra_sigma_G_values)
 
 
@@ -396,17 +421,18 @@ class simulation_data:
         #Generate extra variance, either white noise or correlated.
         dkms_dhMpc = general.get_dkms_dhMpc(0.)
         dv_kms = cell_size * dkms_dhMpc
-        extra_var = independent.get_gaussian_fields(generator,self.N_cells,dv_kms=dv_kms,N_skewers=self.N_qso,white_noise=white_noise)
-
-        #Normalise the extra variance to have unit variance
-        k_kms = np.fft.rfftfreq(self.N_cells)*2*np.pi/dv_kms
-        mean_P = np.average(independent.power_kms(0.,k_kms,dv_kms,white_noise))
-        extra_var /= np.sqrt(mean_P/dv_kms)
 
-        extra_var *= extra_sigma_G
+        #Determine the normalisation for the extra variance to have unit variance
+        mean_P = independent.get_power_spectrum(self.N_cells,dv_kms,white_noise)[3]
 
-        mask = general.make_IVAR_rows(lya,self.Z_QSO,self.LOGLAM_MAP)
-        extra_var *= mask
+        #Generate the extra variance in blocks of skewers, and add it to the skewers below the lya line of each quasar.
+        mask_cells = general.make_IVAR_cells(lya,self.Z_QSO,self.LOGLAM_MAP)
+        for start, stop, extra_var in independent.generate_gaussian_field_blocks(generator,self.N_cells,dv_kms=dv_kms,N_skewers=self.N_qso,white_noise=white_noise,N_skewers_block=N_skewers_block):
+            extra_var /= np.sqrt(mean_P/dv_kms)
+            extra_var *= extra_sigma_G
+            extra_var *= general.IVAR_cells_to_mask(mask_cells[start:stop],self.N_cells)
+            extra_var *= amplitude
+            expanded_GAUSSIAN_DELTA_rows[start:stop] += extra_var
 
 
 
@@ -423,9 +449,6 @@ class simulation_data:
             extra_var[relevant_QSOs,j] = generator.normal(scale=extra_sigma_G[j],size=len(relevant_QSOs))
         """
 
-
-        expanded_GAUSSIAN_DELTA_rows += amplitude*extra_var
-
         """
         for i in range(self.N_qso):
             first_relevant_cell = first_relevant_cells[i].astype('int32')
@@ -455,8 +478,7 @@ class simulation_data:
         self.GAUSSIAN_DELTA_rows = expanded_GAUSSIAN_DELTA_rows
         self.SIGMA_G = np.sqrt(extra_sigma_G**2 + (self.SIGMA_G)**2)
 
-        dtype = [('R', 'f8'), ('Z', 'f8'), ('D', 'f8'), ('V', 'f8')]
-        new_cosmology = np.array(list(zip(self.R,self.Z,self.D,self.V)),dtype=dtype)
+        new_cosmology = self.get_COSMO()
 
         return new_cosmology
 
@@ -484,17 +506,40 @@ class simulation_data:
         #self.F_rows = density_to_flux(self.DENSITY_DELTA_rows+1,alpha,beta)
 
         #Set the skewers to 1 beyond the quasars.
-        for i in range(self.N_qso):
-            if self.linear_skewer_RSDs_added == True:
-                last_relevant_cell = np.searchsorted(self.Z,self.Z_QSO[i]+self.DZ_RSD[i]) - 1
-            else:
-                last_relevant_cell = np.searchsorted(self.Z,self.Z_QSO[i]) - 1
-            self.F_rows[i,last_relevant_cell+1:] = 1
+        self.set_flux_beyond_quasars()
 
         self.flux_computed = True
 
         return
 
+    #Function to add physical, tau and flux skewers to the object in a single pass over the gaussian skewers.
+    #The physical and tau skewers are only kept if requested (e.g. if they are to be saved, or RSDs are to be added).
+    def compute_all_skewers(self,alpha,beta,store_density=False,store_tau=False):
+
+        self.F_rows, self.DENSITY_DELTA_rows, self.TAU_rows = convert.gaussian_to_flux(self.GAUSSIAN_DELTA_rows,self.SIGMA_G,self.D,alpha,beta,return_density=store_density,return_tau=store_tau)
+
+        #Set the skewers to 1 beyond the quasars.
+        self.set_flux_beyond_quasars()
+
+        self.density_computed = store_density
+        self.tau_computed = store_tau
+        self.flux_computed = True
+
+        return
+
+    #Function to set the flux skewers to 1 beyond the quasars.
+    def set_flux_beyond_quasars(self):
+
+        if self.linear_skewer_RSDs_added == True:
+            last_relevant_cells = np.searchsorted(self.Z,self.Z_QSO+self.DZ_RSD) - 1
+        else:
+            last_relevant_cells = np.searchsorted(self.Z,self.Z_QSO) - 1
+
+        beyond_quasars = np.arange(self.N_cells) > last_relevant_cells[:,None]
+        self.F_rows[beyond_quasars] = 1
+
+        return
+
     ## TODO: remove this, now defunct
     #Function to add linear RSDs from the velocity skewers.
     def add_linear_RSDs(self,alpha,beta):
@@ -526,20 +571,34 @@ class simulation_data:
 
         return
 
-    #Function to add thermal RSDs from the velocity skewers.
-    def add_RSDs(self,alpha,beta,thermal=False):
+    #Function to construct the operator that maps tau skewers to tau skewers with RSDs, from the current velocity and density skewers.
+    #This can be passed to add_RSDs in order to apply the same RSDs to several sets of tau skewers (e.g. different alphas).
+    def get_RSD_operator(self,thermal=False):
 
         initial_density_rows = 1 + self.DENSITY_DELTA_rows
-        new_TAU_rows = RSD.add_skewer_RSDs(self.TAU_rows,initial_density_rows,self.VEL_rows,self.Z,self.R,thermal=thermal)
+        RSD_operator = RSD.get_RSD_operator(initial_density_rows,self.VEL_rows,self.Z,self.R,thermal=thermal)
+
+        return RSD_operator
+
+    #Function to add thermal RSDs from the velocity skewers.
+    #thermal_kernel chooses how thermal broadening is computed: 'batched' (all cells at once) or 'loop' (cell by cell).
+    #If an RSD_operator (from get_RSD_operator) is provided, it is applied instead of recomputing the RSDs.
+    def add_RSDs(self,alpha,beta,thermal=False,thermal_kernel='batched',RSD_operator=None):
+
+        if RSD_operator is not None:
+            new_TAU_rows = RSD.apply_RSD_operator(RSD_operator,self.TAU_rows)
+        else:
+            initial_density_rows = 1 + self.DENSITY_DELTA_rows
+            new_TAU_rows = RSD.add_skewer_RSDs(self.TAU_rows,initial_density_rows,self.VEL_rows,self.Z,self.R,thermal=thermal,thermal_kernel=thermal_kernel)
 
         ## TODO: find a neater way to do this
         #For the moment, we add a very small value onto the tau skewers, to avoid problems in the inverse lognormal transformation
         #In future, when we don't care about the gaussian skewers, we can get rid of this
         moodified_new_TAU_rows = new_TAU_rows + (new_TAU_rows==0)*1.0e-10
 
-        #convert the new tau rows back to physical density
-        new_density_rows = convert.tau_to_density(moodified_new_TAU_rows,alpha,beta)
-        new_density_delta_rows = new_density_rows - 1
+        #convert the new tau rows back to physical density, reusing the modified tau array
+        new_density_delta_rows = convert.tau_to_density(moodified_new_TAU_rows,alpha,beta,out=moodified_new_TAU_rows)
+        new_density_delta_rows -= 1
 
         #convert the new physical density rows back to gaussian
         new_gaussian_rows = convert.lognormal_delta_to_gaussian(new_density_delta_rows,self.SIGMA_G,self.D)
@@ -585,13 +644,13 @@ class simulation_data:
             GAUSSIAN_DELTA_rows = np.concatenate((object_A.GAUSSIAN_DELTA_rows,object_B.GAUSSIAN_DELTA_rows),axis=0)
             DENSITY_DELTA_rows = np.concatenate((object_A.DENSITY_DELTA_rows,object_B.DENSITY_DELTA_rows),axis=0)
             VEL_rows = np.concatenate((object_A.VEL_rows,object_B.VEL_rows),axis=0)
-            IVAR_rows = np.concatenate((object_A.IVAR_rows,object_B.IVAR_rows),axis=0)
+            IVAR_cells = np.concatenate((object_A.IVAR_cells,object_B.IVAR_cells),axis=0)
             F_rows = np.concatenate((object_A.F_rows,object_B.F_rows),axis=0)
         else:
             GAUSSIAN_DELTA_rows = np.concatenate((object_A.GAUSSIAN_DELTA_rows,object_B.GAUSSIAN_DELTA_rows),axis=0)
             DENSITY_DELTA_rows = None
             VEL_rows = np.concatenate((object_A.VEL_rows,object_B.VEL_rows),axis=0)
-            IVAR_rows = np.concatenate((object_A.IVAR_rows,object_B.IVAR_rows),axis=0)
+            IVAR_cells = np.concatenate((object_A.IVAR_cells,object_B.IVAR_cells),axis=0)
             F_rows = None
 
         """
@@ -605,27 +664,85 @@ class simulation_data:
         V = object_A.V
         A = object_A.A
 
-        return cls(N_qso,N_cells,SIGMA_G,ALPHA,TYPE,RA,DEC,Z_QSO,DZ_RSD,MOCKID,PLATE,MJD,FIBER,GAUSSIAN_DELTA_rows,DENSITY_DELTA_rows,VEL_rows,IVAR_rows,F_rows,R,Z,D,V,LOGLAM_MAP,A)
+        return cls(N_qso,N_cells,SIGMA_G,ALPHA,TYPE,RA,DEC,Z_QSO,DZ_RSD,MOCKID,PLATE,MJD,FIBER,GAUSSIAN_DELTA_rows,DENSITY_DELTA_rows,VEL_rows,IVAR_cells,F_rows,R,Z,D,V,LOGLAM_MAP,A)
+
+    #Method to create a new object from an existing one, having specified which MOCKIDs we want to include.
+    #The quasars keep the order in which they appear in the existing object.
+    @classmethod
+    def choose_qsos(cls,object_A,MOCKIDs):
+
+        rows = np.isin(object_A.MOCKID,MOCKIDs)
+
+        N_qso = np.sum(rows)
+        N_cells = object_A.N_cells
+        SIGMA_G = object_A.SIGMA_G
+        ALPHA = object_A.ALPHA
+
+        TYPE = object_A.TYPE[rows]
+        RA = object_A.RA[rows]
+        DEC = object_A.DEC[rows]
+        Z_QSO = object_A.Z_QSO[rows]
+        DZ_RSD = object_A.DZ_RSD[rows]
+        MOCKID = object_A.MOCKID[rows]
+        PLATE = object_A.PLATE[rows]
+        MJD = object_A.MJD[rows]
+        FIBER = object_A.FIBER[rows]
+
+        GAUSSIAN_DELTA_rows = object_A.GAUSSIAN_DELTA_rows[rows,:]
+        if object_A.DENSITY_DELTA_rows is not None:
+            DENSITY_DELTA_rows = object_A.DENSITY_DELTA_rows[rows,:]
+        else:
+            DENSITY_DELTA_rows = None
+        VEL_rows = object_A.VEL_rows[rows,:]
+        IVAR_cells = object_A.IVAR_cells[rows,:]
+        if object_A.F_rows is not None:
+            F_rows = object_A.F_rows[rows,:]
+        else:
+            F_rows = None
+
+        Z = object_A.Z
+        LOGLAM_MAP = object_A.LOGLAM_MAP
+        R = object_A.R
+        D = object_A.D
+        V = object_A.V
+        A = object_A.A
+
+        return cls(N_qso,N_cells,SIGMA_G,ALPHA,TYPE,RA,DEC,Z_QSO,DZ_RSD,MOCKID,PLATE,MJD,FIBER,GAUSSIAN_DELTA_rows,DENSITY_DELTA_rows,VEL_rows,IVAR_cells,F_rows,R,Z,D,V,LOGLAM_MAP,A)
+
+    #Function to make a colore-format CATALOG table of the QSOs.
+    def get_colore_CATALOG(self):
+
+        dtype = [('TYPE', 'f8'), ('RA', 'f8'), ('DEC', 'f8'), ('Z_COSMO', 'f8'), ('DZ_RSD', 'f8'), ('MOCKID', int)]
+        CATALOG = general.make_structured_array([self.TYPE,self.RA,self.DEC,self.Z_QSO,self.DZ_RSD,self.MOCKID],dtype)
+
+        return CATALOG
+
+    #Function to make a picca-format CATALOG table of a subset of the QSOs, given by an index array or boolean mask.
+    def get_picca_CATALOG(self,relevant_QSOs):
+
+        dtype = [('RA', 'f8'), ('DEC', 'f8'), ('Z', 'f8'), ('PLATE', int), ('MJD', 'f8'), ('FIBER', int), ('THING_ID', int)]
+        columns = [self.RA,self.DEC,self.Z_QSO,self.PLATE,self.MJD,self.FIBER,self.MOCKID]
+        CATALOG = general.make_structured_array([column[relevant_QSOs] for column in columns],dtype)
+
+        return CATALOG
+
+    #Function to make a COSMO table of the cells.
+    def get_COSMO(self):
+
+        dtype = [('R', 'f8'), ('Z', 'f8'), ('D', 'f8'), ('V', 'f8')]
+        COSMO = general.make_structured_array([self.R,self.Z,self.D,self.V],dtype)
+
+        return COSMO
 
     #Function to save data as a Gaussian colore file.
     def save_as_gaussian_colore(self,location,filename,header,overwrite=False):
 
         #Organise the data into colore-format arrays.
-        colore_1_data = []
-        for i in range(self.N_qso):
-            colore_1_data += [(self.TYPE[i],self.RA[i],self.DEC[i],self.Z_QSO[i],self.DZ_RSD[i],self.MOCKID[i])]
-
-        dtype = [('TYPE', 'f8'), ('RA', 'f8'), ('DEC', 'f8'), ('Z_COSMO', 'f8'), ('DZ_RSD', 'f8'), ('MOCKID', int)]
-        colore_1 = np.array(colore_1_data,dtype=dtype)
+        colore_1 = self.get_colore_CATALOG()
         colore_2 = self.GAUSSIAN_DELTA_rows
         colore_3 = self.VEL_rows
 
-        colore_4_data = []
-        for i in range(self.N_cells):
-            colore_4_data += [(self.R[i],self.Z[i],self.D[i],self.V[i])]
-
-        dtype = [('R', 'f8'), ('Z', 'f8'), ('D', 'f8'), ('V', 'f8')]
-        colore_4 = np.array(colore_4_data,dtype=dtype)
+        colore_4 = self.get_COSMO()
 
         #Construct HDUs from the data arrays.
         prihdr = fits.Header()
@@ -639,79 +756,75 @@ class simulation_data:
 
         #Combine the HDUs into an HDUlist and save as a new file. Close the HDUlist.
         hdulist = fits.HDUList([prihdu, hdu_CATALOG, hdu_GAUSSIAN, hdu_VEL, hdu_COSMO])
-        hdulist.writeto(location+filename,overwrite=overwrite)
+        checkpoint.write_HDUList(hdulist,location+filename,overwrite=overwrite)
         hdulist.close
 
         return
 
-    #Function to save data as a picca density file.
-    def save_as_picca_gaussian(self,location,filename,header,overwrite=False,zero_mean_delta=False,min_number_cells=2,mean_DELTA=None):
-
-        lya_lambdas = 10**self.LOGLAM_MAP
-
-        #Determine the relevant QSOs: those that have relevant cells (IVAR > 0) beyond the first_relevant_cell.
-        #We impose a minimum number of cells per skewer here to avoid problems with picca.
-        relevant_QSOs = []
-        for i in range(self.N_qso):
-            if np.sum(self.IVAR_rows[i,:]) >= min_number_cells:
-                relevant_QSOs += [i]
+    #Function to plan the picca outputs of the object in its current state.
+    #The relevant QSOs (those with at least min_number_cells relevant cells, to avoid problems with picca), the IVAR image, the LOGLAM_MAP and the CATALOG are computed once, and shared by all picca products.
+    #If a plan is given and is still valid (the object's QSOs and cells have not changed since it was made), it is returned as it is.
+    def get_picca_output_plan(self,min_number_cells=2,plan=None):
 
-        #Trim data according to the relevant cells and QSOs.
-        relevant_GAUSSIAN_DELTA_rows = self.GAUSSIAN_DELTA_rows[relevant_QSOs,:]
-        relevant_IVAR_rows = self.IVAR_rows[relevant_QSOs,:]
-        relevant_LOGLAM_MAP = self.LOGLAM_MAP[:]
+        if plan is not None and plan['IVAR_cells'] is self.IVAR_cells and plan['min_number_cells'] == min_number_cells:
+            return plan
 
-        #If desired, enforce that the Delta rows have zero mean.
-        if zero_mean_delta == True:
-            relevant_GAUSSIAN_DELTA_rows = general.normalise_deltas(relevant_GAUSSIAN_DELTA_rows,mean_DELTA)
+        relevant_QSOs = np.where(general.get_N_relevant_cells(self.IVAR_cells) >= min_number_cells)[0]
+        relevant_IVAR_rows = general.IVAR_cells_to_rows(self.IVAR_cells[relevant_QSOs,:],self.N_cells)
 
-        #Organise the data into picca-format arrays.
-        picca_0 = relevant_GAUSSIAN_DELTA_rows.T
-        picca_1 = relevant_IVAR_rows.T
-        picca_2 = relevant_LOGLAM_MAP
+        plan = {}
+        plan['IVAR_cells'] = self.IVAR_cells
+        plan['min_number_cells'] = min_number_cells
+        plan['relevant_QSOs'] = relevant_QSOs
+        plan['IVAR_rows'] = relevant_IVAR_rows
+        plan['IV'] = np.ascontiguousarray(relevant_IVAR_rows.T)
+        plan['LOGLAM_MAP'] = self.LOGLAM_MAP[:]
+        plan['CATALOG'] = self.get_picca_CATALOG(relevant_QSOs)
 
-        picca_3_data = []
-        for i in range(self.N_qso):
-            if i in relevant_QSOs:
-                picca_3_data += [(self.RA[i],self.DEC[i],self.Z_QSO[i],self.PLATE[i],self.MJD[i],self.FIBER[i],self.MOCKID[i])]
+        return plan
 
-        dtype = [('RA', 'f8'), ('DEC', 'f8'), ('Z', 'f8'), ('PLATE', int), ('MJD', 'f8'), ('FIBER', int), ('THING_ID', int)]
-        picca_3 = np.array(picca_3_data,dtype=dtype)
+    #Function to save a picca file from the delta rows of the relevant QSOs, and an output plan.
+    def save_picca_file(self,location,filename,header,relevant_DELTA_rows,plan,overwrite=False):
 
         #Make the data into suitable HDUs.
-        hdu_DELTA = fits.PrimaryHDU(data=picca_0,header=header)
-        hdu_iv = fits.ImageHDU(data=picca_1,header=header,name='IV')
-        hdu_LOGLAM_MAP = fits.ImageHDU(data=picca_2,header=header,name='LOGLAM_MAP')
-        cols_CATALOG = fits.ColDefs(picca_3)
-        hdu_CATALOG = fits.BinTableHDU.from_columns(cols_CATALOG,header=header,name='CATALOG')
+        hdu_DELTA = fits.PrimaryHDU(data=relevant_DELTA_rows.T,header=header)
+        hdu_iv = fits.ImageHDU(data=plan['IV'],header=header,name='IV')
+        hdu_LOGLAM_MAP = fits.ImageHDU(data=plan['LOGLAM_MAP'],header=header,name='LOGLAM_MAP')
+        hdu_CATALOG = fits.BinTableHDU.from_columns(plan['CATALOG'],header=header,name='CATALOG')
 
         #Combine the HDUs into and HDUlist and save as a new file. Close the HDUlist.
         hdulist = fits.HDUList([hdu_DELTA, hdu_iv, hdu_LOGLAM_MAP, hdu_CATALOG])
-        hdulist.writeto(location+filename,overwrite=overwrite)
+        checkpoint.write_HDUList(hdulist,location+filename,overwrite=overwrite)
         hdulist.close()
 
         return
 
+    #Function to save data as a picca gaussian file.
+    def save_as_picca_gaussian(self,location,filename,header,overwrite=False,zero_mean_delta=False,min_number_cells=2,mean_DELTA=None,plan=None):
+
+        plan = self.get_picca_output_plan(min_number_cells=min_number_cells,plan=plan)
+
+        #Trim data according to the relevant QSOs.
+        relevant_GAUSSIAN_DELTA_rows = self.GAUSSIAN_DELTA_rows[plan['relevant_QSOs'],:]
+
+        #If desired, enforce that the Delta rows have zero mean.
+        if zero_mean_delta == True:
+            relevant_GAUSSIAN_DELTA_rows = general.normalise_deltas(relevant_GAUSSIAN_DELTA_rows,mean_DELTA)
+
+        self.save_picca_file(location,filename,header,relevant_GAUSSIAN_DELTA_rows,plan,overwrite=overwrite)
+
+        return
+
     #Function to save data as a Lognormal colore file.
-    def save_as_physical_colore(self,location,filename,header):
+    def save_as_physical_colore(self,location,filename,header,overwrite=False):
 
         #Organise the data into colore-format arrays.
-        colore_1_data = []
-        for i in range(self.N_qso):
-            colore_1_data += [(self.TYPE[i],self.RA[i],self.DEC[i],self.Z_QSO[i],self.DZ_RSD[i],self.MOCKID[i])]
-
-        dtype = [('TYPE', 'f8'), ('RA', 'f8'), ('DEC', 'f8'), ('Z_COSMO', 'f8'), ('DZ_RSD', 'f8'), ('MOCKID', int)]
-        colore_1 = np.array(colore_1_data,dtype=dtype)
+        colore_1 = self.get_colore_CATALOG()
 
         colore_2 = self.DENSITY_DELTA_rows
         colore_3 = self.VEL_rows
 
-        colore_4_data = []
-        for i in range(self.N_cells):
-            colore_4_data += [(self.R[i],self.Z[i],self.D[i],self.V[i])]
-
-        dtype = [('R', 'f8'), ('Z', 'f8'), ('D', 'f8'), ('V', 'f8')]
-        colore_4 = np.array(colore_4_data,dtype=dtype)
+        colore_4 = self.get_COSMO()
 
         #Construct HDUs from the data arrays.
         prihdr = fits.Header()
@@ -725,69 +838,35 @@ class simulation_data:
 
         #Combine the HDUs into an HDUlist and save as a new file. Close the HDUlist.
         hdulist = fits.HDUList([prihdu, hdu_CATALOG, hdu_DELTA, hdu_VEL, hdu_COSMO])
-        hdulist.writeto(location+filename)
+        checkpoint.write_HDUList(hdulist,location+filename,overwrite=overwrite)
         hdulist.close
 
         return
 
     #Function to save data as a picca density file.
-    def save_as_picca_density(self,location,filename,header,zero_mean_delta=False,min_number_cells=2,mean_DELTA=None):
+    def save_as_picca_density(self,location,filename,header,zero_mean_delta=False,min_number_cells=2,mean_DELTA=None,overwrite=False,plan=None):
 
-        lya_lambdas = 10**self.LOGLAM_MAP
+        plan = self.get_picca_output_plan(min_number_cells=min_number_cells,plan=plan)
 
-        #Determine the relevant QSOs: those that have relevant cells (IVAR > 0) beyond the first_relevant_cell.
-        #We impose a minimum number of cells per skewer here to avoid problems with picca.
-        relevant_QSOs = []
-        for i in range(self.N_qso):
-            if np.sum(self.IVAR_rows[i,:]) >= min_number_cells:
-                relevant_QSOs += [i]
-
-        #Trim data according to the relevant cells and QSOs.
-        relevant_DENSITY_DELTA_rows = self.DENSITY_DELTA_rows[relevant_QSOs,:]
-        relevant_IVAR_rows = self.IVAR_rows[relevant_QSOs,:]
-        relevant_LOGLAM_MAP = self.LOGLAM_MAP[:]
+        #Trim data according to the relevant QSOs.
+        relevant_DENSITY_DELTA_rows = self.DENSITY_DELTA_rows[plan['relevant_QSOs'],:]
 
         #If desired, enforce that the Delta rows have zero mean.
         if zero_mean_delta == True:
             relevant_DENSITY_DELTA_rows = general.normalise_deltas(relevant_DENSITY_DELTA_rows,mean_DELTA)
 
-        #Organise the data into picca-format arrays.
-        picca_0 = relevant_DENSITY_DELTA_rows.T
-        picca_1 = relevant_IVAR_rows.T
-        picca_2 = relevant_LOGLAM_MAP
-
-        picca_3_data = []
-        for i in range(self.N_qso):
-            if i in relevant_QSOs:
-                picca_3_data += [(self.RA[i],self.DEC[i],self.Z_QSO[i],self.PLATE[i],self.MJD[i],self.FIBER[i],self.MOCKID[i])]
-
-        dtype = [('RA', 'f8'), ('DEC', 'f8'), ('Z', 'f8'), ('PLATE', int), ('MJD', 'f8'), ('FIBER', int), ('THING_ID', int)]
-        picca_3 = np.array(picca_3_data,dtype=dtype)
-
-        #Make the data into suitable HDUs.
-        hdu_DELTA = fits.PrimaryHDU(data=picca_0,header=header)
-        hdu_iv = fits.ImageHDU(data=picca_1,header=header,name='IV')
-        hdu_LOGLAM_MAP = fits.ImageHDU(data=picca_2,header=header,name='LOGLAM_MAP')
-        cols_CATALOG = fits.ColDefs(picca_3)
-        hdu_CATALOG = fits.BinTableHDU.from_columns(cols_CATALOG,header=header,name='CATALOG')
-
-        #Combine the HDUs into and HDUlist and save as a new file. Close the HDUlist.
-        hdulist = fits.HDUList([hdu_DELTA, hdu_iv, hdu_LOGLAM_MAP, hdu_CATALOG])
-        hdulist.writeto(location+filename)
-        hdulist.close()
+        self.save_picca_file(location,filename,header,relevant_DENSITY_DELTA_rows,plan,overwrite=overwrite)
 
         return
 
     #Function to save data as a transmission file.
-    def save_as_transmission(self,location,filename,header):
+    def save_as_transmission(self,location,filename,header,overwrite=False):
         lya_lambdas = 10**self.LOGLAM_MAP
 
         Z_RSD = self.Z_QSO + self.DZ_RSD
 
-        transmission_1_data = list(zip(self.RA,self.DEC,Z_RSD,self.Z_QSO,self.MOCKID))
-
         dtype = [('RA', 'f8'), ('DEC', 'f8'), ('Z', 'f8'), ('Z_noRSD', 'f8'), ('MOCKID', int)]
-        transmission_1 = np.array(transmission_1_data,dtype=dtype)
+        transmission_1 = general.make_structured_array([self.RA,self.DEC,Z_RSD,self.Z_QSO,self.MOCKID],dtype)
 
         transmission_2 = 10**(self.LOGLAM_MAP)
         transmission_3 = self.F_rows
@@ -808,27 +887,19 @@ class simulation_data:
             hdulist = fits.HDUList([prihdu, hdu_METADATA, hdu_WAVELENGTH, hdu_TRANSMISSION])
 
         #Save as a new file. Close the HDUlist.
-        hdulist.writeto(location+filename)
+        checkpoint.write_HDUList(hdulist,location+filename,overwrite=overwrite)
         hdulist.close()
 
         return
 
     #Function to save data as a picca flux file.
-    def save_as_picca_flux(self,location,filename,header,min_number_cells = 2,mean_F_data=None):
+    def save_as_picca_flux(self,location,filename,header,min_number_cells = 2,mean_F_data=None,overwrite=False,plan=None):
 
-        lya_lambdas = 10**self.LOGLAM_MAP
+        plan = self.get_picca_output_plan(min_number_cells=min_number_cells,plan=plan)
 
-        #Determine the relevant QSOs: those that have relevant cells (IVAR > 0) beyond the first_relevant_cell.
-        #We impose a minimum number of cells per skewer here to avoid problems with picca.
-        relevant_QSOs = []
-        for i in range(self.N_qso):
-            if np.sum(self.IVAR_rows[i,:]) >= min_number_cells:
-                relevant_QSOs += [i]
-
-        #Trim data according to the relevant cells and QSOs.
-        relevant_F_rows = self.F_rows[relevant_QSOs,:]
-        relevant_IVAR_rows = self.IVAR_rows[relevant_QSOs,:]
-        relevant_LOGLAM_MAP = self.LOGLAM_MAP[:]
+        #Trim data according to the relevant QSOs.
+        relevant_F_rows = self.F_rows[plan['relevant_QSOs'],:]
+        relevant_IVAR_rows = plan['IVAR_rows']
         relevant_Z = self.Z[:]
 
         #Calculate mean F as a function of z for the relevant cells, then F_DELTA_rows.
@@ -843,76 +914,42 @@ class simulation_data:
 
         relevant_F_DELTA_rows = ((relevant_F_rows)/relevant_F_BAR - 1)*relevant_IVAR_rows
 
-        #Organise the data into picca-format arrays.
-        picca_0 = relevant_F_DELTA_rows.T
-        picca_1 = relevant_IVAR_rows.T
-        picca_2 = relevant_LOGLAM_MAP
-
-        picca_3_data = []
-        for i in range(self.N_qso):
-            if i in relevant_QSOs:
-                picca_3_data += [(self.RA[i],self.DEC[i],self.Z_QSO[i],self.PLATE[i],self.MJD[i],self.FIBER[i],self.MOCKID[i])]
-
-        dtype = [('RA', 'f8'), ('DEC', 'f8'), ('Z', 'f8'), ('PLATE', int), ('MJD', 'f8'), ('FIBER', int), ('THING_ID', int)]
-        picca_3 = np.array(picca_3_data,dtype=dtype)
-
-        #Make the data into suitable HDUs.
-        hdu_F = fits.PrimaryHDU(data=picca_0,header=header)
-        hdu_iv = fits.ImageHDU(data=picca_1,header=header,name='IV')
-        hdu_LOGLAM_MAP = fits.ImageHDU(data=picca_2,header=header,name='LOGLAM_MAP')
-        cols_CATALOG = fits.ColDefs(picca_3)
-        hdu_CATALOG = fits.BinTableHDU.from_columns(cols_CATALOG,header=header,name='CATALOG')
-
-        #Combine the HDUs into and HDUlist and save as a new file. Close the HDUlist.
-        hdulist = fits.HDUList([hdu_F, hdu_iv, hdu_LOGLAM_MAP, hdu_CATALOG])
-        hdulist.writeto(location+filename)
-        hdulist.close()
+        self.save_picca_file(location,filename,header,relevant_F_DELTA_rows,plan,overwrite=overwrite)
 
         return
 
     #Function to save data as a picca velocity file.
-    def save_as_picca_velocity(self,location,filename,header,zero_mean_delta=False,min_number_cells=2,overwrite=False):
-
-        lya_lambdas = 10**self.LOGLAM_MAP
-
-        #Determine the relevant QSOs: those that have relevant cells (IVAR > 0) beyond the first_relevant_cell.
-        #We impose a minimum number of cells per skewer here to avoid problems with picca.
-        relevant_QSOs = []
-        for i in range(self.N_qso):
-            if np.sum(self.IVAR_rows[i,:]) >= min_number_cells:
-                relevant_QSOs += [i]
-
-        #Trim data according to the relevant cells and QSOs.
-        relevant_VEL_rows = self.VEL_rows[relevant_QSOs,:]
-        relevant_IVAR_rows = self.IVAR_rows[relevant_QSOs,:]
-        relevant_LOGLAM_MAP = self.LOGLAM_MAP[:]
+    def save_as_picca_velocity(self,location,filename,header,zero_mean_delta=False,min_number_cells=2,overwrite=False,plan=None):
 
-        #Organise the data into picca-format arrays.
-        picca_0 = relevant_VEL_rows.T
-        picca_1 = relevant_IVAR_rows.T
-        picca_2 = relevant_LOGLAM_MAP
+        plan = self.get_picca_output_plan(min_number_cells=min_number_cells,plan=plan)
 
-        picca_3_data = []
-        for i in range(self.N_qso):
-            if i in relevant_QSOs:
-                picca_3_data += [(self.RA[i],self.DEC[i],self.Z_QSO[i],self.PLATE[i],self.MJD[i],self.FIBER[i],self.MOCKID[i])]
+        #Trim data according to the relevant QSOs.
+        relevant_VEL_rows = self.VEL_rows[plan['relevant_QSOs'],:]
 
-        dtype = [('RA', 'f8'), ('DEC', 'f8'), ('Z', 'f8'), ('PLATE', int), ('MJD', 'f8'), ('FIBER', int), ('THING_ID', int)]
-        picca_3 = np.array(picca_3_data,dtype=dtype)
+        self.save_picca_file(location,filename,header,relevant_VEL_rows,plan,overwrite=overwrite)
 
-        #Make the data into suitable HDUs.
-        hdu_VEL = fits.PrimaryHDU(data=picca_0,header=header)
-        hdu_iv = fits.ImageHDU(data=picca_1,header=header,name='IV')
-        hdu_LOGLAM_MAP = fits.ImageHDU(data=picca_2,header=header,name='LOGLAM_MAP')
-        cols_CATALOG = fits.ColDefs(picca_3)
-        hdu_CATALOG = fits.BinTableHDU.from_columns(cols_CATALOG,header=header,name='CATALOG')
+        return
 
-        #Combine the HDUs into and HDUlist and save as a new file. Close the HDUlist.
-        hdulist = fits.HDUList([hdu_VEL, hdu_iv, hdu_LOGLAM_MAP, hdu_CATALOG])
-        hdulist.writeto(location+filename,overwrite=overwrite)
-        hdulist.close()
+    #Function to save several picca products from the object in its current state, sharing one output plan.
+    #filenames is a dictionary with products ('gaussian', 'density', 'flux' or 'velocity') as keys and filenames as values.
+    #The plan is returned so that it can be reused for products written later from the same QSOs and cells.
+    def save_as_picca_products(self,location,filenames,header,min_number_cells=2,mean_F_data=None,overwrite=False,plan=None):
+
+        plan = self.get_picca_output_plan(min_number_cells=min_number_cells,plan=plan)
+
+        for product, filename in filenames.items():
+            if product == 'gaussian':
+                self.save_as_picca_gaussian(location,filename,header,min_number_cells=min_number_cells,overwrite=overwrite,plan=plan)
+            elif product == 'density':
+                self.save_as_picca_density(location,filename,header,min_number_cells=min_number_cells,overwrite=overwrite,plan=plan)
+            elif product == 'flux':
+                self.save_as_picca_flux(location,filename,header,min_number_cells=min_number_cells,mean_F_data=mean_F_data,overwrite=overwrite,plan=plan)
+            elif product == 'velocity':
+                self.save_as_picca_velocity(location,filename,header,min_number_cells=min_number_cells,overwrite=overwrite,plan=plan)
+            else:
+                raise ValueError('picca product {} not recognised'.format(product))
 
-        return
+        return plan
 
     #Function to save the mean and variance of the different quantities as a function of Z.
     def get_means(self,lambda_min=0.0):
@@ -929,13 +966,16 @@ class simulation_data:
         last_relevant_cell = self.N_cells - 1
 
         #Determine the relevant QSOs: those that have relevant cells (IVAR > 0) beyond the first_relevant_cell.
-        relevant_QSOs = [i for i in range(self.N_qso) if self.IVAR_rows[i,first_relevant_cell] == 1]
+        relevant_QSOs = general.IVAR_cells_contain(self.IVAR_cells,first_relevant_cell)
 
         #Trim data according to the relevant cells and QSOs.
-        relevant_DENSITY_DELTA_rows = self.DENSITY_DELTA_rows[relevant_QSOs,first_relevant_cell:last_relevant_cell+1]
+        #If the density skewers have not been kept, their means are set to NaN, as they have not been measured.
+        if self.density_computed == True:
+            relevant_DENSITY_DELTA_rows = self.DENSITY_DELTA_rows[relevant_QSOs,first_relevant_cell:last_relevant_cell+1]
         relevant_GAUSSIAN_DELTA_rows = self.GAUSSIAN_DELTA_rows[relevant_QSOs,first_relevant_cell:last_relevant_cell+1]
         relevant_F_rows = self.F_rows[relevant_QSOs,first_relevant_cell:last_relevant_cell+1]
-        relevant_IVAR_rows = self.IVAR_rows[relevant_QSOs,first_relevant_cell:last_relevant_cell+1]
+        relevant_IVAR_cells = general.trim_IVAR_cells(self.IVAR_cells[relevant_QSOs,:],first_relevant_cell,last_relevant_cell+1)
+        relevant_IVAR_rows = general.IVAR_cells_to_rows(relevant_IVAR_cells,last_relevant_cell+1-first_relevant_cell)
         relevant_LOGLAM_MAP = self.LOGLAM_MAP[first_relevant_cell:last_relevant_cell+1]
 
         #For each cell, determine the number of skewers for which it is relevant.
@@ -954,8 +994,12 @@ class simulation_data:
         GDSB = np.average(relevant_GAUSSIAN_DELTA_rows**2,weights=relevant_IVAR_rows+small,axis=0)*relevant_cells
 
         #Calculate the mean in each cell of the density delta and its square.
-        DDB = np.average(relevant_DENSITY_DELTA_rows,weights=relevant_IVAR_rows+small,axis=0)*relevant_cells
-        DDSB = np.average(relevant_DENSITY_DELTA_rows**2,weights=relevant_IVAR_rows+small,axis=0)*relevant_cells
+        if self.density_computed == True:
+            DDB = np.average(relevant_DENSITY_DELTA_rows,weights=relevant_IVAR_rows+small,axis=0)*relevant_cells
+            DDSB = np.average(relevant_DENSITY_DELTA_rows**2,weights=relevant_IVAR_rows+small,axis=0)*relevant_cells
+        else:
+            DDB = np.full(relevant_cells.shape,np.nan)
+            DDSB = np.full(relevant_cells.shape,np.nan)
 
         #Calculate the mean in each cell of the flux and its square.
         FB = np.average(relevant_F_rows,weights=relevant_IVAR_rows+small,axis=0)*relevant_cells
@@ -968,17 +1012,22 @@ class simulation_data:
         #Stitch together the means into a binary table.
         dtype = [('N', 'f4'),('GAUSSIAN_DELTA', 'f4'), ('GAUSSIAN_DELTA_SQUARED', 'f4'), ('DENSITY_DELTA', 'f4'), ('DENSITY_DELTA_SQUARED', 'f4')
                 , ('F', 'f4'), ('F_SQUARED', 'f4'), ('F_DELTA', 'f4'), ('F_DELTA_SQUARED', 'f4')]
-        means = np.array(list(zip(N_relevant_skewers,GDB,GDSB,DDB,DDSB,FB,FSB,FDB,FDSB)),dtype=dtype)
+        means = general.make_structured_array([N_relevant_skewers,GDB,GDSB,DDB,DDSB,FB,FSB,FDB,FDSB],dtype)
 
         return means
 
     #Function to add DLAs to a set of skewers.
-    def add_DLA_table(self):
+    #If a seed is given, each skewer's DLAs are drawn from its own random number generator (see general.get_skewer_generator).
+    def add_DLA_table(self,seed=None):
 
         dla_bias = 2.0
         #If extrapolate_z_down is set to a value below the skewer, then we extrapolate down to that value.
         #Otherwise, we start placing DLAs at the start of the skewer.
         extrapolate_z_down = None
-        DLA.add_DLA_table_to_object(self,dla_bias=dla_bias,extrapolate_z_down=extrapolate_z_down)
+        if seed is not None:
+            generators = general.get_skewer_generators(seed,self.MOCKID,'DLAs')
+        else:
+            generators = None
+        DLA.add_DLA_table_to_object(self,dla_bias=dla_bias,extrapolate_z_down=extrapolate_z_down,generators=generators)
 
         return
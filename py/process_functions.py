@@ -1020,7 +1020,7 @@ class simulation_data:
         h_R, h_Z, h_D, h_V = get_COSMO(h,input_format)
         h_lya_lambdas = get_lya_lambdas(h,input_format)
 
-        if MOCKIDs != None:
+        if MOCKIDs is not None:
             #Work out which rows in the hdulist we are interested in.
             rows = ['']*len(MOCKIDs)
             s = set(MOCKIDs)
@@ -1105,7 +1105,7 @@ class simulation_data:
                 SIGMA_G = h[4].header['SIGMA_G']
 
             #Derive the MOCKID and LOGLAM_MAP.
-            if MOCKIDs != None:
+            if MOCKIDs is not None:
                 MOCKID = MOCKIDs
             else:
                 MOCKID = get_MOCKID(h,input_format,file_number)
@@ -0,0 +1,96 @@
+import numpy as np
+from astropy.io import fits
+import heapq
+
+import checkpoint
+
+lya = 1215.67
+
+#Function to estimate the cost of processing each of a list of pixels from master data, as the total length of their quasars' skewers.
+#Each skewer runs from z_min up to its quasar, and its length is measured in comoving distance, in which the output cells are uniform.
+def get_pixel_costs_from_master_data(master_data,cosmology_data,pixels,z_min=0.0):
+
+    Z_QSO = master_data['Z_QSO_NO_RSD']
+    PIXNUM = master_data['PIXNUM'].astype(int)
+
+    R_QSO = np.interp(Z_QSO,cosmology_data['Z'],cosmology_data['R'])
+    R_min = np.interp(z_min,cosmology_data['Z'],cosmology_data['R'])
+    skewer_lengths = np.maximum(R_QSO - R_min,0.)
+
+    N_pixels = max(np.max(PIXNUM,initial=0),np.max(pixels,initial=0)) + 1
+    pixel_lengths = np.bincount(PIXNUM[PIXNUM>=0],weights=skewer_lengths[PIXNUM>=0],minlength=N_pixels)
+    costs = {pixel:float(pixel_lengths[pixel]) for pixel in pixels}
+
+    return costs
+
+#Function to estimate the cost of processing each of a list of pixels from a master file.
+def get_pixel_costs(master_filename,pixels,z_min=0.0):
+
+    h = fits.open(master_filename)
+    master_data = h[1].data
+    cosmology_data = h[2].data
+    costs = get_pixel_costs_from_master_data(master_data,cosmology_data,pixels,z_min=z_min)
+    h.close()
+
+    return costs
+
+#Function to read the times taken to process pixels in previous runs, from the pixels' manifests (see checkpoint.py).
+#The recorded times of the given stages are added together. Pixels without a time for the last stage are left out.
+def get_pixel_timings(base_location,file_structure,N_side,pixels,stages=('gaussian','final')):
+
+    timings = {}
+    for pixel in pixels:
+        location = base_location + '/' + file_structure.format(pixel//100,pixel)
+        manifest = checkpoint.read_manifest(location,N_side,pixel)
+        stage_times = [manifest[stage]['time'] for stage in stages if 'time' in manifest.get(stage,{})]
+        if 'time' in manifest.get(stages[-1],{}):
+            timings[pixel] = float(np.sum(stage_times))
+
+    return timings
+
+#Function to refine estimated pixel costs using times recorded in previous runs.
+#The time per unit of estimated cost is fitted from the pixels with timings, and used to convert the costs of the other pixels into times.
+#Pixels with timings keep their recorded times. If there are no timings, the costs are returned unchanged.
+def refine_pixel_costs(costs,timings):
+
+    timed_pixels = [pixel for pixel in costs.keys() if pixel in timings]
+    if len(timed_pixels) == 0:
+        return dict(costs)
+
+    timed_costs = np.array([costs[pixel] for pixel in timed_pixels])
+    timed_times = np.array([timings[pixel] for pixel in timed_pixels])
+    if np.sum(timed_costs**2) > 0:
+        time_per_cost = np.sum(timed_costs*timed_times)/np.sum(timed_costs**2)
+    else:
+        time_per_cost = 0.
+
+    refined_costs = {}
+    for pixel, cost in costs.items():
+        if pixel in timings:
+            refined_costs[pixel] = timings[pixel]
+        else:
+            refined_costs[pixel] = float(time_per_cost*cost)
+
+    return refined_costs
+
+#Function to order pixels from most to least costly.
+def order_by_cost(pixels,costs):
+
+    ordered_pixels = sorted(pixels,key=lambda pixel: (-costs.get(pixel,0.),pixel))
+
+    return ordered_pixels
+
+#Function to split pixels into N_groups groups (e.g. one per node) with total costs as even as possible.
+#Pixels are assigned from most to least costly, each to the group with the lowest total cost so far (longest processing time first).
+#Each group is returned ordered from most to least costly, so that its pixels can be submitted in that order.
+def split_pixels_by_cost(pixels,costs,N_groups):
+
+    groups = [[] for i in range(N_groups)]
+    heap = [(0.,i) for i in range(N_groups)]
+
+    for pixel in order_by_cost(pixels,costs):
+        group_cost, i = heapq.heappop(heap)
+        groups[i] += [pixel]
+        heapq.heappush(heap,(group_cost + costs.get(pixel,0.),i))
+
+    return groups
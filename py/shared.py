@@ -0,0 +1,175 @@
+import numpy as np
+
+#Shared memory is only available from python 3.8. Without it, shared arrays are pickled in the same way as normal arrays.
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
+
+#Blocks of shared memory attached to by this process, by name, so that each is only attached to once.
+attached_blocks = {}
+
+#Positions of the MOCKIDs of each (file number, pixel number) pair in the shared MOCKID lookups attached to by this process, by the name of their index's block.
+MOCKID_lookup_positions = {}
+
+#Function to start the process that removes leaked blocks of shared memory, if it is not already running.
+#This should be called before starting a multiprocessing pool whose workers make shared arrays to return.
+#Otherwise each worker starts its own, which removes the worker's blocks as soon as the pool is closed.
+def start_resource_tracker():
+
+    if shared_memory is not None:
+        resource_tracker.ensure_running()
+
+    return
+
+#Function to attach to a block of shared memory by name.
+def attach_block(name):
+
+    if name not in attached_blocks:
+        attached_blocks[name] = shared_memory.SharedMemory(name=name)
+
+    return attached_blocks[name]
+
+#Class to hold an array in shared memory, so that it can be passed to and from multiprocessing workers without being copied.
+#Pickling a shared_array only pickles the name of its block of shared memory, and the array's shape and dtype.
+#Unpickling attaches to the block, giving a read-only view of the array as the 'array' attribute.
+#The block must be removed by calling 'unlink' once no process needs it any more.
+class shared_array:
+    def __init__(self,array):
+
+        array = np.ascontiguousarray(array)
+        self.shape = array.shape
+        self.dtype = array.dtype
+
+        if shared_memory is None or array.nbytes == 0:
+            self.name = None
+            self.array = array
+        else:
+            block = shared_memory.SharedMemory(create=True,size=array.nbytes)
+            attached_blocks[block.name] = block
+            self.name = block.name
+            self.array = np.ndarray(self.shape,dtype=self.dtype,buffer=block.buf)
+            self.array[...] = array
+
+        return
+
+    def __getstate__(self):
+
+        state = {'name':self.name,'shape':self.shape,'dtype':self.dtype}
+        if self.name is None:
+            state['array'] = self.array
+
+        return state
+
+    def __setstate__(self,state):
+
+        self.name = state['name']
+        self.shape = state['shape']
+        self.dtype = state['dtype']
+
+        if self.name is None:
+            self.array = state['array']
+        else:
+            block = attach_block(self.name)
+            self.array = np.ndarray(self.shape,dtype=self.dtype,buffer=block.buf)
+            self.array.flags.writeable = False
+
+        return
+
+    #Function to get a copy of the array that does not depend on the block of shared memory.
+    def copy(self):
+
+        return np.array(self.array)
+
+    #Function to remove the block of shared memory. Views of the array must not be used afterwards.
+    def unlink(self):
+
+        if self.name is not None and self.name in attached_blocks:
+            self.array = None
+            block = attached_blocks.pop(self.name)
+            block.unlink()
+
+            #If views of the array still exist, the memory is only released when they are.
+            try:
+                block.close()
+            except BufferError:
+                pass
+
+        return
+
+#Function to get the position of the MOCKIDs of each (file number, pixel number) pair from a MOCKID lookup index.
+def get_MOCKID_lookup_positions(lookup_index):
+
+    if lookup_index.name in MOCKID_lookup_positions:
+        return MOCKID_lookup_positions[lookup_index.name]
+
+    positions = {}
+    for FILENUM, PIXNUM, START, COUNT in lookup_index.array:
+        positions[(int(FILENUM),int(PIXNUM))] = (int(START),int(COUNT))
+
+    if lookup_index.name is not None:
+        MOCKID_lookup_positions[lookup_index.name] = positions
+
+    return positions
+
+#Class to look up the MOCKIDs of each (file number, pixel number) pair, in the same way as the dictionary made by master.MOCKID_lookup_index_to_dict.
+#The lookup index and MOCKIDs are held in shared memory, so that only their names are pickled when the lookup is passed to multiprocessing workers.
+class shared_MOCKID_lookup:
+    def __init__(self,lookup_index,sorted_MOCKID):
+
+        self.lookup_index = shared_array(lookup_index)
+        self.sorted_MOCKID = shared_array(sorted_MOCKID)
+        self.positions = get_MOCKID_lookup_positions(self.lookup_index)
+
+        return
+
+    def __getstate__(self):
+
+        return {'lookup_index':self.lookup_index,'sorted_MOCKID':self.sorted_MOCKID}
+
+    def __setstate__(self,state):
+
+        self.lookup_index = state['lookup_index']
+        self.sorted_MOCKID = state['sorted_MOCKID']
+        self.positions = get_MOCKID_lookup_positions(self.lookup_index)
+
+        return
+
+    def __getitem__(self,key):
+
+        START, COUNT = self.positions[key]
+
+        return self.sorted_MOCKID.array[START:START+COUNT]
+
+    def __contains__(self,key):
+
+        return key in self.positions
+
+    def __iter__(self):
+
+        return iter(self.positions)
+
+    def __len__(self):
+
+        return len(self.positions)
+
+    def keys(self):
+
+        return self.positions.keys()
+
+    def values(self):
+
+        return [self[key] for key in self.positions]
+
+    def items(self):
+
+        return [(key,self[key]) for key in self.positions]
+
+    #Function to remove the blocks of shared memory, once no process needs the lookup any more.
+    def unlink(self):
+
+        MOCKID_lookup_positions.pop(self.lookup_index.name,None)
+        self.lookup_index.unlink()
+        self.sorted_MOCKID.unlink()
+
+        return
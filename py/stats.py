@@ -1,25 +1,70 @@
 import numpy as np
 from astropy.io import fits
 
+import general
+import input
+import convert
+
 lya = 1215.67
 
 #Function to calculate the mean of deltas, mean of deltas^2, and N.
-def return_means(DELTA_rows,weights,sample_pc=1.0):
-    DELTA_SQUARED_rows = DELTA_rows**2
+#The relevant cells of each skewer are given by a compact ivar mask (see general.make_IVAR_cells).
+def return_means(DELTA_rows,IVAR_cells,sample_pc=1.0):
     N_cells = DELTA_rows.shape[1]
+    mask = general.IVAR_cells_to_mask(IVAR_cells,N_cells)
 
-    N = np.zeros(N_cells)
+    N = np.sum(mask,axis=0).astype('float64')
     mean_DELTA = np.zeros(N_cells)
     mean_DELTA_SQUARED = np.zeros(N_cells)
 
-    for j in range(N_cells):
-        N[j] = np.sum(weights[:,j],axis=0)
-        if N[j] > 0:
-            mean_DELTA[j] = np.average(DELTA_rows[:,j],weights=weights[:,j])
-            mean_DELTA_SQUARED[j] = np.average(DELTA_SQUARED_rows[:,j],weights=weights[:,j])
+    #Sum the deltas and deltas^2 over the relevant cells.
+    MASKED_DELTA_rows = np.where(mask,DELTA_rows,0.)
+    sum_DELTA = np.sum(MASKED_DELTA_rows,axis=0,dtype='float64')
+    sum_DELTA_SQUARED = np.sum(np.square(MASKED_DELTA_rows,dtype='float64'),axis=0)
+
+    relevant_cells = N > 0
+    mean_DELTA[relevant_cells] = sum_DELTA[relevant_cells]/N[relevant_cells]
+    mean_DELTA_SQUARED[relevant_cells] = sum_DELTA_SQUARED[relevant_cells]/N[relevant_cells]
 
     return N, mean_DELTA, mean_DELTA_SQUARED
 
+#Function to calculate N, and the sums of deltas and deltas^2, for groups of Gaussian skewers in a CoLoRe file, without making simulation_data objects.
+#MOCKID_groups is a dictionary of arrays of MOCKIDs, and the sums are returned in a dictionary with the same keys.
+#The relevant cells are those with IVAR=1 (as in 'return_means'), and the skewers are read in blocks of N_skewers_block to limit memory use.
+def get_gaussian_sums(filename,file_number,input_format,MOCKID_groups,IVAR_cutoff=lya,N_skewers_block=1024):
+
+    h = fits.open(filename)
+    h_MOCKID = input.get_MOCKID(h,input_format,file_number)
+    h_Z_QSO = input.get_Z_QSO(h,input_format)
+    LOGLAM_MAP = np.log10(input.get_lya_lambdas(h,input_format))
+    N_cells = LOGLAM_MAP.shape[0]
+
+    sums = {}
+    for key, MOCKIDs in MOCKID_groups.items():
+        rows = np.where(np.isin(h_MOCKID,MOCKIDs))[0]
+        IVAR_cells = general.make_IVAR_cells(IVAR_cutoff,h_Z_QSO[rows],LOGLAM_MAP)
+
+        N = 0
+        sum_DELTA = 0.
+        sum_DELTA_SQUARED = 0.
+        for start in range(0,rows.shape[0],N_skewers_block):
+            stop = min(start+N_skewers_block,rows.shape[0])
+            DELTA_rows = input.get_image_rows(h,2,rows[start:stop])
+            if input_format == 'physical_colore':
+                DELTA_rows = convert.lognormal_delta_to_gaussian(DELTA_rows,h[4].header['SIGMA_G'],h[4].data['D'])
+
+            mask = general.IVAR_cells_to_mask(IVAR_cells[start:stop],N_cells)
+            MASKED_DELTA_rows = np.where(mask,DELTA_rows,0.)
+            N += int(np.sum(mask))
+            sum_DELTA += float(np.sum(MASKED_DELTA_rows,dtype='float64'))
+            sum_DELTA_SQUARED += float(np.sum(np.square(MASKED_DELTA_rows,dtype='float64')))
+
+        sums[key] = (N,sum_DELTA,sum_DELTA_SQUARED)
+
+    h.close()
+
+    return sums
+
 #
 def combine_pixel_means(results):
 
@@ -0,0 +1,321 @@
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from multiprocessing import Pool
+
+#A work queue shared between workers on any number of hosts through a shared directory.
+#Each stage of work has its own directory, with subdirectories holding one file per task:
+#    pending/    tasks waiting to be claimed, claimed in the order of their names
+#    claimed/    tasks being worked on, whose files are touched regularly by their workers
+#    done/       tasks that have been completed
+#    failed/     tasks that failed max_attempts times
+#Tasks are claimed by renaming their file from pending/ to claimed/, which only one worker can do.
+#Each claim has a unique ID, so that a worker whose claim was requeued as stale cannot complete or fail another worker's claim of the same task.
+#Claimed tasks whose files have not been touched for longer than timeout (e.g. as their worker died) are returned to pending/.
+
+#Function to get the directory of a stage of a queue.
+def get_stage_directory(queue_dir,stage):
+
+    stage_dir = queue_dir + '/' + stage
+
+    return stage_dir
+
+#Function to get a name for the current worker, unique across hosts.
+def get_worker_id():
+
+    worker_id = '{}-{}'.format(socket.gethostname(),os.getpid())
+
+    return worker_id
+
+#Function to write a task file, atomically.
+def write_task_file(filename,task_data):
+
+    temporary_filename = os.path.join(os.path.dirname(filename),'.tmp-{}-{}'.format(get_worker_id(),os.path.basename(filename)))
+    with open(temporary_filename,'w') as f:
+        json.dump(task_data,f)
+    os.replace(temporary_filename,filename)
+
+    return
+
+#Function to read a task file. If the file has been moved by another worker in the meantime, None is returned.
+def read_task_file(filename):
+
+    try:
+        with open(filename) as f:
+            task_data = json.load(f)
+    except (FileNotFoundError,ValueError):
+        task_data = None
+
+    return task_data
+
+#Function to list the tasks in a state (a subdirectory) of a stage, in order.
+def list_tasks(queue_dir,stage,state):
+
+    state_dir = get_stage_directory(queue_dir,stage) + '/' + state
+    tasks = sorted([filename for filename in os.listdir(state_dir) if not filename.startswith('.')])
+
+    return tasks
+
+#Function to set up a stage of a queue with a list of tasks, to be claimed in the order given.
+#Only the first worker to get here adds the tasks. The others wait until the tasks have been added, for up to timeout seconds.
+#If the stage has already been set up (e.g. by an earlier run), it is left as it is.
+def make_stage(queue_dir,stage,tasks,timeout=600.):
+
+    stage_dir = get_stage_directory(queue_dir,stage)
+    ready_filename = stage_dir + '/ready'
+
+    os.makedirs(queue_dir,exist_ok=True)
+    try:
+        os.mkdir(stage_dir)
+    except FileExistsError:
+        start = time.time()
+        while not os.path.exists(ready_filename):
+            if time.time() - start > timeout:
+                raise RuntimeError('Stage {} of queue {} was not set up within {}s.'.format(stage,queue_dir,timeout))
+            time.sleep(1.)
+        return
+
+    for state in ['pending','claimed','done','failed']:
+        os.mkdir(stage_dir + '/' + state)
+
+    #Prefix the task names with their positions in the list, so that they are claimed in order.
+    N_digits = len(str(len(tasks)))
+    for i, task in enumerate(tasks):
+        filename = stage_dir + '/pending/' + '{}-{}'.format(str(i).zfill(N_digits),task)
+        write_task_file(filename,{'task':str(task),'attempts':0})
+
+    #Record the number of tasks, to tell when the stage is complete.
+    with open(ready_filename,'w') as f:
+        json.dump({'N_tasks':len(tasks)},f)
+
+    return
+
+#Function to get the number of tasks in a stage, recorded when it was set up.
+def get_stage_size(queue_dir,stage):
+
+    with open(get_stage_directory(queue_dir,stage) + '/ready') as f:
+        N_tasks = json.load(f)['N_tasks']
+
+    return N_tasks
+
+#Function to determine whether all of a stage's tasks are done or have failed.
+#Tasks in pending/ and claimed/ are not counted directly, as they are briefly hidden while being moved between them.
+def stage_complete(queue_dir,stage):
+
+    N_finished = len(list_tasks(queue_dir,stage,'done')) + len(list_tasks(queue_dir,stage,'failed'))
+
+    return N_finished == get_stage_size(queue_dir,stage)
+
+#Function to hold a task's file by moving it to a hidden name private to the current worker, so that no other worker can move it at the same time.
+#The held file is touched, so that it is not mistaken for a stale one. Returns the held file's name, or None if another worker moved the file first.
+def hold_task(state_dir,filename):
+
+    held_filename = state_dir + '/.held-{}.{}'.format(filename,uuid.uuid4().hex)
+    try:
+        os.rename(state_dir + '/' + filename,held_filename)
+        os.utime(held_filename)
+    except FileNotFoundError:
+        return None
+
+    return held_filename
+
+#Function to move a held task's file. Returns False if it was lost to another worker in the meantime.
+def move_held_task(held_filename,filename):
+
+    try:
+        os.rename(held_filename,filename)
+    except FileNotFoundError:
+        return False
+
+    return True
+
+#Function to hold a claimed task's file, if it is still claimed with the given claim ID.
+#Returns the name of the held file and the task's data, or None if the task has been lost to another worker (e.g. after being requeued as stale).
+def hold_claimed_task(queue_dir,stage,filename,claim_id):
+
+    claimed_dir = get_stage_directory(queue_dir,stage) + '/claimed'
+    held_filename = hold_task(claimed_dir,filename)
+    if held_filename is None:
+        return None
+
+    #If the task has been claimed again since, it belongs to another worker, so put it back.
+    task_data = read_task_file(held_filename)
+    if task_data is None or task_data.get('claim') != claim_id:
+        move_held_task(held_filename,claimed_dir + '/' + filename)
+        return None
+
+    return held_filename, task_data
+
+#Function to claim the next pending task of a stage.
+#Returns the name of the task's file and its data, including a claim ID unique to this claim, or None if there are no pending tasks.
+def claim_task(queue_dir,stage,worker_id):
+
+    stage_dir = get_stage_directory(queue_dir,stage)
+    for filename in list_tasks(queue_dir,stage,'pending'):
+        #Take the file from pending/ before recording the claim in it, so that no other worker can change it.
+        held_filename = hold_task(stage_dir + '/pending',filename)
+        if held_filename is None:
+            continue
+
+        task_data = read_task_file(held_filename)
+        if task_data is None:
+            continue
+        task_data['worker'] = worker_id
+        task_data['claim'] = '{}-{}'.format(worker_id,uuid.uuid4().hex)
+        write_task_file(held_filename,task_data)
+        if not move_held_task(held_filename,stage_dir + '/claimed/' + filename):
+            continue
+
+        return filename, task_data
+
+    return None
+
+#Function to mark a claimed task as done.
+#Returns False if the task has been lost to another worker, in which case it is left to that worker.
+def complete_task(queue_dir,stage,filename,claim_id):
+
+    held = hold_claimed_task(queue_dir,stage,filename,claim_id)
+    if held is None:
+        return False
+
+    held_filename, task_data = held
+
+    return move_held_task(held_filename,get_stage_directory(queue_dir,stage) + '/done/' + filename)
+
+#Function to mark a claimed task as failed, with a message.
+#The task is returned to pending/ to be tried again, unless it has already been tried max_attempts times.
+#Returns False if the task has been lost to another worker, in which case it is left to that worker.
+def fail_task(queue_dir,stage,filename,claim_id,message,max_attempts=3):
+
+    held = hold_claimed_task(queue_dir,stage,filename,claim_id)
+    if held is None:
+        return False
+
+    held_filename, task_data = held
+    task_data['attempts'] += 1
+    task_data['message'] = message
+    task_data.pop('claim')
+    write_task_file(held_filename,task_data)
+
+    stage_dir = get_stage_directory(queue_dir,stage)
+    if task_data['attempts'] < max_attempts:
+        return move_held_task(held_filename,stage_dir + '/pending/' + filename)
+    else:
+        return move_held_task(held_filename,stage_dir + '/failed/' + filename)
+
+#Function to return claimed tasks that have not been touched for longer than timeout seconds to pending/.
+#This counts as a failed attempt, so that tasks that repeatedly kill their workers end up in failed/.
+#Tasks left held by a worker that died while moving them are returned to the state they were being moved from.
+def requeue_stale_tasks(queue_dir,stage,timeout=600.,max_attempts=3):
+
+    stage_dir = get_stage_directory(queue_dir,stage)
+
+    for state in ['pending','claimed']:
+        state_dir = stage_dir + '/' + state
+        for held_name in [name for name in os.listdir(state_dir) if name.startswith('.held-')]:
+            try:
+                age = time.time() - os.path.getmtime(state_dir + '/' + held_name)
+            except FileNotFoundError:
+                continue
+            if age > timeout:
+                filename = held_name[len('.held-'):].rsplit('.',1)[0]
+                move_held_task(state_dir + '/' + held_name,state_dir + '/' + filename)
+
+    for filename in list_tasks(queue_dir,stage,'claimed'):
+        try:
+            age = time.time() - os.path.getmtime(stage_dir + '/claimed/' + filename)
+        except FileNotFoundError:
+            continue
+        if age <= timeout:
+            continue
+        task_data = read_task_file(stage_dir + '/claimed/' + filename)
+        if task_data is not None:
+            fail_task(queue_dir,stage,filename,task_data.get('claim'),'no heartbeat for {:.0f}s'.format(age),max_attempts=max_attempts)
+
+    return
+
+#Class to touch a claimed task's file regularly in a background thread, to show that its worker is still alive.
+class heartbeat:
+    def __init__(self,filename,interval):
+        self.filename = filename
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run,daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            #The file may be held briefly by another worker, or lost if the task was requeued, so carry on regardless.
+            try:
+                os.utime(self.filename)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self,*exc):
+        self.stopped.set()
+        self.thread.join()
+        return False
+
+#Function to work on a stage: claim and run tasks until all of the stage's tasks are done or have failed, on any host.
+#function is called with the name of each task, and a list of (task, result) pairs for the tasks completed by this worker is returned.
+#While waiting for other workers' tasks to finish, stale tasks are requeued, and picked up again.
+def work(queue_dir,stage,function,timeout=600.,max_attempts=3,poll_interval=5.):
+
+    stage_dir = get_stage_directory(queue_dir,stage)
+    worker_id = get_worker_id()
+    results = []
+
+    while True:
+        claim = claim_task(queue_dir,stage,worker_id)
+
+        if claim is None:
+            if stage_complete(queue_dir,stage):
+                break
+            requeue_stale_tasks(queue_dir,stage,timeout=timeout,max_attempts=max_attempts)
+            time.sleep(poll_interval)
+            continue
+
+        filename, task_data = claim
+        task = task_data['task']
+        try:
+            with heartbeat(stage_dir + '/claimed/' + filename,timeout/4.):
+                result = function(task)
+        except Exception:
+            fail_task(queue_dir,stage,filename,task_data['claim'],traceback.format_exc(),max_attempts=max_attempts)
+            print('Error in task {} of stage {}:\n{}'.format(task,stage,traceback.format_exc()),flush=True)
+            continue
+
+        #If the task was requeued as stale while it was running, another worker now has it, and will record it as done.
+        if complete_task(queue_dir,stage,filename,task_data['claim']):
+            results += [(task,result)]
+        else:
+            print('Task {} of stage {} was lost to another worker.'.format(task,stage),flush=True)
+
+    return results
+
+#Function to run a stage of a queue with N_processes local worker processes, returning once the stage is complete on all hosts.
+#Returns the (task, result) pairs of the tasks completed by these processes, and the names of any tasks that failed.
+def run_stage(queue_dir,stage,tasks,function,N_processes=1,timeout=600.,max_attempts=3,poll_interval=5.):
+
+    make_stage(queue_dir,stage,tasks,timeout=timeout)
+
+    pool = Pool(processes = N_processes)
+    process_results = [pool.apply_async(work,(queue_dir,stage,function),{'timeout':timeout,'max_attempts':max_attempts,'poll_interval':poll_interval}) for i in range(N_processes)]
+    pool.close()
+    pool.join()
+
+    results = []
+    for process_result in process_results:
+        results += process_result.get()
+
+    stage_dir = get_stage_directory(queue_dir,stage)
+    failed_tasks = [read_task_file(stage_dir + '/failed/' + filename)['task'] for filename in list_tasks(queue_dir,stage,'failed')]
+
+    return results, failed_tasks
@@ -69,47 +69,29 @@ cat > $RUN_FILE <<EOF
 umask 0002
 export OMP_NUM_THREADS=64
 
-PIXDIRS=\`\ls -tr1d ${OUTPUT_PATH}/[0-9]*/*\`
-NPIXELS=\`echo \$PIXDIRS | wc -w\`
-PIXDIRS_list=(\$PIXDIRS)
-
-PIXELS=()
-for PIXDIR in \$PIXDIRS ; do 
-    PIX=\${PIXDIR##*/}
-    PIXELS=("\${PIXELS[@]}" \$PIX)
-done
-
-NPIXELS_PER_NODE=\$(( (\$NPIXELS + $NNODES - 1)/$NNODES ))
-START_INDEX=0
-STOP_INDEX=\$(( \$NPIXELS_PER_NODE - 1 ))
-FINAL_NODE=0
-
-for NODE in \`seq $NNODES\` ; do
-    echo "starting node \$NODE"
-
-    NODE_PIXELS=\${PIXELS[@]:\$START_INDEX:\$NPIXELS_PER_NODE}
+# split the pixels between the nodes by their estimated costs (refined by the timings of any previous runs)
+# each line of the node pixels file lists one node's pixels, from most to least costly
+NODE_PIXELS_FILE=${OUTPUT_PATH}/logs/node-pixels.txt
+${PROCESS_PATH}/schedule_pixels.py --out-dir ${OUTPUT_PATH} --nside ${NSIDE} --nnodes ${NNODES} --lambda-min ${LAMBDA_MIN} --out-file \$NODE_PIXELS_FILE
+
+NODE=0
+while read NODE_PIXELS ; do
+    NODE=\$(( \$NODE + 1 ))
+
+    if [ -z "\$NODE_PIXELS" ] ; then
+        echo "no pixels allocated to node \$NODE"
+        continue
+    fi
 
+    echo "starting node \$NODE"
     echo "looking at pixels: \${NODE_PIXELS}"
 
     command="srun -N 1 -n 1 -c ${NCORES} ${PROCESS_PATH}/make_transmission.py --in-dir ${INPUT_PATH} --out-dir ${OUTPUT_PATH} --pixels \${NODE_PIXELS} --tuning-file ${TUNING_PATH} --nside ${NSIDE} --nproc ${NCORES} --IVAR-cut ${IVAR_CUT} --cell-size ${CELL_SIZE} --lambda-min ${LAMBDA_MIN} ${FLAGS}"
 
     echo \$command
-    \$command >& ${OUTPUT_PATH}/logs/node-\${NODE}.log &
-
-    if (( \$FINAL_NODE == 1)) ; then
-        echo "all pixels allocated, no more nodes needed"
-        break
-    fi
-
-    START_INDEX=\$(( \$STOP_INDEX + 1 ))
-    STOP_INDEX=\$(( \$START_INDEX + \$NPIXELS_PER_NODE - 1))
-
-    if (( \$STOP_INDEX >= (\$NPIXELS - 1) )) ; then
-        STOP_INDEX=\$NPIXELS-1
-        FINAL_NODE=1
-    fi
+    \$command >& ${OUTPUT_PATH}/logs/node-\${NODE}.log < /dev/null &
 
-done
+done < \$NODE_PIXELS_FILE
 
 wait
 
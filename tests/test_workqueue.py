@@ -0,0 +1,87 @@
+import os
+import sys
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','py'))
+
+import workqueue
+
+#Function to make a claimed task's file look as if its worker stopped touching it long ago.
+def make_stale(queue_dir,stage,filename):
+
+    old_time = time.time() - 3600.
+    os.utime(workqueue.get_stage_directory(queue_dir,stage) + '/claimed/' + filename,(old_time,old_time))
+
+    return
+
+def test_stale_claim_cannot_be_completed_by_its_old_worker(tmp_path):
+
+    queue_dir = str(tmp_path)
+    workqueue.make_stage(queue_dir,'final',['17'])
+
+    #Worker A claims the task, stops touching it, and it is requeued.
+    filename, task_data_A = workqueue.claim_task(queue_dir,'final','A')
+    make_stale(queue_dir,'final',filename)
+    workqueue.requeue_stale_tasks(queue_dir,'final',timeout=60.)
+    assert workqueue.list_tasks(queue_dir,'final','pending') == [filename]
+
+    #Worker B claims it again.
+    filename_B, task_data_B = workqueue.claim_task(queue_dir,'final','B')
+    assert filename_B == filename
+    assert task_data_B['attempts'] == 1
+
+    #A finishing late must not complete B's claim.
+    assert not workqueue.complete_task(queue_dir,'final',filename,task_data_A['claim'])
+    assert not workqueue.fail_task(queue_dir,'final',filename,task_data_A['claim'],'late failure')
+    assert workqueue.list_tasks(queue_dir,'final','claimed') == [filename]
+    assert workqueue.list_tasks(queue_dir,'final','done') == []
+
+    #B completes it, and then the stage is complete.
+    assert workqueue.complete_task(queue_dir,'final',filename,task_data_B['claim'])
+    assert workqueue.list_tasks(queue_dir,'final','done') == [filename]
+    assert workqueue.stage_complete(queue_dir,'final')
+
+    #A claim that has been completed cannot be completed again.
+    assert not workqueue.complete_task(queue_dir,'final',filename,task_data_B['claim'])
+
+def test_stale_claim_is_only_requeued_once(tmp_path):
+
+    queue_dir = str(tmp_path)
+    workqueue.make_stage(queue_dir,'final',['17'])
+
+    filename, task_data = workqueue.claim_task(queue_dir,'final','A')
+
+    #Two workers requeue the same stale claim.
+    assert workqueue.fail_task(queue_dir,'final',filename,task_data['claim'],'no heartbeat')
+    assert not workqueue.fail_task(queue_dir,'final',filename,task_data['claim'],'no heartbeat')
+
+    assert workqueue.list_tasks(queue_dir,'final','claimed') == []
+    assert workqueue.list_tasks(queue_dir,'final','pending') == [filename]
+    assert workqueue.read_task_file(workqueue.get_stage_directory(queue_dir,'final') + '/pending/' + filename)['attempts'] == 1
+
+def test_held_task_of_dead_worker_is_recovered(tmp_path):
+
+    queue_dir = str(tmp_path)
+    workqueue.make_stage(queue_dir,'final',['17'])
+
+    #A worker dies while holding a pending task's file.
+    pending_dir = workqueue.get_stage_directory(queue_dir,'final') + '/pending'
+    filename = workqueue.list_tasks(queue_dir,'final','pending')[0]
+    held_filename = workqueue.hold_task(pending_dir,filename)
+    old_time = time.time() - 3600.
+    os.utime(held_filename,(old_time,old_time))
+    assert workqueue.claim_task(queue_dir,'final','B') is None
+
+    workqueue.requeue_stale_tasks(queue_dir,'final',timeout=60.)
+    assert workqueue.list_tasks(queue_dir,'final','pending') == [filename]
+
+def test_work_runs_every_task_once(tmp_path):
+
+    queue_dir = str(tmp_path)
+    tasks = [str(i) for i in range(5)]
+    workqueue.make_stage(queue_dir,'final',tasks)
+
+    results = workqueue.work(queue_dir,'final',lambda task: int(task)**2,poll_interval=0.01)
+
+    assert sorted(results) == sorted([(task,int(task)**2) for task in tasks])
+    assert workqueue.stage_complete(queue_dir,'final')